@@ -0,0 +1,146 @@
+import asyncio
+from collections import deque
+from config import Config
+from metrics import ADMISSIONS, BUFFERED_BYTES
+
+# Memory ceiling and admission control.
+# Every forwarder holds the bytes it has read against one process-wide budget until they
+# are accepted by the next socket (below its high water mark) or the peer's mux window.
+# While the budget is exhausted forwarders stop reading, so TCP pushes back on the senders,
+# and new connections are turned away instead of adding more buffers.
+
+RESUME_FRACTION = 0.75 # Stalled forwarders resume once usage drops below this share of the budget
+
+_BUFFERED = BUFFERED_BYTES.labels()
+
+
+def set_water_marks(writer):
+    """Applies the per-stream write buffer limits: drain() waits above high until below low."""
+    transport = writer.transport
+    if transport is not None and not transport.is_closing():
+        transport.set_write_buffer_limits(high=Config.STREAM_HIGH_WATER, low=Config.STREAM_LOW_WATER)
+
+
+class BufferBudget:
+    """Bytes held in flight by all connections together, capped at limit (0 = unlimited)."""
+    def __init__(self, limit=None):
+        self.limit = Config.MEMORY_BUDGET if limit is None else limit
+        self.used = 0
+        self.peak = 0
+        self.stalls = 0 # Times a forwarder had to wait for the budget
+        self._waiters = deque()
+
+    def exhausted(self) -> bool:
+        return self.limit > 0 and self.used >= self.limit
+
+    def pressure(self) -> float:
+        return self.used / self.limit if self.limit > 0 else 0.0
+
+    def charge(self, n):
+        self.used += n
+        if self.used > self.peak:
+            self.peak = self.used
+        _BUFFERED.value = self.used
+
+    def release(self, n):
+        self.used -= n
+        _BUFFERED.value = self.used
+        if self._waiters and self.used < self.limit * RESUME_FRACTION:
+            while self._waiters:
+                waiter = self._waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(None)
+
+    async def wait(self):
+        """Returns once there is room in the budget."""
+        if not self.exhausted():
+            return
+        self.stalls += 1
+        while self.exhausted():
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            await waiter
+
+    async def hold(self, n, operation):
+        """Awaits operation (a write that may block on a slow peer) with n bytes charged, then waits for room."""
+        self.charge(n)
+        try:
+            await operation
+        finally:
+            self.release(n)
+        await self.wait()
+
+
+BUDGET = BufferBudget()
+
+
+class AdmissionControl:
+    """
+    Caps concurrent connections at max_active. Connections beyond that wait in a FIFO queue
+    for up to timeout seconds; they are rejected at once when the queue is full or the
+    memory budget is exhausted.
+    """
+    def __init__(self, role, max_active=None, max_queued=None, timeout=None, budget=None):
+        self.role = role
+        self.max_active = Config.MAX_CONNECTIONS if max_active is None else max_active
+        self.max_queued = Config.ADMISSION_QUEUE if max_queued is None else max_queued
+        self.timeout = Config.ADMISSION_TIMEOUT if timeout is None else timeout
+        self.budget = BUDGET if budget is None else budget
+        self.active = 0
+        self.rejected = 0
+        self._queue = deque() # Futures of waiting connections, oldest first
+
+    async def admit(self) -> bool:
+        """Takes a slot, waiting in the queue if necessary. False means the connection must be refused."""
+        if self.budget.exhausted():
+            return self._reject('rejected_memory')
+        if self.max_active <= 0 or (self.active < self.max_active and not self._queue):
+            self.active += 1
+            ADMISSIONS.labels(self.role, 'admitted').inc()
+            return True
+        if len(self._queue) >= self.max_queued:
+            return self._reject('rejected_full')
+
+        ADMISSIONS.labels(self.role, 'queued').inc()
+        waiter = asyncio.get_running_loop().create_future()
+        self._queue.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self.timeout) # release() hands its slot over
+        except asyncio.TimeoutError:
+            self._dequeue(waiter)
+            return self._reject('rejected_timeout')
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release() # Got the slot just as we were cancelled: pass it on
+            else:
+                self._dequeue(waiter)
+            raise
+        ADMISSIONS.labels(self.role, 'admitted').inc()
+        return True
+
+    def release(self):
+        while self._queue:
+            waiter = self._queue.popleft()
+            if not waiter.done():
+                waiter.set_result(None) # The slot passes straight to the oldest waiter
+                return
+        self.active -= 1
+
+    def _dequeue(self, waiter):
+        try: self._queue.remove(waiter)
+        except ValueError: pass
+
+    def _reject(self, reason) -> bool:
+        self.rejected += 1
+        ADMISSIONS.labels(self.role, reason).inc()
+        return False
+
+    def stats(self) -> dict:
+        return {
+            'admitted_active': self.active,
+            'admission_queued': len(self._queue),
+            'admission_rejected': self.rejected,
+            'buffered_bytes': self.budget.used,
+            'buffered_peak': self.budget.peak,
+            'buffer_stalls': self.budget.stalls,
+        }
@@ -0,0 +1,59 @@
+import argparse
+import asyncio
+import os
+import time
+from cryptopool import CryptoExecutor
+from encryption import CounterNonceCipher
+
+# Finds the frame size above which sealing on the crypto executor beats sealing inline.
+# Usage: python src/bench_crypto.py [--workers 4] [--streams 8] [--megabytes 64]
+
+SIZES = [1024, 4096, 8192, 16384, 32768, 65536, 262144]
+
+async def seal_all(executor, size, streams, total_bytes):
+    """Seals total_bytes split across concurrent streams. Returns MB/s."""
+    payload = os.urandom(size)
+    frames_per_stream = max(1, total_bytes // size // streams)
+
+    async def stream():
+        cipher = CounterNonceCipher(os.urandom(32), is_client=True)
+        for _ in range(frames_per_stream):
+            nonce = cipher.next_send_nonce()
+            if executor.should_offload(size):
+                await executor.run(cipher.aesgcm.encrypt, nonce, payload, None)
+            else:
+                cipher.aesgcm.encrypt(nonce, payload, None)
+                await asyncio.sleep(0) # Yield like a forwarder does on drain()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[stream() for _ in range(streams)])
+    elapsed = time.perf_counter() - start
+    return frames_per_stream * streams * size / elapsed / 1e6
+
+async def main(workers, streams, megabytes):
+    inline = CryptoExecutor(workers=0)
+    pooled = CryptoExecutor(workers=workers, threshold=0)
+    total = megabytes * 1024 * 1024
+    crossover = None
+
+    print(f"{'frame':>8} {'inline MB/s':>12} {'pool MB/s':>10}  ({workers} workers, {streams} streams)")
+    for size in SIZES:
+        a = await seal_all(inline, size, streams, total)
+        b = await seal_all(pooled, size, streams, total)
+        print(f"{size:>8} {a:>12.1f} {b:>10.1f}")
+        if crossover is None and b > a:
+            crossover = size
+    pooled.shutdown()
+
+    if crossover:
+        print(f"Offloading wins from {crossover} byte frames: set Config.CRYPTO_OFFLOAD_THRESHOLD accordingly.")
+    else:
+        print("Offloading never won on this machine: keep Config.CRYPTO_WORKERS = 0.")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="AES-GCM inline vs. worker pool crossover")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 4)
+    parser.add_argument('--streams', type=int, default=8)
+    parser.add_argument('--megabytes', type=int, default=64)
+    args = parser.parse_args()
+    asyncio.run(main(args.workers, args.streams, args.megabytes))
@@ -0,0 +1,330 @@
+import argparse
+import ast
+import asyncio
+import json
+import logging
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+from config import Config
+from eventloop import BACKENDS, available_backends, current_backend, run
+from metrics import COMPRESSION_BYTES
+
+# End-to-end load benchmark: ShadowServer, ShadowClient and a local target in one process.
+# Usage: python src/bench_load.py [--clients 32] [--connections 500] [--megabytes 256]
+#                                 [--in-process] [--set DATA_PLANE=buffered] [--output results.json]
+#                                 [--compare baseline.json] [--loop uvloop | --compare-loops]
+
+TARGET_ECHO = b'E'
+TARGET_SINK = b'S' # Reads until EOF, then replies with the byte count (8 bytes)
+TARGET_SOURCE = b'D' # + size (8 bytes) + payload kind (1 byte): sends that many bytes, then closes
+
+CHUNK = 64 * 1024
+
+
+def payload_block(kind) -> bytes:
+    """One CHUNK of bulk data: random (incompressible) or text-like (zlib -1 gets it to about 30%)."""
+    if kind == 'text':
+        words = [os.urandom(2 + i % 5).hex().encode() for i in range(256)]
+        seed = int.from_bytes(os.urandom(4), 'big')
+        out = bytearray()
+        while len(out) < CHUNK:
+            seed = (seed * 1103515245 + 12345) & 0x7FFFFFFF
+            out += words[(seed >> 8) % len(words)] + b' '
+        return bytes(out[:CHUNK])
+    return os.urandom(CHUNK)
+
+
+# Result keys where a bigger number is better (for --compare)
+HIGHER_IS_BETTER = {'setup_rate', 'upload_mbps', 'download_mbps'}
+
+
+async def handle_target(reader, writer):
+    try:
+        mode = await reader.readexactly(1)
+        if mode == TARGET_ECHO:
+            while True:
+                data = await reader.read(CHUNK)
+                if not data: break
+                writer.write(data)
+                await writer.drain()
+        elif mode == TARGET_SINK:
+            total = 0
+            while True:
+                data = await reader.read(CHUNK)
+                if not data: break
+                total += len(data)
+            writer.write(total.to_bytes(8, 'big'))
+            await writer.drain()
+        elif mode == TARGET_SOURCE:
+            remaining = int.from_bytes(await reader.readexactly(8), 'big')
+            block = payload_block('text' if await reader.readexactly(1) == b't' else 'random')
+            while remaining > 0:
+                writer.write(block[:remaining])
+                remaining -= min(remaining, CHUNK)
+                await writer.drain()
+    except Exception:
+        pass
+    finally:
+        writer.close()
+
+
+async def socks_connect(port, target_port):
+    """Opens a SOCKS5 connection through the client to 127.0.0.1:target_port."""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(b'\x05\x01\x00')
+    writer.write(b'\x05\x01\x00\x01' + socket.inet_aton('127.0.0.1') + target_port.to_bytes(2, 'big'))
+    await writer.drain()
+    await reader.readexactly(2)
+    reply = await reader.readexactly(10)
+    if reply[1] != 0x00:
+        raise ConnectionError(f"SOCKS reply {reply[1]}")
+    return reader, writer
+
+
+def percentiles(samples) -> dict:
+    if not samples:
+        return {}
+    samples = sorted(samples)
+    pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))]
+    return {'p50_ms': pick(0.50) * 1000, 'p90_ms': pick(0.90) * 1000, 'p99_ms': pick(0.99) * 1000,
+            'max_ms': samples[-1] * 1000, 'count': len(samples)}
+
+
+async def bench_setup(args, target_port):
+    """Connection setup: SOCKS greeting through to the first echoed byte, over --clients workers."""
+    latencies = []
+    remaining = args.connections
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            start = time.perf_counter()
+            reader, writer = await socks_connect(Config.CLIENT_PORT, target_port)
+            writer.write(TARGET_ECHO + b'x')
+            await reader.readexactly(1)
+            latencies.append(time.perf_counter() - start)
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(args.clients)])
+    elapsed = time.perf_counter() - start
+    result = {'setup_rate': len(latencies) / elapsed}
+    result.update({f'setup_{k}': v for k, v in percentiles(latencies).items()})
+    return result
+
+
+async def bench_handshakes(client, rounds):
+    """Tunnel handshake round trips (connect to the server's first reply), full and resumed, and their CPU cost."""
+    from mux import MUX_HELLO
+    full, resumed = [], []
+    cpu = time.process_time()
+    for i in range(rounds):
+        if i % 2 == 0:
+            client.ticket = None
+        start = time.perf_counter()
+        tunnel, _ = await client.open_request(MUX_HELLO)
+        (resumed if tunnel.resumed else full).append(time.perf_counter() - start)
+        tunnel.close()
+    cpu = time.process_time() - cpu
+    result = {f'handshake_full_{k}': v for k, v in percentiles(full).items()}
+    result.update({f'handshake_resumed_{k}': v for k, v in percentiles(resumed).items()})
+    result['handshake_cpu_ms'] = cpu / rounds * 1000 # Client and server side together, averaged over both kinds
+    return result
+
+
+async def bench_bulk(args, target_port):
+    """Bulk throughput in each direction, --megabytes split across --clients connections."""
+    per_client = args.megabytes * 1024 * 1024 // args.clients
+    block = payload_block(args.payload)
+
+    async def upload():
+        reader, writer = await socks_connect(Config.CLIENT_PORT, target_port)
+        writer.write(TARGET_SINK)
+        sent = 0
+        while sent < per_client:
+            writer.write(block[:per_client - sent])
+            sent += min(CHUNK, per_client - sent)
+            await writer.drain()
+        writer.write_eof()
+        received = int.from_bytes(await reader.readexactly(8), 'big')
+        writer.close()
+        if received != per_client:
+            raise RuntimeError(f"Sink got {received} of {per_client} bytes")
+
+    async def download():
+        reader, writer = await socks_connect(Config.CLIENT_PORT, target_port)
+        writer.write(TARGET_SOURCE + per_client.to_bytes(8, 'big') + args.payload[:1].encode())
+        received = 0
+        while True:
+            data = await reader.read(CHUNK)
+            if not data: break
+            received += len(data)
+        writer.close()
+        if received != per_client:
+            raise RuntimeError(f"Got {received} of {per_client} bytes")
+
+    result = {}
+    total = per_client * args.clients
+    for name, fn in (('upload', upload), ('download', download)):
+        cpu = time.process_time()
+        start = time.perf_counter()
+        await asyncio.gather(*[fn() for _ in range(args.clients)])
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu
+        result[f'{name}_mbps'] = total / elapsed / 1e6
+        result[f'{name}_cpu_s_per_gb'] = cpu / (total / 1e9)
+    compressed_in = COMPRESSION_BYTES.labels('input').value
+    if compressed_in:
+        result['compression_ratio'] = COMPRESSION_BYTES.labels('output').value / compressed_in
+    return result
+
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'event_loop': current_backend(),
+        'config': {key: getattr(Config, key) for key in ('MULTIPLEX', 'MUX_TUNNELS', 'WIRE_V2', 'FRAME_SIZE',
+                                                         'DATA_PLANE', 'CRYPTO_WORKERS', 'SESSION_TICKETS',
+                                                         'COMPRESSION', 'MAX_CONNECTIONS', 'MEMORY_BUDGET')},
+    }
+
+
+async def main(args):
+    # The bench owns its ports; never touch a running instance
+    Config.SERVER_PORT = args.server_port
+    Config.CLIENT_PORT = args.client_port
+    Config.METRICS_PORT = 0
+    for setting in args.set:
+        key, _, value = setting.partition('=')
+        if not hasattr(Config, key):
+            raise SystemExit(f"Unknown setting {key}")
+        try:
+            value = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            pass # Plain strings need no quotes
+        setattr(Config, key, value)
+
+    from client import ShadowClient
+    from server import ShadowServer
+    logging.getLogger().setLevel(logging.WARNING) # Per-connection INFO lines would dominate the profile
+
+    target = await asyncio.start_server(handle_target, '127.0.0.1', 0)
+    target_port = target.sockets[0].getsockname()[1]
+    server = ShadowServer()
+    if args.in_process:
+        from memtransport import open_in_process
+        client = ShadowClient(connector=lambda: open_in_process(server.handle_client))
+    else:
+        client = ShadowClient(server_port=Config.SERVER_PORT)
+    tasks = [asyncio.ensure_future(server.start()), asyncio.ensure_future(client.start())]
+    await asyncio.sleep(0.2)
+
+    results = {}
+    try:
+        phases = (lambda: bench_handshakes(client, args.handshakes), lambda: bench_setup(args, target_port),
+                  lambda: bench_bulk(args, target_port))
+        for phase in phases:
+            results.update(await asyncio.wait_for(phase(), args.timeout))
+    finally:
+        for session in client.mux_sessions:
+            session.close()
+        if client.pool:
+            client.pool.close()
+        await asyncio.sleep(0.1) # Let the server notice and finish its handlers
+        for task in tasks:
+            task.cancel()
+        target.close()
+    return {'environment': environment(), 'parameters': vars(args), 'results': results}
+
+
+def compare(baseline, current, out=None):
+    print(f"{'metric':<34} {'baseline':>12} {'current':>12} {'change':>8}", file=out)
+    for key, value in current['results'].items():
+        old = baseline.get('results', {}).get(key)
+        if not old or key.endswith('_count'):
+            continue
+        change = (value - old) / old * 100
+        better = change > 0 if key in HIGHER_IS_BETTER else change < 0
+        print(f"{key:<34} {old:>12.2f} {value:>12.2f} {change:>+7.1f}% {'better' if better else 'worse'}", file=out)
+
+
+def compare_loops(argv):
+    """Runs the same workload once per installed backend, each in a fresh process, and compares them to asyncio."""
+    reports = {}
+    for backend in available_backends():
+        print(f"Running on {backend}...", file=sys.stderr)
+        done = subprocess.run([sys.executable, os.path.abspath(__file__), *argv, '--loop', backend],
+                              stdout=subprocess.PIPE, text=True, check=True)
+        reports[backend] = json.loads(done.stdout)
+    if len(reports) < 2:
+        print("Only the asyncio loop is installed (pip install uvloop to compare)", file=sys.stderr)
+    for backend, report in reports.items():
+        if backend != 'asyncio':
+            print(f"asyncio (baseline) vs {backend}:", file=sys.stderr)
+            compare(reports['asyncio'], report, out=sys.stderr)
+    return {'environment': reports['asyncio']['environment'],
+            'backends': {backend: report['results'] for backend, report in reports.items()}}
+
+
+def _strip_options(argv, *names):
+    """argv without the given options and their values."""
+    out, skip = [], False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg in names:
+            skip = arg != '--compare-loops'
+        elif arg.split('=', 1)[0] not in names:
+            out.append(arg)
+    return out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="ShadowLink in-process load benchmark")
+    parser.add_argument('--clients', type=int, default=32, help="Concurrent SOCKS5 clients")
+    parser.add_argument('--connections', type=int, default=500, help="Connections for the setup-rate phase")
+    parser.add_argument('--handshakes', type=int, default=200, help="Tunnel handshakes to time (half resumed)")
+    parser.add_argument('--megabytes', type=int, default=256, help="Bulk bytes per direction")
+    parser.add_argument('--payload', choices=('random', 'text'), default='random',
+                        help="Bulk data: random (incompressible) or text-like")
+    parser.add_argument('--in-process', action='store_true',
+                        help="Client reaches the server in memory (as in the GUI) instead of over loopback TCP")
+    parser.add_argument('--server-port', type=int, default=18443)
+    parser.add_argument('--client-port', type=int, default=11080)
+    parser.add_argument('--timeout', type=float, default=300, help="Seconds before a stalled phase fails")
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                        help="Override a Config setting, e.g. --set MULTIPLEX=False")
+    parser.add_argument('--output', help="Write the JSON report here (default: stdout)")
+    parser.add_argument('--compare', help="Baseline JSON report to compare against")
+    parser.add_argument('--loop', choices=BACKENDS, default=Config.EVENT_LOOP, help="Event loop backend to run on")
+    parser.add_argument('--compare-loops', action='store_true',
+                        help="Run the workload on every installed backend (separate processes) and compare them")
+    args = parser.parse_args()
+
+    if args.compare_loops:
+        report = compare_loops(_strip_options(sys.argv[1:], '--compare-loops', '--loop', '--output', '--compare'))
+        args.compare = None
+    else:
+        report = run(main(args), args.loop)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
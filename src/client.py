@@ -3,33 +3,83 @@ import socket
 import logging
 import time
 from config import Config
-from encryption import TunnelEncryption, ECDHKeyExchange
+from admission import AdmissionControl, BUDGET, set_water_marks
+from lifecycle import Lifecycle
+from logpipe import CONN_LOG, ERROR_LOG, setup_logging
+from eventloop import BACKENDS, listen_options, run, tune_listener, tune_socket
+from encryption import ResumptionTicket, derive_resumption_secret, derive_resumed_key
+from coalesce import FrameCoalescer
+from cryptopool import get_key_pool
+from dataplane import relay_buffered
+from metrics import HANDSHAKE_SECONDS, ERRORS, connect_error_kind, start_metrics_server
+from mux import MuxSession, MUX_HELLO, MUX_ACCEPT
+from pool import TunnelPool
+from resolver import DNSCache, open_connection
+from routing import Router
+from scheduler import TrafficShaper, UP, DOWN
+from protocol import (Tunnel, pack_hello, pack_compact_hello, parse_hello, parse_features, pack_resume,
+                      new_resume_nonce, local_features, negotiate_version, format_target, RESUME_OK, TICKET_PREFIX,
+                      V1_FRAME_SIZE)
+from stats import TrafficStats
+from udprelay import UdpAssociation, UDP_HELLO, UDP_ACCEPT, pack_socks_address
 
-logging.basicConfig(level=Config.get_log_level(), format='%(asctime)s - [CLIENT] - %(message)s')
+setup_logging('CLIENT')
+
+def socks_reply(code) -> bytes:
+    return b'\x05' + bytes([code]) + b'\x00\x01' + socket.inet_aton('0.0.0.0') + (0).to_bytes(2, 'big')
+
+SOCKS_SUCCESS = socks_reply(0x00)
+SOCKS_NOT_ALLOWED = socks_reply(0x02) # Connection not allowed by ruleset
+SOCKS_HOST_UNREACHABLE = socks_reply(0x04)
+SOCKS_CONNECTION_REFUSED = socks_reply(0x05)
+
+DIRECT_READ_SIZE = 64 * 1024 # Bytes per read on connections that bypass the tunnel
 
 class ShadowClient:
-    def __init__(self, server_host='127.0.0.1', server_port=Config.SERVER_PORT, stats_queue=None):
+    def __init__(self, server_host='127.0.0.1', server_port=Config.SERVER_PORT, traffic=None, connector=None):
         self.server_host = server_host
         self.server_port = server_port
-        self.stats_queue = stats_queue # Thread-safe queue for GUI updates
-        self.bytes_sent = 0
-        self.bytes_received = 0
-        self.start_time = time.time()
-
-    def update_stats(self, sent=0, received=0):
-        self.bytes_sent += sent
-        self.bytes_received += received
-        if self.stats_queue:
-            # Calculate speed? Or just push raw counters?
-            # Let's push a dict
-            self.stats_queue.put({
-                'sent': self.bytes_sent,
-                'recv': self.bytes_received,
-                'speed_sent': sent, # Current chunk
-                'speed_recv': received
-            })
+        # async () -> (reader, writer) to the server; the GUI passes an in-process one
+        self.connector = connector or (lambda: asyncio.open_connection(self.server_host, self.server_port))
+        self.traffic = traffic or TrafficStats() # Read traffic.snapshot from any thread
+        self.admission = AdmissionControl('client')
+        self.traffic.admission = self.admission
+        self.lifecycle = Lifecycle('client')
+        self.traffic.lifecycle = self.lifecycle
+        self.router = Router() # Which targets bypass the tunnel or are refused
+        self.traffic.router = self.router
+        self.dns = None # DNSCache for direct connections, created on first use
+        self.shaper = TrafficShaper('client') # Rate limits and fair shares of the tunnels
+        self.traffic.shaper = self.shaper
+
+        # Multiplexed tunnels. None = not yet known whether the server speaks mux
+        self.mux_supported = None if Config.MULTIPLEX else False
+        self.mux_sessions = []
+        self.mux_lock = asyncio.Lock()
+
+        # Pre-keyed tunnels for per-connection requests, started on first use
+        self.pool = None
+
+        # Features advertised in the last server hello (None until we saw one)
+        self.server_features = None
+
+        # Session resumption
+        self.ticket = None
+        self.full_handshakes = 0
+        self.resumed_handshakes = 0
 
     async def handle_browser(self, reader, writer):
+        if not await self.admission.admit():
+            ERROR_LOG.warning("Browser connection refused: connection limit or memory budget reached")
+            writer.close()
+            return
+        set_water_marks(writer)
+        tune_socket(writer)
+        conn = self.lifecycle.open('browser', writer.get_extra_info('peername'),
+                                   deadline=Config.HANDSHAKE_TIMEOUT + Config.CONNECT_TIMEOUT)
+        conn.add_writer(writer)
+        counters = None
+        flow = None
         try:
             # --- SOCKS5 HANDSHAKE ---
             # 1. Auth negotiation
@@ -44,7 +94,7 @@ class ShadowClient:
             request_header = await reader.read(4)
             if not request_header: return
             ver, cmd, rsv, atyp = request_header
-            if cmd != 0x01: return # Connect only
+            if cmd not in (0x01, 0x03): return # CONNECT and UDP ASSOCIATE only
 
             if atyp == 0x01: # IPv4
                 addr_bytes = await reader.read(4)
@@ -53,116 +103,474 @@ class ShadowClient:
                 len_byte = await reader.read(1)
                 domain_len = len_byte[0]
                 dst_addr = (await reader.read(domain_len)).decode()
-            else: return # IPv6 bad
+            elif atyp == 0x04: # IPv6
+                addr_bytes = await reader.readexactly(16)
+                dst_addr = socket.inet_ntop(socket.AF_INET6, addr_bytes)
+            else: return
 
             port_bytes = await reader.read(2)
             dst_port = int.from_bytes(port_bytes, 'big')
 
-            logging.info(f"Connecting to {dst_addr}:{dst_port}")
+            if cmd == 0x03:
+                conn.established(idle_timeout=0) # Lasts as long as the application keeps it open
+                await self.handle_udp_associate(reader, writer)
+                return
 
-            # --- SERVER CONNECTION & ECDH HANDSHAKE ---
-            try:
-                srv_reader, srv_writer = await asyncio.open_connection(self.server_host, self.server_port)
-            except Exception as e:
-                logging.error(f"Server refused: {e}")
-                writer.close()
+            target = format_target(dst_addr, dst_port)
+            conn.label = target
+            rule = self.router.route(dst_addr)
+            if rule.action == 'block':
+                CONN_LOG.info("Blocked %s (rule: %s)", target, rule)
+                writer.write(SOCKS_NOT_ALLOWED)
                 return
+            if rule.action == 'direct':
+                CONN_LOG.info("Connecting to %s directly (rule: %s)", target, rule)
+                counters = self.traffic.open_connection(target)
+                flow = self.shaper.open(dst_addr, dst_port)
+                await self.handle_direct(reader, writer, dst_addr, dst_port, counters, conn, flow)
+                return
+            CONN_LOG.info("Connecting to %s", target)
+            counters = self.traffic.open_connection(target)
+            flow = self.shaper.open(dst_addr, dst_port)
+
+            # Optimistic mode: claim success now, so the browser's first bytes (TLS ClientHello)
+            # travel in the same flight as the target request. Failures become a reset.
+            early_data = b''
+            if Config.OPTIMISTIC_CONNECT:
+                writer.write(SOCKS_SUCCESS)
+                await writer.drain()
+                early_data = await self.read_early_data(reader)
+
+            if self.mux_supported is not False:
+                session = await self.get_mux_session()
+                if session:
+                    await self.handle_mux_stream(reader, writer, session, target, counters, conn, flow, early_data)
+                    return
+                if self.mux_supported is not False:
+                    if Config.OPTIMISTIC_CONNECT: writer.transport.abort()
+                    return # Server unreachable
 
-            # Perform Key Exchange
-            client_ecdh = ECDHKeyExchange()
-            client_pub = client_ecdh.get_public_bytes()
-
-            # 1. Read Server Pub Key
-            len_bytes = await srv_reader.read(4)
-            if not len_bytes: return
-            server_pub_len = int.from_bytes(len_bytes, 'big')
-            server_pub_bytes = await srv_reader.read(server_pub_len)
-
-            # 2. Send Our Pub Key
-            srv_writer.write(len(client_pub).to_bytes(4, 'big'))
-            srv_writer.write(client_pub)
-            await srv_writer.drain()
-
-            # 3. Derive Secret
-            shared_key = client_ecdh.derive_shared_key(server_pub_bytes)
-            cipher = TunnelEncryption(shared_key)
-            logging.info("Encrypted Tunnel Established")
-
-            # --- REQUEST TUNNEL ---
-            connect_msg = f"{dst_addr}:{dst_port}".encode()
-            encrypted_connect = cipher.encrypt(connect_msg)
-            
-            srv_writer.write(len(encrypted_connect).to_bytes(4, 'big'))
-            srv_writer.write(encrypted_connect)
-            await srv_writer.drain()
-
-            # Wait for OK
-            len_bytes = await srv_reader.read(4)
-            if not len_bytes: return
-            enc_len = int.from_bytes(len_bytes, 'big')
-            encrypted_resp = await srv_reader.read(enc_len)
-            
+            # --- SERVER CONNECTION, HANDSHAKE & TUNNEL REQUEST ---
+            if self.pool is None and Config.POOL_MIN_IDLE > 0:
+                self.pool = TunnelPool(self.open_tunnel)
+                self.pool.start()
             try:
-                decrypted_resp = cipher.decrypt(encrypted_resp)
-                if decrypted_resp != b"OK": raise Exception("Refused")
-            except:
-                writer.close()
-                srv_writer.close()
+                tunnel, reply = await self.open_request(target.encode(), pooled=True, early_data=early_data)
+                conn.add_writer(tunnel.writer)
+                if reply != b"OK":
+                    ERRORS.labels('client', 'refused').inc()
+                    raise ConnectionRefusedError("Refused")
+            except Exception as e:
+                ERROR_LOG.error("Server refused: %s", e)
+                if Config.OPTIMISTIC_CONNECT:
+                    writer.transport.abort()
                 return
+            counters.add_sent(len(early_data))
+            conn.established()
 
             # Reply to Browser (Success)
-            writer.write(b'\x05\x00\x00\x01' + socket.inet_aton('0.0.0.0') + (0).to_bytes(2, 'big'))
-            await writer.drain()
+            if not Config.OPTIMISTIC_CONNECT:
+                writer.write(SOCKS_SUCCESS)
+                await writer.drain()
 
             # --- PIPE DATA ---
+            if Config.DATA_PLANE == 'buffered' and tunnel.version >= 2 and not tunnel.compressor and not self.shaper.shaping:
+                def on_sent(n):
+                    counters.add_sent(n)
+                    conn.touch()
+                def on_received(n):
+                    counters.add_received(n)
+                    conn.touch()
+                await relay_buffered(reader, writer, tunnel, on_sent=on_sent, on_received=on_received)
+                return
+
             await asyncio.gather(
-                self.forward_encrypt(reader, srv_writer, cipher),
-                self.forward_decrypt(srv_reader, writer, cipher)
+                self.forward_encrypt(reader, tunnel, counters, conn, flow),
+                self.forward_decrypt(tunnel, writer, counters, conn, flow)
             )
 
         except Exception as e:
-            logging.error(f"Client Error: {e}")
+            ERROR_LOG.error("Client Error: %s", e)
         finally:
-            writer.close()
+            if counters:
+                counters.close()
+            if flow:
+                flow.close()
+            conn.close()
+            self.admission.release()
+
+    async def open_tunnel(self, allow_resume=True, corked=False):
+        """
+        Connects to the server and keys a Tunnel. Resumes with a session ticket when one is
+        available (no key pair, no ECDH), otherwise performs the full ECDH handshake.
+        With corked=True our hello is held back and leaves in one write with the first request.
+        """
+        started = time.monotonic()
+        try:
+            srv_reader, srv_writer = await asyncio.wait_for(self.connector(), Config.CONNECT_TIMEOUT)
+        except Exception:
+            ERRORS.labels('client', 'server_unreachable').inc()
+            raise
+        tune_socket(srv_writer)
 
-    async def forward_encrypt(self, source, dest, cipher):
+        # 1. Read Server Hello (Pub Key + advertised features)
         try:
+            len_bytes = await asyncio.wait_for(srv_reader.readexactly(4), Config.HANDSHAKE_TIMEOUT)
+            server_hello_len = int.from_bytes(len_bytes, 'big')
+            server_hello = await asyncio.wait_for(srv_reader.readexactly(server_hello_len), Config.HANDSHAKE_TIMEOUT)
+        except Exception:
+            ERRORS.labels('client', 'handshake').inc()
+            srv_writer.close()
+            raise
+        server_pub_bytes, server_fields = parse_hello(server_hello)
+        self.server_features = parse_features(server_fields)
+
+        features = local_features(is_client=True)
+        fields = {'Features': ' '.join(sorted(features))} if features else None
+        version = negotiate_version(features, self.server_features)
+
+        ticket = self.ticket
+        if allow_resume and ticket and ticket.usable() and 'Nonce' in server_fields:
+            client_nonce = new_resume_nonce()
+            resume = pack_resume(client_nonce, ticket.use(), fields)
+            hello = len(resume).to_bytes(4, 'big') + resume
+            if not corked:
+                srv_writer.write(hello)
+            shared_key = derive_resumed_key(ticket.secret, client_nonce, bytes.fromhex(server_fields['Nonce']))
+            tunnel = Tunnel(srv_reader, srv_writer, shared_key, is_client=True, version=version, resumed=True,
+                            peer_features=self.server_features)
+            if corked:
+                tunnel.cork(hello)
+            self.resumed_handshakes += 1
+            HANDSHAKE_SECONDS.labels('client', 'resumed').observe(time.monotonic() - started)
+            return tunnel
+
+        # Perform Key Exchange (with a key pair the pool generated in the background)
+        client_ecdh = get_key_pool().take()
+        if Config.COMPACT_HANDSHAKE and 'x25519' in self.server_features:
+            client_pub = pack_compact_hello(client_ecdh.get_raw_public_bytes(), fields)
+        else:
+            client_pub = pack_hello(client_ecdh.get_public_bytes(), fields)
+
+        # 2. Send Our Pub Key (now, or together with the first request)
+        hello = len(client_pub).to_bytes(4, 'big') + client_pub
+        if not corked:
+            srv_writer.write(hello)
+
+        # 3. Derive Secret
+        shared_key = client_ecdh.derive_shared_key(server_pub_bytes)
+        tunnel = Tunnel(srv_reader, srv_writer, shared_key, is_client=True, version=version,
+                        peer_features=self.server_features)
+        if corked:
+            tunnel.cork(hello)
+        if Config.SESSION_TICKETS and 'resume' in tunnel.peer_features:
+            tunnel.resumption_secret = derive_resumption_secret(shared_key)
+        self.full_handshakes += 1
+        HANDSHAKE_SECONDS.labels('client', 'full').observe(time.monotonic() - started)
+        CONN_LOG.info("Encrypted Tunnel Established")
+        return tunnel
+
+    async def handle_udp_associate(self, reader, writer):
+        """Relays the application's datagrams until it closes the SOCKS control connection."""
+        counters = self.traffic.open_connection("udp")
+        tunnel = None
+        association = None
+        try:
+            try:
+                tunnel, reply = await self.open_request(UDP_HELLO, pooled=True)
+                if not reply.startswith(UDP_ACCEPT): raise ConnectionRefusedError("Refused")
+            except Exception as e:
+                ERROR_LOG.error("UDP relay unavailable: %s", e)
+                if tunnel: tunnel.close()
+                writer.write(b'\x05\x07\x00\x01' + socket.inet_aton('0.0.0.0') + (0).to_bytes(2, 'big')) # Command not supported
+                await writer.drain()
+                return
+
+            body = reply[len(UDP_ACCEPT):]
+            association = UdpAssociation(body[:8], body[8:40], counters)
+            host, port = await association.start(writer.get_extra_info('sockname')[0], self.server_host,
+                                                 int.from_bytes(body[40:42], 'big'),
+                                                 writer.get_extra_info('peername')[0])
+            writer.write(b'\x05\x00\x00' + pack_socks_address(host, port))
+            await writer.drain()
+            CONN_LOG.info("UDP association on %s:%s", host, port)
+
+            while await reader.read(1024): pass # The association lasts as long as this connection
+        finally:
+            if association: association.close()
+            if tunnel: tunnel.close()
+            counters.close()
+
+    async def read_early_data(self, reader) -> bytes:
+        """Waits briefly for the browser's first bytes. Server-first protocols just get b''."""
+        try:
+            return await asyncio.wait_for(reader.read(V1_FRAME_SIZE), Config.EARLY_DATA_WAIT_MS / 1000)
+        except asyncio.TimeoutError:
+            return b''
+
+    async def open_request(self, message: bytes, pooled=False, early_data=b''):
+        """
+        Opens a tunnel, sends its first encrypted message and returns (tunnel, reply).
+        The message leaves in one write with our hello, so this costs a single round trip.
+        A rejected ticket is dropped and the request retried with a full handshake.
+        With pooled=True an idle pre-keyed tunnel is used when available. early_data is sent
+        as a second frame right behind the message, before the reply.
+        """
+        tunnel = self.pool.acquire() if pooled and self.pool else None
+        if tunnel:
+            try:
+                return tunnel, await self.exchange(tunnel, message, early_data)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                pass # Went stale in the pool; pay for a fresh one
+
+        tunnel = await self.open_tunnel(corked=True)
+        try:
+            return tunnel, await self.exchange(tunnel, message, early_data)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            if not tunnel.resumed or tunnel.resume_confirmed:
+                raise
+            logging.warning("Session ticket rejected, falling back to full handshake")
+            ERRORS.labels('client', 'ticket_rejected').inc()
+            self.ticket = None
+
+        tunnel = await self.open_tunnel(allow_resume=False, corked=True)
+        return tunnel, await self.exchange(tunnel, message, early_data)
+
+    async def exchange(self, tunnel, message, early_data=b''):
+        """Sends the request and returns the reply. The tunnel is closed if anything fails."""
+        try:
+            await self.send_request(tunnel, message, early_data)
+            return await self.read_reply(tunnel)
+        except BaseException:
+            tunnel.close()
+            raise
+
+    async def send_request(self, tunnel, message, early_data=b''):
+        """Sends the request (and early data) in one write, together with our hello on a fresh tunnel."""
+        tunnel.cork()
+        tunnel.write_message(message)
+        if early_data:
+            tunnel.write_message(early_data)
+        tunnel.uncork()
+        await tunnel.writer.drain()
+
+    async def read_reply(self, tunnel):
+        """Reads the server's first reply, consuming any ticket / resumption control messages."""
+        while True:
+            # The server connects to the target before replying
+            message = await asyncio.wait_for(tunnel.read_message(), Config.HANDSHAKE_TIMEOUT + Config.CONNECT_TIMEOUT)
+            if message == RESUME_OK:
+                tunnel.resume_confirmed = True
+            elif message.startswith(TICKET_PREFIX) and tunnel.resumption_secret:
+                body = message[len(TICKET_PREFIX):]
+                lifetime = int.from_bytes(body[:4], 'big')
+                max_uses = int.from_bytes(body[4:8], 'big')
+                self.ticket = ResumptionTicket(body[8:], tunnel.resumption_secret, lifetime, max_uses)
+            else:
+                return message
+
+    async def get_mux_session(self):
+        """
+        Returns a multiplexed tunnel, opening a new one while fewer than Config.MUX_TUNNELS exist.
+        Returns None if the server does not speak the mux protocol (legacy fallback).
+        """
+        async with self.mux_lock:
+            if self.mux_supported is False:
+                return None
+            self.mux_sessions = [s for s in self.mux_sessions if not s.closed]
+            if len(self.mux_sessions) >= Config.MUX_TUNNELS:
+                return min(self.mux_sessions, key=lambda s: len(s.streams))
+            try:
+                tunnel, reply = await self.open_request(MUX_HELLO)
+            except Exception as e:
+                # Old servers advertise no features and drop the connection on the mux hello
+                if self.server_features is not None and 'mux' not in self.server_features:
+                    logging.warning("Server does not support multiplexing, using one connection per stream")
+                    self.mux_supported = False
+                else:
+                    logging.error(f"Server refused: {e}")
+                return None
+
+            if reply != MUX_ACCEPT:
+                tunnel.close()
+                self.mux_supported = False
+                return None
+
+            self.mux_supported = True
+            session = MuxSession(tunnel, is_client=True)
+            # Close unused tunnels well before the server's TUNNEL_IDLE_TIMEOUT would
+            conn = self.lifecycle.open('tunnel', 'mux', idle_timeout=Config.TUNNEL_IDLE_TIMEOUT / 2)
+            conn.busy = lambda: bool(session.streams)
+            conn.add_closer(session.close)
+            asyncio.ensure_future(self.run_mux_session(session, conn))
+            self.mux_sessions.append(session)
+            logging.info(f"Multiplexed tunnel #{len(self.mux_sessions)} established")
+            return session
+
+    async def run_mux_session(self, session, conn):
+        try:
+            await session.run()
+        finally:
+            conn.close()
+
+    async def handle_mux_stream(self, reader, writer, session, target, counters, conn, flow, early_data=b''):
+        try:
+            stream = await session.open_stream(target, early_data)
+        except Exception as e:
+            ERROR_LOG.error("Stream to %s refused: %s", target, e)
+            ERRORS.labels('client', 'refused').inc()
+            if Config.OPTIMISTIC_CONNECT:
+                writer.transport.abort() # We already told the browser it worked
+            return
+        conn.add_closer(stream.abort)
+        stream.flow = flow
+        counters.add_sent(len(early_data))
+        conn.established()
+
+        # Reply to Browser (Success)
+        if not Config.OPTIMISTIC_CONNECT:
+            writer.write(SOCKS_SUCCESS)
+            await writer.drain()
+
+        await asyncio.gather(
+            self.forward_to_stream(reader, stream, counters, conn, flow),
+            self.forward_from_stream(stream, writer, counters, conn, flow)
+        )
+
+    async def handle_direct(self, reader, writer, host, port, counters, conn, flow):
+        """Connects to the target ourselves: no tunnel, no encryption, no server hop."""
+        if self.dns is None:
+            self.dns = DNSCache()
+        try:
+            target_reader, target_writer = await open_connection(self.dns, host, port)
+        except Exception as e:
+            ERROR_LOG.error("Direct connection to %s failed: %s", conn.label, e)
+            ERRORS.labels('client', connect_error_kind(e)).inc()
+            writer.write(SOCKS_CONNECTION_REFUSED if isinstance(e, ConnectionRefusedError) else SOCKS_HOST_UNREACHABLE)
+            return
+        conn.add_writer(target_writer)
+        set_water_marks(target_writer)
+        tune_socket(target_writer)
+        conn.established()
+
+        writer.write(SOCKS_SUCCESS)
+        await writer.drain()
+        await asyncio.gather(
+            self.forward_direct(reader, target_writer, counters.add_sent, conn, flow, UP),
+            self.forward_direct(target_reader, writer, counters.add_received, conn, flow, DOWN)
+        )
+
+    # Forwarders: a clean EOF is passed on as a half-close and the other direction keeps
+    # running; any error tears down the whole connection (both sockets and the stream).
+
+    async def forward_direct(self, source, dest, count, conn, flow, direction):
+        try:
+            while True:
+                data = await source.read(DIRECT_READ_SIZE)
+                if not data: break
+                conn.touch()
+                await flow.pace(len(data), direction)
+                dest.write(data)
+                await BUDGET.hold(len(data), dest.drain())
+                count(len(data))
+            conn.half_close(dest)
+        except Exception:
+            conn.close()
+
+    async def forward_to_stream(self, source, stream, counters, conn, flow):
+        try:
+            coalescer = FrameCoalescer(source, stream.session.max_payload)
+            while True:
+                data = await coalescer.read()
+                if not data: break
+                conn.touch()
+                await flow.pace(len(data), UP)
+                await BUDGET.hold(len(data), stream.write(data))
+                counters.add_sent(len(data))
+            await stream.close()
+        except Exception:
+            conn.close()
+
+    async def forward_from_stream(self, stream, dest, counters, conn, flow):
+        try:
+            while True:
+                data = await stream.read()
+                if not data: break
+                conn.touch()
+                await flow.pace(len(data), DOWN)
+                dest.write(data)
+                await BUDGET.hold(len(data), dest.drain())
+                counters.add_received(len(data))
+            conn.half_close(dest)
+        except Exception:
+            conn.close()
+
+    async def forward_encrypt(self, source, tunnel, counters, conn, flow):
+        try:
+            coalescer = FrameCoalescer(source, tunnel.max_payload)
             while True:
-                data = await source.read(4096)
+                data = await coalescer.read()
                 if not data: break
-                
-                encrypted = cipher.encrypt(data)
-                dest.write(len(encrypted).to_bytes(4, 'big'))
-                dest.write(encrypted)
-                await dest.drain()
-                self.update_stats(sent=len(data))
-        except: pass
+                conn.touch()
+                await flow.pace(len(data), UP)
+                await BUDGET.hold(len(data), tunnel.send_message(data))
+                counters.add_sent(len(data))
+            conn.half_close(tunnel.writer) # Browser is done sending
+        except Exception:
+            conn.close()
 
-    async def forward_decrypt(self, source, dest, cipher):
+    async def forward_decrypt(self, tunnel, dest, counters, conn, flow):
         try:
             while True:
-                len_bytes = await source.read(4)
-                if not len_bytes: break
-                length = int.from_bytes(len_bytes, 'big')
-                encrypted = await source.read(length)
-                if not encrypted: break
-                
-                decrypted = cipher.decrypt(encrypted)
+                decrypted = await tunnel.read_message()
+                conn.touch()
+                await flow.pace(len(decrypted), DOWN)
                 dest.write(decrypted)
-                await dest.drain()
-                self.update_stats(received=len(decrypted))
-        except: pass
+                await BUDGET.hold(len(decrypted), dest.drain())
+                counters.add_received(len(decrypted))
+        except asyncio.IncompleteReadError as e:
+            # A tunnel closed between frames is the server's half-close: the target is done sending
+            if e.partial: conn.close()
+            else: conn.half_close(dest)
+        except Exception:
+            conn.close()
 
     async def start(self):
         server = await asyncio.start_server(
-            self.handle_browser, '127.0.0.1', Config.CLIENT_PORT)
+            self.handle_browser, '127.0.0.1', Config.CLIENT_PORT, **listen_options())
+        tune_listener(server)
         logging.info(f"SOCKS5 Proxy on localhost:{Config.CLIENT_PORT}")
-        async with server:
-            await server.serve_forever()
+        asyncio.ensure_future(self.traffic.run_publisher())
+        self.lifecycle.start()
+        self.router.start()
+        get_key_pool().start()
+        if Config.POOL_IDLE_TIMEOUT >= Config.TUNNEL_IDLE_TIMEOUT:
+            logging.warning("POOL_IDLE_TIMEOUT should be below TUNNEL_IDLE_TIMEOUT, or the server may drop pooled tunnels first")
+        await start_metrics_server()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.close()
+
+    def close(self):
+        """Closes pooled tunnels, mux sessions and live connections once serving stops."""
+        if self.pool:
+            self.pool.close()
+        for session in self.mux_sessions:
+            session.close()
+        self.router.stop()
+        self.lifecycle.close_all()
 
 if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="ShadowLink Client")
+    parser.add_argument('--loop', choices=BACKENDS, default=Config.EVENT_LOOP,
+                        help="Event loop backend (auto = uvloop when installed)")
+    args = parser.parse_args()
+
     client = ShadowClient()
     try:
-        asyncio.run(client.start())
+        run(client.start(), args.loop)
     except KeyboardInterrupt:
         pass
@@ -0,0 +1,76 @@
+import asyncio
+import time
+from config import Config
+
+class CoalescingStats:
+    """Process-wide counters for the frames our forwarders produce."""
+    def __init__(self):
+        self.reads = 0
+        self.frames = 0
+        self.bytes = 0
+
+    def average_frame_size(self) -> float:
+        return self.bytes / self.frames if self.frames else 0.0
+
+    def coalescing_ratio(self) -> float:
+        """Source reads per frame sent. 1.0 means no coalescing happened."""
+        return self.reads / self.frames if self.frames else 0.0
+
+STATS = CoalescingStats()
+
+class FrameCoalescer:
+    """
+    Reads a source stream in frame-sized batches.
+
+    The first chunk after an idle period is returned immediately, so interactive traffic
+    never waits. When chunks arrive back to back (a chatty upstream), we keep reading for
+    up to budget_us microseconds or until max_size bytes, whichever comes first, and
+    return everything as one frame.
+    """
+    def __init__(self, source, max_size, budget_us=None, stats=STATS):
+        self.source = source
+        self.max_size = max_size
+        self.budget = (Config.COALESCE_BUDGET_US if budget_us is None else budget_us) / 1_000_000
+        self.stats = stats
+        self.last_read_at = 0.0
+        self.eof = False
+
+    async def read(self) -> bytes:
+        if self.eof:
+            return b''
+        data = await self.source.read(self.max_size)
+        if not data:
+            return data
+
+        now = time.monotonic()
+        chatty = self.budget > 0 and now - self.last_read_at < self.budget
+        self.last_read_at = now
+        reads = 1
+
+        if chatty and len(data) < self.max_size:
+            parts = [data]
+            size = len(data)
+            deadline = now + self.budget
+            while size < self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    # StreamReader.read is cancel-safe: on timeout the data stays buffered
+                    more = await asyncio.wait_for(self.source.read(self.max_size - size), remaining)
+                except asyncio.TimeoutError:
+                    break
+                if not more:
+                    self.eof = True
+                    break
+                parts.append(more)
+                size += len(more)
+                reads += 1
+            self.last_read_at = time.monotonic()
+            data = b''.join(parts) if len(parts) > 1 else data
+
+        if self.stats:
+            self.stats.reads += reads
+            self.stats.frames += 1
+            self.stats.bytes += len(data)
+        return data
@@ -0,0 +1,99 @@
+import time
+import zlib
+from config import Config
+from metrics import COMPRESSION_BYTES, COMPRESSION_FRAMES, COMPRESSION_SECONDS
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Per-frame compression for v2 tunnels.
+# Each side advertises the codecs it can decode as hello features; the sender picks its
+# favourite among the peer's and marks compressed frames in the v2 flags byte, so the
+# receiver never needs to know which codec was chosen in advance.
+# Compression before encryption leaks plaintext length, so it is off unless configured.
+
+FLAG_ZLIB = 0x01
+FLAG_ZSTD = 0x02
+COMPRESSED_FLAGS = FLAG_ZLIB | FLAG_ZSTD
+
+MAX_DECOMPRESSED = 16 * 1024 * 1024 # Largest frame a v2 header can describe
+
+_INPUT = COMPRESSION_BYTES.labels('input')
+_OUTPUT = COMPRESSION_BYTES.labels('output')
+_COMPRESS_TIME = COMPRESSION_SECONDS.labels('compress')
+_DECOMPRESS_TIME = COMPRESSION_SECONDS.labels('decompress')
+
+
+def available_codecs() -> list:
+    """Configured codecs this install can use, in order of preference."""
+    return [codec for codec in Config.COMPRESSION
+            if codec == 'zlib' or (codec == 'zstd' and zstandard is not None)]
+
+
+class FrameCompressor:
+    """
+    Compresses outgoing frames with one codec. A sample of each frame is compressed first;
+    high-entropy data (TLS records, media, archives) fails the sample and is sent as is.
+    """
+    def __init__(self, codec):
+        self.codec = codec
+        self.flag = FLAG_ZSTD if codec == 'zstd' else FLAG_ZLIB
+        if codec == 'zstd':
+            self._compress = zstandard.ZstdCompressor(level=Config.COMPRESS_LEVEL_ZSTD).compress
+        else:
+            self._compress = lambda data: zlib.compress(data, Config.COMPRESS_LEVEL_ZLIB)
+
+    @staticmethod
+    def negotiate(peer_features):
+        """Returns a compressor for the first codec we prefer that the peer can decode, or None."""
+        for codec in available_codecs():
+            if codec in peer_features:
+                return FrameCompressor(codec)
+        return None
+
+    def compress(self, message: bytes):
+        """Returns (payload, flags): compressed with our flag, or the message unchanged with 0."""
+        if len(message) < Config.COMPRESS_MIN_SIZE:
+            return message, 0
+        start = time.perf_counter()
+        try:
+            sample = message[:Config.COMPRESS_SAMPLE_SIZE]
+            if len(zlib.compress(sample, 1)) > len(sample) * Config.COMPRESS_MAX_RATIO:
+                COMPRESSION_FRAMES.labels('skipped').inc()
+                return message, 0
+            packed = self._compress(message)
+        finally:
+            _COMPRESS_TIME.value += time.perf_counter() - start
+
+        _INPUT.value += len(message)
+        if len(packed) > len(message) * Config.COMPRESS_MAX_RATIO:
+            COMPRESSION_FRAMES.labels('incompressible').inc()
+            _OUTPUT.value += len(message)
+            return message, 0
+        COMPRESSION_FRAMES.labels('compressed').inc()
+        _OUTPUT.value += len(packed)
+        return packed, self.flag
+
+
+def decompress(data: bytes, flags) -> bytes:
+    """Undoes FrameCompressor.compress for whichever codec flags names."""
+    start = time.perf_counter()
+    try:
+        if flags & FLAG_ZSTD:
+            if zstandard is None:
+                raise ValueError("Peer sent zstd frames but zstandard is not installed")
+            return zstandard.ZstdDecompressor().decompress(data, max_output_size=MAX_DECOMPRESSED)
+        inflater = zlib.decompressobj()
+        plain = inflater.decompress(data, MAX_DECOMPRESSED)
+        if inflater.unconsumed_tail:
+            raise ValueError("Compressed frame exceeds the frame size limit")
+        return plain
+    finally:
+        _DECOMPRESS_TIME.value += time.perf_counter() - start
+
+
+def codec_features() -> set:
+    """Hello features: the codecs we can decode (only advertised when compression is on)."""
+    return set(available_codecs())
@@ -8,14 +8,126 @@ class Config:
     
     # Handshake Protocol Constants
     HANDSHAKE_SIZE = 4096 # Allow enough buffer for PEM keys
+
+    # Server worker processes (Linux, SO_REUSEPORT). The GUI always runs a single process
+    SERVER_WORKERS = 1
+    WORKER_STATS_INTERVAL = 2 # Seconds between worker stats reports to the supervisor
+    WORKER_RESTART_BACKOFF = 1 # Minimum seconds between restarts of the same worker slot
+
+    # Multiplexing (many SOCKS streams over few long-lived tunnels)
+    MULTIPLEX = True
+    MUX_TUNNELS = 2 # Tunnels the client keeps open to the server
+    MUX_WINDOW = 256 * 1024 # Per-stream flow control window (bytes)
+
+    # Optimistic CONNECT: answer the browser at once and send its first bytes with the target
+    OPTIMISTIC_CONNECT = False
+    EARLY_DATA_WAIT_MS = 20 # How long to wait for the browser's first bytes (e.g. TLS ClientHello)
+
+    # Pre-keyed tunnel pool for per-connection mode (used when not multiplexing)
+    POOL_MIN_IDLE = 2 # Idle tunnels kept ready (0 = no pool)
+    POOL_MAX_IDLE = 16
+    POOL_IDLE_TIMEOUT = 30 # Seconds an idle tunnel may wait for a request
+    POOL_RATE_WINDOW = 10 # Seconds of acquire history used to size the pool
+    POOL_LEAD_TIME = 1 # Keep this many seconds of recent demand ready
+
+    # Wire format v2 (counter nonces, large frames). v1 stays available for old peers
+    WIRE_V2 = True
+    FRAME_SIZE = 64 * 1024 # Max plaintext per v2 frame (header allows up to 16 MiB)
+    CRYPTO_WORKERS = 0 # AES-GCM worker threads (0 = encrypt inline on the event loop)
+    CRYPTO_OFFLOAD_THRESHOLD = 32 * 1024 # Frames at least this large go to the workers
+    KEY_POOL_SIZE = 32 # Ephemeral X25519 key pairs a background thread keeps ready (0 = generate inline)
+    COMPACT_HANDSHAKE = True # Raw 32-byte client keys (server advertises 'x25519'); PEM stays for old peers
+    COALESCE_BUDGET_US = 500 # Max wait to batch a chatty upstream into one frame (0 = off)
+    DATA_PLANE = 'streams' # 'buffered' = zero-copy BufferedProtocol engine for v2 per-connection tunnels
+
+    # Per-frame compression on v2 tunnels, used only when both sides enable it.
+    # Off by default: compressing before encrypting leaks plaintext length (CRIME-style attacks)
+    COMPRESSION = [] # Codecs in order of preference, e.g. ['zstd', 'zlib'] (zstd needs the zstandard package)
+    COMPRESS_MIN_SIZE = 512 # Smaller frames are sent as is
+    COMPRESS_SAMPLE_SIZE = 1024 # Bytes test-compressed to detect high-entropy data
+    COMPRESS_MAX_RATIO = 0.9 # Send uncompressed unless the result is at most this fraction of the input
+    COMPRESS_LEVEL_ZLIB = 1
+    COMPRESS_LEVEL_ZSTD = 3
+
+    # Memory ceiling and admission control (per process)
+    STREAM_HIGH_WATER = 64 * 1024 # Per-socket write buffer: writers wait once it holds more than this...
+    STREAM_LOW_WATER = 16 * 1024 # ...until it drains below this
+    MEMORY_BUDGET = 64 * 1024 * 1024 # Bytes all connections together may hold in flight (0 = unlimited)
+    MAX_CONNECTIONS = 1024 # Concurrent connections (a mux tunnel and each of its streams count once; 0 = unlimited)
+    ADMISSION_QUEUE = 256 # Connections that may wait for a slot; beyond this they are refused at once
+    ADMISSION_TIMEOUT = 5 # Seconds a queued connection waits before it is refused
+
+    # Event loop and sockets
+    EVENT_LOOP = 'auto' # 'asyncio', 'uvloop' (pip install uvloop; not on Windows) or 'auto' = uvloop when installed
+    LISTEN_BACKLOG = 1024 # Pending connections a listener queues during accept bursts (the OS caps it, e.g. somaxconn)
+    TCP_NODELAY = True # Send small frames (hellos, SOCKS replies, mux control) at once instead of waiting on Nagle
+    TCP_SOCKET_BUFFER = 0 # SO_RCVBUF/SO_SNDBUF for TCP sockets (0 = keep the kernel's autotuning)
+
+    # Traffic shaping and fair scheduling (rates are bytes/s per direction; 0 = unlimited)
+    SHAPE_GLOBAL_RATE = 0 # All connections of the process together
+    SHAPE_DEST_RATE = 0 # Each destination host
+    SHAPE_STREAM_RATE = 0 # Each connection
+    SHAPE_BURST = 0.25 # Seconds of its rate a bucket may bank for bursts
+    SCHED_CLASSES = {'interactive': 8, 'default': 4, 'bulk': 1} # Priority class -> fair queuing weight on shared tunnels
+    SCHED_PORT_CLASSES = {22: 'interactive', 53: 'interactive', 3389: 'interactive', 5900: 'interactive'} # Others: 'default'
+    SCHED_BULK_AFTER = 4 * 1024 * 1024 # Flows that moved this many bytes drop to 'bulk' (0 = never)
+    SCHED_QUANTUM = 16 * 1024 # Bytes per unit of weight a stream may send per fair queuing round
+    SCHED_YIELD_BYTES = 256 * 1024 # A forwarder yields to the event loop after moving this much without waiting
+
+    # Connection lifecycle
+    HANDSHAKE_TIMEOUT = 10 # Seconds for a tunnel handshake (the client's SOCKS setup also gets CONNECT_TIMEOUT)
+    IDLE_TIMEOUT = 300 # Seconds without traffic before a proxied connection is torn down (0 = never)
+    TUNNEL_IDLE_TIMEOUT = 90 # Server: tunnels without a request or mux streams are closed after this.
+                             # The client keeps POOL_IDLE_TIMEOUT and its idle mux tunnels below it
+    LEAK_GRACE = 10 # Seconds a torn-down socket may take to close before it counts as leaked
+
+    # Session resumption (skip ECDH on repeat connections)
+    SESSION_TICKETS = True
+    TICKET_LIFETIME = 300 # Seconds a ticket stays valid
+    TICKET_MAX_USES = 32 # Resumptions allowed per ticket
+
+    # Traffic stats
+    STATS_INTERVAL = 0.5 # Seconds between published snapshots
+    STATS_WINDOW = 3 # Sliding window (seconds) for the KB/s rates
+    METRICS_PORT = 9464 # Prometheus endpoint on 127.0.0.1 (0 = off). Not started by SO_REUSEPORT workers
+
+    # Logging (records are formatted and written by a background thread)
+    LOG_QUEUE_SIZE = 10000 # Records waiting for the writer; beyond that new ones are dropped
+    # Per-category limits: (records per second, burst, keep 1 in N beyond that). Unlisted categories are unlimited
+    LOG_LIMITS = {'conn': (50, 200, 100), 'errors': (20, 100, 20)}
+    LOG_GUI_BATCH = 200 # Lines moved into the GUI log box per refresh
+    LOG_GUI_LINES = 2000 # Lines the GUI log box keeps
     
+    # SOCKS5 UDP ASSOCIATE relay (server listens on UDP SERVER_PORT)
+    UDP_RELAY = True
+    UDP_IDLE_TIMEOUT = 60 # Seconds before an idle upstream UDP socket is closed
+    UDP_MAX_SOCKETS = 1024 # Upstream UDP sockets the server may hold open
+    UDP_SOCKET_BUFFER = 1024 * 1024 # SO_RCVBUF/SO_SNDBUF for relay sockets (the OS may cap it)
+
+    # Server upstream connections
+    DNS_TTL = 60 # Seconds a resolved name is cached (getaddrinfo reports no TTL)
+    DNS_NEGATIVE_TTL = 10 # Seconds a failed lookup is cached
+    DNS_CACHE_SIZE = 1024 # Max cached names (LRU)
+    CONNECT_TIMEOUT = 10 # Seconds for resolve + connect to a target
+    HAPPY_EYEBALLS_DELAY = 0.25 # Head start of each address before the next one is tried (RFC 8305)
+
     # Paths
     BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
     CONFIG_DIR = os.path.join(BASE_DIR, 'config')
+
+    # Client routing rules (format in routing.py); the file is re-read when it changes
+    ROUTE_RULES_FILE = os.path.join(CONFIG_DIR, 'routes.txt')
+    ROUTE_DEFAULT = 'tunnel' # Action for targets no rule matches: 'tunnel', 'direct' or 'block'
+    ROUTE_RELOAD_INTERVAL = 2 # Seconds between checks of the rule file (0 = load once)
     
     # Settings (defaults)
     STRICT_MODE = False
     ISP_IP_MARKER = None # Store user's ISP IP here to check against
+
+    # Strict Mode public IP monitor
+    IP_SOURCES = ['https://api.ipify.org', 'https://icanhazip.com', 'https://ifconfig.me/ip']
+    IP_CHECK_INTERVAL = 10 # Seconds between background lookups
+    IP_VERDICT_TTL = 30 # Fail closed if the last successful verdict is older than this
     
     @staticmethod
     def get_log_level():
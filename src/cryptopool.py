@@ -0,0 +1,103 @@
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from config import Config
+from encryption import ECDHKeyExchange
+from metrics import KEY_POOL_TAKES
+
+class CryptoExecutor:
+    """
+    Optional worker pool for AES-GCM. OpenSSL releases the GIL while it encrypts, so large
+    frames sealed here run in parallel with the event loop and with each other.
+    Frames below the threshold stay inline, where a thread hop would cost more than it saves.
+    """
+    def __init__(self, workers=0, threshold=32 * 1024):
+        self.workers = workers
+        self.threshold = threshold
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='shadowlink-crypto') if workers > 0 else None
+        self.offloaded = 0
+        self.inline = 0
+
+    def should_offload(self, size) -> bool:
+        if self.pool is not None and size >= self.threshold:
+            self.offloaded += 1
+            return True
+        self.inline += 1
+        return False
+
+    async def run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.pool, fn, *args)
+
+    def shutdown(self):
+        if self.pool:
+            self.pool.shutdown(wait=False)
+
+_executor = None
+
+def get_crypto_executor() -> CryptoExecutor:
+    """Process-wide executor, created from Config on first use."""
+    global _executor
+    if _executor is None:
+        _executor = CryptoExecutor(Config.CRYPTO_WORKERS, Config.CRYPTO_OFFLOAD_THRESHOLD)
+    return _executor
+
+
+class KeyPool:
+    """
+    Ephemeral X25519 key pairs generated ahead of time by a background thread, so handshakes
+    don't pay for key generation on the event loop. take() never waits: when the pool is
+    empty it generates a key pair inline. Every key pair is used for one handshake only.
+    """
+    def __init__(self, size=0):
+        self.size = size
+        self.keys = deque()
+        self.hits = KEY_POOL_TAKES.labels('hit')
+        self.misses = KEY_POOL_TAKES.labels('miss')
+        self._wanted = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def start(self):
+        """Starts the refill thread (once per process: a forked child must not reuse the parent's keys)."""
+        if not self.size:
+            return
+        if self._pid != os.getpid():
+            self.keys.clear()
+            self._pid = os.getpid()
+            self._wanted = threading.Event()
+            self._thread = threading.Thread(target=self._refill, name='shadowlink-keys', daemon=True)
+            self._thread.start()
+        self._wanted.set()
+
+    def take(self) -> ECDHKeyExchange:
+        if self._pid != os.getpid():
+            self.start()
+        try:
+            key = self.keys.popleft()
+            self.hits.inc()
+        except IndexError:
+            key = ECDHKeyExchange()
+            self.misses.inc()
+        if len(self.keys) < self.size // 2:
+            self._wanted.set()
+        return key
+
+    def _refill(self):
+        while True:
+            self._wanted.wait()
+            self._wanted.clear()
+            while len(self.keys) < self.size:
+                self.keys.append(ECDHKeyExchange())
+                time.sleep(0) # Hand the GIL back to the event loop between key pairs
+
+_key_pool = None
+
+def get_key_pool() -> KeyPool:
+    """Process-wide key pool, created from Config on first use."""
+    global _key_pool
+    if _key_pool is None:
+        _key_pool = KeyPool(Config.KEY_POOL_SIZE)
+    return _key_pool
@@ -0,0 +1,242 @@
+import asyncio
+import logging
+from config import Config
+from compression import COMPRESSED_FLAGS, decompress
+from protocol import TAG_SIZE
+
+# Zero-copy data plane for v2 tunnels.
+# After the handshake both sockets are handed from their StreamReader/StreamWriter to
+# BufferedProtocols that receive straight into pooled buffers. Frames are sealed and
+# opened in place with memoryviews and written with a single transport.write() each.
+# The sealing side never compresses (tunnels with a compressor use the stream forwarders),
+# but compressed frames from the peer are still accepted.
+
+HEADER_SIZE = 4
+
+
+class BufferPool:
+    """Free list of equally sized bytearrays, so steady-state forwarding allocates nothing."""
+    def __init__(self, size, max_free=64):
+        self.size = size
+        self.max_free = max_free
+        self._free = []
+        self.allocated = 0
+        self.reused = 0
+
+    def acquire(self) -> bytearray:
+        if self._free:
+            self.reused += 1
+            return self._free.pop()
+        self.allocated += 1
+        return bytearray(self.size)
+
+    def release(self, buf: bytearray):
+        if len(buf) == self.size and len(self._free) < self.max_free:
+            self._free.append(buf)
+
+
+FRAME_POOL = BufferPool(HEADER_SIZE + Config.FRAME_SIZE + TAG_SIZE)
+
+
+def _detach(reader, writer):
+    """Takes the transport away from a stream pair. Returns (transport, already buffered bytes, at eof)."""
+    # StreamReader has no public API for "everything buffered so far"; this is a one-time copy at switch-over.
+    leftover = bytes(reader._buffer)
+    reader._buffer.clear()
+    return writer.transport, leftover, reader.at_eof()
+
+
+class _Side(asyncio.BufferedProtocol):
+    """Common flow control: when our transport's write buffer fills, stop reading the other side."""
+    def __init__(self, relay):
+        self.relay = relay
+        self.transport = None
+        self.peer = None # The _Side we write into
+
+    def attach(self, transport):
+        self.transport = transport
+        transport.set_protocol(self)
+        if not transport.is_reading():
+            transport.resume_reading() # StreamReaderProtocol may have paused it
+
+    def sync_flow_control(self):
+        """Applies backpressure for data the stream writer had already queued."""
+        if self.transport.get_write_buffer_size() > self.transport.get_write_buffer_limits()[1]:
+            self.pause_writing()
+
+    def pause_writing(self):
+        self.peer.transport.pause_reading()
+
+    def resume_writing(self):
+        if not self.peer.transport.is_closing():
+            self.peer.transport.resume_reading()
+
+    def write(self, view, buf):
+        """
+        Writes view (which points into buf). Returns buf if it may be reused, or None if the
+        transport kept a reference to it (partial send) and it must not be touched again.
+        """
+        self.transport.write(view)
+        if self.transport.get_write_buffer_size():
+            return None
+        return buf
+
+    def eof_received(self):
+        self.relay.on_eof(self)
+        return True # Keep the write direction open for half-close
+
+    def connection_lost(self, exc):
+        self.relay.close()
+
+
+class _SealSide(_Side):
+    """Plaintext socket (browser or target). Reads into the payload area of a frame buffer."""
+    def __init__(self, relay, tunnel, on_data=None):
+        super().__init__(relay)
+        self.tunnel = tunnel
+        self.on_data = on_data
+        self.max_payload = min(tunnel.max_payload, Config.FRAME_SIZE)
+        self.buf = None
+
+    def get_buffer(self, sizehint):
+        if self.buf is None:
+            self.buf = FRAME_POOL.acquire()
+        return memoryview(self.buf)[HEADER_SIZE:HEADER_SIZE + self.max_payload]
+
+    def buffer_updated(self, nbytes):
+        self.seal(nbytes)
+
+    def seal(self, nbytes):
+        buf = self.buf
+        view = memoryview(buf)
+        frame_len = nbytes + TAG_SIZE
+        view[:HEADER_SIZE] = frame_len.to_bytes(HEADER_SIZE, 'big') # flags = 0
+        body = view[HEADER_SIZE:HEADER_SIZE + frame_len]
+        self.tunnel.cipher.encrypt_into(body[:nbytes], view[:HEADER_SIZE], body)
+        self.buf = self.peer.write(view[:HEADER_SIZE + frame_len], buf)
+        self.tunnel.frame_sizes.observe(nbytes)
+        if self.on_data:
+            self.on_data(nbytes)
+
+    def feed(self, data):
+        """Seals bytes that arrived before the switch-over."""
+        for i in range(0, len(data), self.max_payload):
+            chunk = data[i:i + self.max_payload]
+            self.get_buffer(len(chunk))[:len(chunk)] = chunk
+            self.seal(len(chunk))
+
+
+class _OpenSide(_Side):
+    """Tunnel socket. Accumulates frames in one buffer and decrypts them in place."""
+    def __init__(self, relay, tunnel, on_data=None):
+        super().__init__(relay)
+        self.tunnel = tunnel
+        self.on_data = on_data
+        self.buf = FRAME_POOL.acquire()
+        self.end = 0
+
+    def get_buffer(self, sizehint):
+        if self.end == len(self.buf):
+            # A frame larger than our pooled buffers (peer uses a bigger FRAME_SIZE)
+            self.buf = self.buf + bytearray(len(self.buf))
+        return memoryview(self.buf)[self.end:]
+
+    def buffer_updated(self, nbytes):
+        self.end += nbytes
+        try:
+            self.open_frames()
+        except Exception as e:
+            logging.error(f"Tunnel frame error: {e}")
+            self.relay.close()
+
+    def open_frames(self):
+        buf = self.buf
+        view = memoryview(buf)
+        pos = 0
+        while self.end - pos >= HEADER_SIZE:
+            length = int.from_bytes(view[pos:pos + HEADER_SIZE], 'big') & 0xFFFFFF
+            start = pos + HEADER_SIZE
+            if self.end - start < length:
+                break
+            plain = view[start:start + length - TAG_SIZE]
+            self.tunnel.cipher.decrypt_into(view[start:start + length], view[pos:start], plain)
+            if view[pos] & COMPRESSED_FLAGS:
+                data = decompress(bytes(plain), view[pos])
+                self.peer.transport.write(data) # A fresh bytes object; buf stays ours
+                if self.on_data:
+                    self.on_data(len(data))
+            elif plain:
+                kept = self.peer.write(plain, buf)
+                if self.on_data:
+                    self.on_data(len(plain))
+                if kept is None:
+                    # The transport still references buf: carry the remainder into a fresh buffer
+                    fresh = FRAME_POOL.acquire()
+                    rest = self.end - start - length
+                    fresh[:rest] = view[start + length:self.end]
+                    self.buf, self.end = fresh, rest
+                    return self.open_frames()
+            pos = start + length
+
+        if pos:
+            # Move the partial frame to the front (memmove, no allocation)
+            view[:self.end - pos] = view[pos:self.end]
+            self.end -= pos
+
+    def feed(self, data):
+        """Processes frames that arrived before the switch-over."""
+        if len(data) > len(self.buf) - self.end:
+            self.buf = self.buf + bytearray(len(data))
+        self.buf[self.end:self.end + len(data)] = data
+        self.end += len(data)
+        self.open_frames()
+
+
+class BufferedRelay:
+    """Pipes one plaintext socket through one v2 tunnel socket until both directions finish."""
+    def __init__(self, plain_reader, plain_writer, tunnel, on_sent=None, on_received=None):
+        self.done = asyncio.get_running_loop().create_future()
+        self.seal_side = _SealSide(self, tunnel, on_sent)
+        self.open_side = _OpenSide(self, tunnel, on_received)
+        self.seal_side.peer = self.open_side
+        self.open_side.peer = self.seal_side
+        self._eofs = set()
+        self._sides = [(self.seal_side, plain_reader, plain_writer),
+                       (self.open_side, tunnel.reader, tunnel.writer)]
+
+    async def run(self):
+        detached = [(side,) + _detach(reader, writer) for side, reader, writer in self._sides]
+        for side, transport, _, _ in detached:
+            side.attach(transport)
+        for side, _, _, _ in detached:
+            side.sync_flow_control()
+        for side, _, leftover, at_eof in detached:
+            if leftover:
+                side.feed(leftover)
+            if at_eof:
+                self.on_eof(side)
+        await self.done
+
+    def on_eof(self, side):
+        self._eofs.add(side)
+        peer = side.peer.transport
+        if peer.can_write_eof() and not peer.is_closing():
+            peer.write_eof()
+        if len(self._eofs) == 2:
+            self.close()
+
+    def close(self):
+        for side in (self.seal_side, self.open_side):
+            if side.transport and not side.transport.is_closing():
+                side.transport.close()
+        for side in (self.seal_side, self.open_side):
+            if side.buf is not None:
+                FRAME_POOL.release(side.buf)
+                side.buf = None
+        if not self.done.done():
+            self.done.set_result(None)
+
+
+async def relay_buffered(plain_reader, plain_writer, tunnel, on_sent=None, on_received=None):
+    """Forwards both directions with the zero-copy engine. Requires a v2 tunnel."""
+    await BufferedRelay(plain_reader, plain_writer, tunnel, on_sent, on_received).run()
@@ -1,28 +1,47 @@
 import os
 import secrets
+import time
 from cryptography.hazmat.primitives import hashes, serialization
-from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric import x25519
 from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 
+# In-place AEAD is only in recent cryptography releases. Older ones fall back to encrypt()/decrypt() + copy.
+_HAS_AEAD_INTO = hasattr(AESGCM, 'encrypt_into')
+
+X25519_KEY_SIZE = 32
+
 class ECDHKeyExchange:
     """Handles Elliptic Curve Diffie-Hellman Key Exchange to derive shared AES keys."""
     def __init__(self):
-        # Generate ephemeral private key for this session using Curve25519 (X25519)
-        self.private_key = ec.generate_private_key(ec.X25519())
+        # Generate ephemeral private key for this session using Curve25519 (X25519).
+        # Both encodings are computed up front, so pooled key pairs cost nothing at handshake time
+        self.private_key = x25519.X25519PrivateKey.generate()
         self.public_key = self.private_key.public_key()
-
-    def get_public_bytes(self) -> bytes:
-        """Returns the public key in bytes to send to the peer."""
-        return self.public_key.public_bytes(
+        self.public_pem = self.public_key.public_bytes(
             encoding=serialization.Encoding.PEM,
             format=serialization.PublicFormat.SubjectPublicKeyInfo
         )
+        self.public_raw = self.public_key.public_bytes(
+            encoding=serialization.Encoding.Raw,
+            format=serialization.PublicFormat.Raw
+        )
+
+    def get_public_bytes(self) -> bytes:
+        """Returns the public key in bytes to send to the peer (PEM, understood by every peer)."""
+        return self.public_pem
+
+    def get_raw_public_bytes(self) -> bytes:
+        """Returns the bare 32-byte public key, for the compact handshake."""
+        return self.public_raw
 
     def derive_shared_key(self, peer_public_bytes: bytes) -> bytes:
-        """Derives a fast ephemeral AES-256 key from the peer's public key."""
-        peer_public_key = serialization.load_pem_public_key(peer_public_bytes)
-        shared_secret = self.private_key.exchange(ec.ECDH(), peer_public_key)
+        """Derives a fast ephemeral AES-256 key from the peer's public key (PEM or raw 32 bytes)."""
+        if len(peer_public_bytes) == X25519_KEY_SIZE:
+            peer_public_key = x25519.X25519PublicKey.from_public_bytes(peer_public_bytes)
+        else:
+            peer_public_key = serialization.load_pem_public_key(peer_public_bytes)
+        shared_secret = self.private_key.exchange(peer_public_key)
         
         # Derive a 32-byte (256-bit) AES key using HKDF
         derived_key = HKDF(
@@ -53,3 +72,156 @@ class TunnelEncryption:
         nonce = data[:12]
         ciphertext = data[12:]
         return self.aesgcm.decrypt(nonce, ciphertext, None)
+
+class CounterNonceCipher:
+    """
+    AES-256-GCM with deterministic nonces for wire format v2: [Direction 4][Counter 8].
+    Each side sends under its own direction prefix, so the shared key never repeats a nonce,
+    and no nonce travels on the wire. Frames must be decrypted in the order they were sent.
+    """
+    CLIENT_TO_SERVER = b'C2S\x00'
+    SERVER_TO_CLIENT = b'S2C\x00'
+
+    def __init__(self, key: bytes, is_client: bool):
+        if len(key) != 32:
+            raise ValueError("Key must be 32 bytes (256 bits) for AES-256")
+        self.aesgcm = AESGCM(key)
+        self.send_prefix = self.CLIENT_TO_SERVER if is_client else self.SERVER_TO_CLIENT
+        self.recv_prefix = self.SERVER_TO_CLIENT if is_client else self.CLIENT_TO_SERVER
+        self.send_counter = 0
+        self.recv_counter = 0
+
+    def next_send_nonce(self) -> bytes:
+        """Reserves the next outgoing nonce. Frames must reach the wire in reservation order."""
+        nonce = self.send_prefix + self.send_counter.to_bytes(8, 'big')
+        self.send_counter += 1
+        return nonce
+
+    def next_recv_nonce(self) -> bytes:
+        nonce = self.recv_prefix + self.recv_counter.to_bytes(8, 'big')
+        self.recv_counter += 1
+        return nonce
+
+    def encrypt(self, data: bytes, aad: bytes = None) -> bytes:
+        return self.aesgcm.encrypt(self.next_send_nonce(), data, aad)
+
+    def decrypt(self, data: bytes, aad: bytes = None) -> bytes:
+        return self.aesgcm.decrypt(self.next_recv_nonce(), data, aad)
+
+    def encrypt_into(self, data, aad, out):
+        """Seals data into out (len(data) + 16 bytes). May be called in place."""
+        nonce = self.next_send_nonce()
+        if _HAS_AEAD_INTO:
+            self.aesgcm.encrypt_into(nonce, data, aad, out)
+        else:
+            out[:] = self.aesgcm.encrypt(nonce, bytes(data), bytes(aad))
+
+    def decrypt_into(self, data, aad, out):
+        """Opens data into out (len(data) - 16 bytes). May be called in place."""
+        nonce = self.next_recv_nonce()
+        if _HAS_AEAD_INTO:
+            self.aesgcm.decrypt_into(nonce, data, aad, out)
+        else:
+            out[:] = self.aesgcm.decrypt(nonce, bytes(data), bytes(aad))
+
+class DatagramCipher:
+    """
+    AES-256-GCM for UDP relay datagrams: [Association ID 8][Nonce 12][Ciphertext + Tag].
+    Datagrams may be lost or reordered, so nonces are random and travel with each packet.
+    The association ID is authenticated as associated data.
+    """
+    def __init__(self, key: bytes, association_id: bytes):
+        if len(key) != 32:
+            raise ValueError("Key must be 32 bytes (256 bits) for AES-256")
+        self.aesgcm = AESGCM(key)
+        self.association_id = association_id
+
+    def seal(self, data: bytes) -> bytes:
+        nonce = os.urandom(12)
+        return self.association_id + nonce + self.aesgcm.encrypt(nonce, data, self.association_id)
+
+    def open(self, packet: bytes) -> bytes:
+        """Raises InvalidTag (or ValueError) for packets that are not ours."""
+        if len(packet) < 8 + 12 + 16 or packet[:8] != self.association_id:
+            raise ValueError("Not a datagram for this association")
+        return self.aesgcm.decrypt(packet[8:20], packet[20:], self.association_id)
+
+def _hkdf(secret: bytes, info: bytes, salt: bytes = None) -> bytes:
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=salt, info=info).derive(secret)
+
+def derive_resumption_secret(session_key: bytes) -> bytes:
+    """Secret bound into a resumption ticket. Never used directly as a traffic key."""
+    return _hkdf(session_key, b'shadowlink-resumption')
+
+def derive_resumed_key(resumption_secret: bytes, client_nonce: bytes, server_nonce: bytes) -> bytes:
+    """Fresh per-connection AES-256 key for a resumed session (no asymmetric operation)."""
+    return _hkdf(resumption_secret, b'shadowlink-resume', salt=client_nonce + server_nonce)
+
+class SessionTicketManager:
+    """
+    Server side of session resumption. Tickets are sealed with a process-local AES-GCM key,
+    so the server keeps no per-session state beyond a use counter per ticket.
+    Ticket plaintext: [Ticket ID 16][Issued At 8][Resumption Secret 32]
+    """
+    def __init__(self, lifetime=300, max_uses=32):
+        self.lifetime = lifetime
+        self.max_uses = max_uses
+        self.aesgcm = AESGCM(AESGCM.generate_key(bit_length=256))
+        self.uses = {} # ticket id -> (issued_at, uses)
+        self.full_handshakes = 0
+        self.resumed_handshakes = 0
+        self.rejected_tickets = 0
+
+    def issue(self, resumption_secret: bytes) -> bytes:
+        ticket_id = secrets.token_bytes(16)
+        issued_at = int(time.time())
+        self.uses[ticket_id] = (issued_at, 0)
+        nonce = os.urandom(12)
+        plain = ticket_id + issued_at.to_bytes(8, 'big') + resumption_secret
+        return nonce + self.aesgcm.encrypt(nonce, plain, b'shadowlink-ticket')
+
+    def redeem(self, ticket: bytes):
+        """Returns the resumption secret, or None if the ticket is forged, expired or used up."""
+        try:
+            plain = self.aesgcm.decrypt(ticket[:12], ticket[12:], b'shadowlink-ticket')
+        except Exception:
+            self.rejected_tickets += 1
+            return None
+
+        ticket_id = plain[:16]
+        issued_at = int.from_bytes(plain[16:24], 'big')
+        entry = self.uses.get(ticket_id)
+        if entry is None or time.time() - issued_at > self.lifetime or entry[1] >= self.max_uses:
+            self.uses.pop(ticket_id, None)
+            self.rejected_tickets += 1
+            return None
+
+        self.uses[ticket_id] = (issued_at, entry[1] + 1)
+        self.resumed_handshakes += 1
+        self._prune()
+        return plain[24:]
+
+    def _prune(self):
+        if len(self.uses) < 1024:
+            return
+        cutoff = time.time() - self.lifetime
+        self.uses = {k: v for k, v in self.uses.items() if v[0] >= cutoff}
+
+    def resumption_ratio(self) -> float:
+        total = self.full_handshakes + self.resumed_handshakes
+        return self.resumed_handshakes / total if total else 0.0
+
+class ResumptionTicket:
+    """Client side copy of a ticket, with the limits the server announced."""
+    def __init__(self, sealed: bytes, secret: bytes, lifetime: int, max_uses: int):
+        self.sealed = sealed
+        self.secret = secret
+        self.expires_at = time.time() + lifetime
+        self.uses_left = max_uses
+
+    def usable(self) -> bool:
+        return self.uses_left > 0 and time.time() < self.expires_at
+
+    def use(self) -> bytes:
+        self.uses_left -= 1
+        return self.sealed
@@ -0,0 +1,96 @@
+import asyncio
+import logging
+import socket
+from config import Config
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+# Event loop backend and socket tuning.
+# Entry points (client, server, server workers, GUI service thread, benchmarks) start their
+# loop through run(), which picks the backend from Config.EVENT_LOOP or a --loop option:
+# uvloop (libuv, faster accept/read/write paths) when it is installed, the stock asyncio
+# loop otherwise. Listeners and TCP sockets get the backlog, TCP_NODELAY and buffer sizes
+# from Config, whichever loop runs them.
+
+BACKENDS = ('auto', 'asyncio', 'uvloop')
+
+
+def available_backends() -> list:
+    """Backends this install can run, stock asyncio first."""
+    return ['asyncio'] + (['uvloop'] if uvloop is not None else [])
+
+
+def select_backend(name=None) -> str:
+    """Resolves a backend name ('auto', 'asyncio' or 'uvloop'; None = Config.EVENT_LOOP) to one that is installed."""
+    name = (name or Config.EVENT_LOOP).lower()
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown event loop {name!r} (expected one of {', '.join(BACKENDS)})")
+    if name == 'asyncio':
+        return 'asyncio'
+    if uvloop is not None:
+        return 'uvloop'
+    if name == 'uvloop':
+        logging.warning("uvloop is not installed (pip install uvloop; not available on Windows), using asyncio")
+    return 'asyncio'
+
+
+def loop_factory(name=None):
+    """Returns (backend, callable creating a new loop of that backend)."""
+    backend = select_backend(name)
+    return backend, (uvloop.new_event_loop if backend == 'uvloop' else asyncio.new_event_loop)
+
+
+def run(main, backend=None):
+    """asyncio.run() on the selected backend. Works in any thread (the GUI runs it in its service thread)."""
+    backend, factory = loop_factory(backend)
+    logging.debug(f"Event loop: {backend}")
+    if hasattr(asyncio, 'Runner'): # Python 3.11+
+        with asyncio.Runner(loop_factory=factory) as runner:
+            return runner.run(main)
+    if backend == 'uvloop':
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return asyncio.run(main)
+
+
+def current_backend() -> str:
+    """Name of the backend running the current event loop."""
+    loop = asyncio.get_running_loop()
+    return 'uvloop' if uvloop is not None and isinstance(loop, uvloop.Loop) else 'asyncio'
+
+
+def listen_options() -> dict:
+    """Keyword arguments for asyncio.start_server()."""
+    return {'backlog': Config.LISTEN_BACKLOG}
+
+
+def _set_buffers(sock):
+    if Config.TCP_SOCKET_BUFFER > 0:
+        for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, option, Config.TCP_SOCKET_BUFFER)
+            except OSError:
+                pass
+
+
+def tune_listener(server):
+    """
+    Sets buffer sizes on a listening server's sockets. Accepted connections inherit them, and
+    the receive buffer in place at SYN time is what their TCP window scale is based on.
+    """
+    for sock in server.sockets:
+        _set_buffers(sock)
+
+
+def tune_socket(writer):
+    """Applies TCP_NODELAY and buffer sizes to a connected TCP stream (in-memory links are skipped)."""
+    sock = writer.get_extra_info('socket')
+    if sock is None or sock.family not in (socket.AF_INET, socket.AF_INET6):
+        return
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if Config.TCP_NODELAY else 0)
+    except OSError:
+        pass # Already reset by the peer
+    _set_buffers(sock)
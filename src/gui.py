@@ -4,8 +4,13 @@ import asyncio
 import queue
 import time
 from config import Config
+from eventloop import run
 from client import ShadowClient
+from logpipe import LineQueueHandler, add_handler
+from memtransport import open_in_process
+from metrics import stop_metrics_server
 from server import ShadowServer
+from stats import TrafficStats
 
 # Theme Settings
 ctk.set_appearance_mode("Dark")
@@ -21,8 +26,13 @@ class ShadowLinkApp(ctk.CTk):
         
         # Data
         self.running = False
-        self.stats_queue = queue.Queue()
-        self.log_queue = queue.Queue()
+        self.traffic = TrafficStats() # Written by the client loop, read here once per tick
+        self.last_snapshot = None
+        self.log_queue = queue.Queue(Config.LOG_QUEUE_SIZE) # Lines from any thread; update_ui moves them into the log box
+        add_handler(LineQueueHandler(self.log_queue))
+        self.service_thread = None
+        self.service_loop = None
+        self.service_task = None
         
         # Layout
         self.grid_columnconfigure(0, weight=1)
@@ -76,8 +86,27 @@ class ShadowLinkApp(ctk.CTk):
         self.after(100, self.update_ui)
 
     def log(self, msg):
+        """Safe from any thread: the line shows up on the next UI tick."""
         timestamp = time.strftime("[%H:%M:%S]")
-        self.log_box.insert("end", f"{timestamp} {msg}\n")
+        try:
+            self.log_queue.put_nowait(f"{timestamp} {msg}")
+        except queue.Full:
+            pass
+
+    def flush_log(self):
+        """Moves up to LOG_GUI_BATCH queued lines into the log box with a single insert."""
+        lines = []
+        try:
+            while len(lines) < Config.LOG_GUI_BATCH:
+                lines.append(self.log_queue.get_nowait())
+        except queue.Empty:
+            pass
+        if not lines:
+            return
+        self.log_box.insert("end", "\n".join(lines) + "\n")
+        excess = int(self.log_box.index("end-1c").split('.')[0]) - 1 - Config.LOG_GUI_LINES
+        if excess > 0:
+            self.log_box.delete("1.0", f"{excess + 1}.0")
         self.log_box.see("end")
 
     def toggle_connection(self):
@@ -92,15 +121,12 @@ class ShadowLinkApp(ctk.CTk):
         self.status_indicator.configure(text="SECURE CONNECTION ACTIVE", text_color="#00ff41")
         self.log("Starting ShadowLink Services...")
         
-        # Start Threads
         strict = self.switch_strict.get() == 1
         sysproxy_on = self.switch_sysproxy.get() == 1
         
-        self.server_thread = threading.Thread(target=self.run_server, args=(strict,), daemon=True)
-        self.client_thread = threading.Thread(target=self.run_client, daemon=True)
-        
-        self.server_thread.start()
-        self.client_thread.start()
+        # One thread, one event loop: the client reaches the server in memory instead of over loopback
+        self.service_thread = threading.Thread(target=self.run_services, args=(strict,), daemon=True)
+        self.service_thread.start()
         
         # Enable System Proxy if requested
         if sysproxy_on:
@@ -111,9 +137,6 @@ class ShadowLinkApp(ctk.CTk):
                  self.log("ERROR: Could not set System Proxy")
 
     def stop_services(self):
-        # Graceful shutdown is hard with asyncio.run in threads without complex signaling
-        # For this PoC, we rely on daemon threads dying when app closes or just "abandoning" them
-        # Ideally, we'd use a stop event.
         self.running = False
         
         # Disable System Proxy always on stop
@@ -123,37 +146,49 @@ class ShadowLinkApp(ctk.CTk):
         
         self.btn_connect.configure(text="INITIALIZE LINK", fg_color="forestgreen")
         self.status_indicator.configure(text="OFFLINE", text_color="red")
-        self.log("Stopping Services (Restart App to fully reset threads)")
-        # In a real app we would cancel async tasks here.
 
-    def run_server(self, strict):
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        
-        # Hardcode ISP Safe IP for now or fetch it
-        # For simplicity, if strict is on, we assume the user configured Config.ISP_IP manually or we fetch it first?
-        # Let's verify strict mode logic.
+        # Cancelling the services task closes listeners, tunnels and connections; the loop then exits
+        loop, task = self.service_loop, self.service_task
+        if loop and task:
+            loop.call_soon_threadsafe(task.cancel)
+        self.service_thread.join(timeout=5)
+        if self.service_thread.is_alive():
+            self.log("WARNING: Services did not stop within 5s")
+        else:
+            self.log("Services stopped")
+
+    def run_services(self, strict):
+        try:
+            run(self.serve(strict))
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.service_loop = self.service_task = None
+
+    async def serve(self, strict):
+        self.service_loop = asyncio.get_running_loop()
+        self.service_task = asyncio.current_task()
+        if not self.running:
+            return # TERMINATE LINK came before the task was published
         server = ShadowServer(strict_mode=strict, safe_isp_ip=Config.ISP_IP_MARKER)
         self.log(f"Server Host initialized (Strict: {strict})")
-        loop.run_until_complete(server.start())
-
-    def run_client(self):
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        
-        client = ShadowClient(stats_queue=self.stats_queue)
-        self.log("Client Proxy initialized on :1080")
-        loop.run_until_complete(client.start())
+        # The server still listens on SERVER_PORT for remote clients
+        client = ShadowClient(traffic=self.traffic, connector=lambda: open_in_process(server.handle_client))
+        self.log(f"Client Proxy initialized on :{Config.CLIENT_PORT} (in-process link to server)")
+        try:
+            await asyncio.gather(server.start(), client.start())
+        finally:
+            stop_metrics_server()
 
     def update_ui(self):
+        self.flush_log()
+
         # Process Stats
-        while not self.stats_queue.empty():
-            stat = self.stats_queue.get()
-            # Smooth out speed display?
-            # stat['speed_sent'] is chunk size. We need to aggregate per second.
-            # Simplified: Just show total for now or "Activity"
-            self.lbl_speed_up.configure(text=f"UPLOAD: {stat['sent']//1024} KB")
-            self.lbl_speed_down.configure(text=f"DOWNLOAD: {stat['recv']//1024} KB")
+        stat = self.traffic.snapshot
+        if stat is not self.last_snapshot:
+            self.last_snapshot = stat
+            self.lbl_speed_up.configure(text=f"UPLOAD: {stat['rate_sent']/1024:.1f} KB/s ({stat['sent']//1024} KB)")
+            self.lbl_speed_down.configure(text=f"DOWNLOAD: {stat['rate_recv']/1024:.1f} KB/s ({stat['recv']//1024} KB)")
 
         self.after(100, self.update_ui)
 
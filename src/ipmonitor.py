@@ -0,0 +1,100 @@
+import asyncio
+import logging
+import time
+import urllib.request
+from config import Config
+
+class HTTPIPSource:
+    """Looks up the public IP from a plain-text echo service, off the event loop."""
+    def __init__(self, url, timeout=3):
+        self.url = url
+        self.timeout = timeout
+
+    def _fetch_blocking(self):
+        return urllib.request.urlopen(self.url, timeout=self.timeout).read().decode('utf8').strip()
+
+    async def fetch(self):
+        try:
+            return await asyncio.get_running_loop().run_in_executor(None, self._fetch_blocking)
+        except Exception:
+            return None
+
+    def __repr__(self):
+        return f"HTTPIPSource({self.url})"
+
+class StaticIPSource:
+    """Local stand-in for tests and offline setups. Set .ip to simulate a VPN drop."""
+    def __init__(self, ip=None):
+        self.ip = ip
+
+    async def fetch(self):
+        return self.ip
+
+    def __repr__(self):
+        return f"StaticIPSource({self.ip})"
+
+class PublicIPMonitor:
+    """
+    Polls the public IP in the background and keeps the Strict Mode verdict in a flag,
+    so per-connection checks never touch the network.
+    Sources are tried in order until one answers. The gate fails closed: it stays shut
+    until the first successful check, and reopens only while the verdict is younger than ttl.
+    """
+    def __init__(self, safe_isp_ip, sources=None, interval=Config.IP_CHECK_INTERVAL,
+                 ttl=Config.IP_VERDICT_TTL, on_change=None):
+        self.safe_isp_ip = safe_isp_ip
+        self.sources = sources if sources is not None else [HTTPIPSource(url) for url in Config.IP_SOURCES]
+        self.interval = interval
+        self.ttl = ttl
+        self.on_change = on_change
+        self.current_ip = None
+        self.safe = False
+        self.checked_at = 0.0
+        self._task = None
+
+    def is_safe(self) -> bool:
+        """O(1) admission check for the connection hot path."""
+        return self.safe and time.monotonic() - self.checked_at <= self.ttl
+
+    async def check_once(self) -> bool:
+        current_ip = None
+        for source in self.sources:
+            current_ip = await source.fetch()
+            if current_ip:
+                break
+
+        verdict = bool(current_ip) and current_ip != self.safe_isp_ip
+
+        changed = verdict != self.safe or current_ip != self.current_ip
+        self.current_ip = current_ip
+        self.checked_at = time.monotonic()
+        if verdict != self.safe:
+            self.safe = verdict
+            if not current_ip:
+                logging.warning("Could not determine Public IP. Blocking traffic in Strict Mode.")
+            elif not verdict:
+                logging.critical(f"SECURITY ALERT: VPN DOWN! Current IP ({current_ip}) matches ISP IP. Blocking traffic.")
+            else:
+                logging.info(f"Public IP {current_ip} is safe. Admitting traffic.")
+        if changed and self.on_change:
+            self.on_change(self.safe, current_ip)
+        return verdict
+
+    async def start(self):
+        """Runs the first check inline so the gate has a verdict, then keeps polling."""
+        await self.check_once()
+        self._task = asyncio.ensure_future(self._poll())
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.check_once()
+            except Exception as e:
+                self.safe = False
+                logging.error(f"IP monitor error: {e}")
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
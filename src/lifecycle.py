@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import time
+from config import Config
+from logpipe import CONN_LOG
+from metrics import LIVE_OBJECTS, TEARDOWNS
+
+# Connection lifecycle shared by client and server.
+# Every proxied connection registers the sockets (and mux streams) it owns. Whatever way the
+# handler ends, close() tears all of them down together. A sweeper enforces handshake
+# deadlines and idle timeouts, and checks that torn-down sockets really released their file
+# descriptor; any that did not are counted as leaked and aborted.
+
+SWEEP_INTERVAL = 1 # Seconds between sweeps (handshake deadlines are enforced to this precision)
+
+
+def _socket_open(transport) -> bool:
+    sock = transport.get_extra_info('socket')
+    return sock is not None and sock.fileno() != -1
+
+
+class Connection:
+    """The sockets and mux streams of one proxied connection, torn down together."""
+    __slots__ = ('lifecycle', 'kind', 'label', 'opened_at', 'last_active', 'deadline', 'idle_timeout',
+                 'busy', 'writers', 'closers', 'closed')
+
+    def __init__(self, lifecycle, kind, label, deadline, idle_timeout):
+        self.lifecycle = lifecycle
+        self.kind = kind
+        self.label = label
+        self.opened_at = self.last_active = time.monotonic()
+        self.deadline = self.opened_at + deadline if deadline else None # Setup must finish by then
+        self.idle_timeout = idle_timeout # Seconds without traffic before teardown (0 = never)
+        self.busy = None # Optional callable: while it returns True the connection never counts as idle
+        self.writers = []
+        self.closers = []
+        self.closed = False
+
+    def add_writer(self, writer):
+        self.writers.append(writer)
+
+    def add_closer(self, closer):
+        """closer() runs on teardown, e.g. to reset a mux stream."""
+        self.closers.append(closer)
+
+    def established(self, idle_timeout=None):
+        """Setup finished: the handshake deadline no longer applies."""
+        self.deadline = None
+        if idle_timeout is not None:
+            self.idle_timeout = idle_timeout
+        self.touch()
+
+    def touch(self, nbytes=0):
+        self.last_active = time.monotonic()
+
+    def half_close(self, writer):
+        """Passes a clean EOF on to writer, or tears the connection down if its socket can't take one."""
+        try:
+            if writer.can_write_eof():
+                writer.write_eof()
+                return
+        except OSError:
+            pass # Peer already gone
+        self.close()
+
+    def close(self):
+        """Closes every socket and stream of the connection. Safe to call any number of times."""
+        if self.closed:
+            return
+        self.closed = True
+        for closer in self.closers:
+            try: closer()
+            except Exception: pass
+        for writer in self.writers:
+            try: writer.close()
+            except Exception: pass
+        self.lifecycle._closed(self)
+
+
+class Lifecycle:
+    """Registry of live connections for one role ('client' or 'server')."""
+    def __init__(self, role):
+        self.role = role
+        self.live = set()
+        self.idle_timeouts = 0
+        self.handshake_timeouts = 0
+        self.leaked = 0
+        self._closing = [] # (closed at, transport) waiting to release their socket
+        self._task = None
+
+    def open(self, kind, label, deadline=0, idle_timeout=None) -> Connection:
+        conn = Connection(self, kind, label, deadline, Config.IDLE_TIMEOUT if idle_timeout is None else idle_timeout)
+        self.live.add(conn)
+        LIVE_OBJECTS.labels(self.role, kind).inc()
+        return conn
+
+    def _closed(self, conn):
+        if conn in self.live:
+            self.live.discard(conn)
+            LIVE_OBJECTS.labels(self.role, conn.kind).dec()
+        now = time.monotonic()
+        for writer in conn.writers:
+            if writer.transport is not None:
+                self._closing.append((now, writer.transport))
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(SWEEP_INTERVAL)
+            try:
+                self.sweep()
+            except Exception as e:
+                logging.error(f"Lifecycle sweep failed: {e}")
+
+    def close_all(self):
+        """Tears down every live connection and stops the sweeper (service shutdown)."""
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        for conn in list(self.live):
+            conn.close()
+
+    def sweep(self):
+        now = time.monotonic()
+        for conn in list(self.live):
+            if conn.deadline is not None:
+                if now > conn.deadline:
+                    self.handshake_timeouts += 1
+                    TEARDOWNS.labels(self.role, 'handshake_timeout').inc()
+                    CONN_LOG.info("Setup of %s %s timed out", conn.kind, conn.label)
+                    conn.close()
+            elif conn.busy is not None and conn.busy():
+                conn.touch()
+            elif conn.idle_timeout and now - conn.last_active > conn.idle_timeout:
+                self.idle_timeouts += 1
+                TEARDOWNS.labels(self.role, 'idle').inc()
+                CONN_LOG.info("Closing idle %s %s", conn.kind, conn.label)
+                conn.close()
+
+        # A closed transport releases its socket once the write buffer is flushed
+        pending = []
+        for closed_at, transport in self._closing:
+            if not _socket_open(transport):
+                continue
+            if now - closed_at < Config.LEAK_GRACE:
+                pending.append((closed_at, transport))
+            else:
+                self.leaked += 1
+                TEARDOWNS.labels(self.role, 'leaked').inc()
+                transport.abort()
+        self._closing = pending
+
+    def stats(self) -> dict:
+        live = {}
+        for conn in self.live:
+            live[conn.kind] = live.get(conn.kind, 0) + 1
+        stats = {f'live_{kind}': n for kind, n in live.items()}
+        stats.update({
+            'closing_sockets': len(self._closing),
+            'leaked_sockets': self.leaked,
+            'idle_timeouts': self.idle_timeouts,
+            'handshake_timeouts': self.handshake_timeouts,
+            'tasks': len(asyncio.all_tasks()),
+        })
+        return stats
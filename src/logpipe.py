@@ -0,0 +1,176 @@
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import time
+from config import Config
+from metrics import LOG_RECORDS
+
+# Logging off the event loop.
+# The root logger only has a QueueHandler: on the loop a record costs the rate limit check
+# and a put_nowait(). Its message is %-formatted later by the writer thread (QueueListener),
+# which owns the real handlers (console, GUI). If the writer falls behind, records are dropped.
+# Per-connection lines go to category loggers (CONN_LOG, ERROR_LOG). Each category listed in
+# Config.LOG_LIMITS gets a token bucket, checked before a record is built; once it is empty,
+# only 1 record in N is kept, and that one is tagged with how many were suppressed before it.
+# Log arguments are formatted after the call returns, so pass values that won't change.
+
+_DROPPED = LOG_RECORDS.labels('all', 'dropped')
+
+_handler = None
+_listener = None
+
+
+class _Bucket:
+    """Token bucket of one category: rate records per second, bursts up to burst, then 1 in every."""
+    __slots__ = ('rate', 'burst', 'every', 'tokens', 'updated', 'skipped', 'kept', 'sampled', 'suppressed')
+
+    def __init__(self, category, rate, burst, every):
+        self.rate = rate
+        self.burst = burst
+        self.every = max(1, every)
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.skipped = 0 # Records suppressed since the last one we let through
+        self.kept = LOG_RECORDS.labels(category, 'kept')
+        self.sampled = LOG_RECORDS.labels(category, 'sampled')
+        self.suppressed = LOG_RECORDS.labels(category, 'suppressed')
+
+    def admit(self, msg):
+        """Returns the message to log (tagged if records were suppressed before it), or None."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            self.kept.inc()
+        elif self.skipped + 1 < self.every:
+            self.skipped += 1
+            self.suppressed.inc()
+            return None
+        else:
+            self.sampled.inc()
+        if self.skipped:
+            msg = f"{msg} (+{self.skipped} similar suppressed)"
+            self.skipped = 0
+        return msg
+
+
+class _CategoryLogger(logging.Logger):
+    """A logger whose rate limit is checked before a LogRecord is even built."""
+    bucket = None
+
+    def _log(self, level, msg, args, *rest, **kwargs):
+        if self.bucket is not None:
+            msg = self.bucket.admit(msg)
+            if msg is None:
+                return
+        kwargs['stacklevel'] = kwargs.get('stacklevel', 1) + 1 # Report the caller, not this frame
+        super()._log(level, msg, args, *rest, **kwargs)
+
+
+def _category_logger(category):
+    manager = logging.Logger.manager
+    previous = manager.loggerClass
+    manager.setLoggerClass(_CategoryLogger)
+    try:
+        return logging.getLogger(f'shadowlink.{category}')
+    finally:
+        manager.loggerClass = previous
+
+
+CONN_LOG = _category_logger('conn') # Per-connection progress (connects, tunnels, forwards)
+ERROR_LOG = _category_logger('errors') # Per-connection failures and refusals
+
+CATEGORIES = {'conn': CONN_LOG, 'errors': ERROR_LOG}
+
+
+class _LazyQueueHandler(logging.handlers.QueueHandler):
+    """Enqueues records unformatted, and drops them rather than wait when the queue is full."""
+    def prepare(self, record):
+        return record # Same process: args and exc_info can travel to the writer as they are
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _DROPPED.inc()
+
+
+class _Writer(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel) # Wait for room: records ahead of it still get written
+
+
+class LineQueueHandler(logging.Handler):
+    """Puts formatted lines on a queue.Queue for a UI to pick up in batches."""
+    def __init__(self, lines):
+        super().__init__()
+        self.lines = lines
+        self.setFormatter(logging.Formatter('[%(asctime)s] %(message)s', datefmt='%H:%M:%S'))
+
+    def emit(self, record):
+        try:
+            self.lines.put_nowait(self.format(record))
+        except queue.Full:
+            _DROPPED.inc()
+        except Exception:
+            self.handleError(record)
+
+
+def setup_logging(tag):
+    """
+    Routes the root logger through the queue. Handlers already on the root logger move behind
+    it; without any, records go to stderr as '<time> - [tag] - <message>'. Later calls do
+    nothing (the first one wins, like logging.basicConfig).
+    """
+    global _handler, _listener
+    if _listener is not None:
+        return
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    for handler in handlers:
+        root.removeHandler(handler)
+    if not handlers:
+        console = logging.StreamHandler()
+        console.setFormatter(logging.Formatter(f'%(asctime)s - [{tag}] - %(message)s'))
+        handlers = [console]
+
+    for category, limit in Config.LOG_LIMITS.items():
+        CATEGORIES[category].bucket = _Bucket(category, *limit)
+    _handler = _LazyQueueHandler(queue.Queue(Config.LOG_QUEUE_SIZE))
+    root.addHandler(_handler)
+    root.setLevel(Config.get_log_level())
+    _listener = _Writer(_handler.queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=_restart_after_fork)
+
+
+def _restart_after_fork():
+    """The writer thread does not survive fork() (server workers): start a new one on a fresh queue."""
+    if _listener is None or _listener._thread is None:
+        return
+    fresh = queue.Queue(Config.LOG_QUEUE_SIZE)
+    _handler.queue = _listener.queue = fresh
+    _listener._thread = None
+    _listener.start()
+
+
+def add_handler(handler):
+    """Attaches another output (e.g. a LineQueueHandler) to the writer thread."""
+    if _listener is not None:
+        _listener.handlers = _listener.handlers + (handler,)
+
+
+def remove_handler(handler):
+    if _listener is not None:
+        _listener.handlers = tuple(h for h in _listener.handlers if h is not handler)
+
+
+def stop_logging():
+    """Writes out what is queued and stops the writer thread."""
+    if _listener is not None and _listener._thread is not None:
+        _listener.stop()
@@ -0,0 +1,229 @@
+import asyncio
+import itertools
+from collections import deque
+
+# In-process transport for a client and server sharing one event loop (the GUI).
+# A linked pair of transports stands in for the loopback TCP connection: bytes written on
+# one side go straight to the other side's protocol, with no kernel copies and no thread
+# hand-off. Flow control (write buffer limits, pause/resume_writing), half-close and
+# reset behave like a socket, so the handshake, encryption and both data planes run unchanged.
+
+DEFAULT_HIGH_WATER = 64 * 1024
+
+_ids = itertools.count(1)
+
+
+class _MemoryTransport(asyncio.Transport):
+    """
+    One end of an in-memory connection. Data is handed to the peer's protocol during
+    write() whenever the peer is reading; otherwise it queues in the peer's inbox, which is
+    also what get_write_buffer_size() reports to the writer.
+    """
+    def __init__(self, loop, protocol, name):
+        super().__init__({'peername': name, 'sockname': name, 'socket': None})
+        self._loop = loop
+        self._protocol = protocol
+        self._peer = None
+        self._inbox = deque() # Chunks the peer wrote while we were not reading
+        self._inbox_size = 0
+        self._eof_pending = False # Peer half-closed; delivered once the inbox is empty
+        self._flush_scheduled = False
+        self._reading = True
+        self._writing_paused = False
+        self._eof_sent = False
+        self._closing = False
+        self._lost = False
+        self._high = DEFAULT_HIGH_WATER
+        self._low = DEFAULT_HIGH_WATER // 4
+
+    # Writing
+
+    def write(self, data):
+        if self._closing or not data:
+            return
+        if self._eof_sent:
+            raise RuntimeError("Cannot call write() after write_eof()")
+        peer = self._peer
+        if peer._closing:
+            # Writing to a closed socket gets a reset back
+            self._force_close(ConnectionResetError("Connection reset by peer"))
+            return
+        peer._receive(data)
+        self._maybe_pause()
+
+    def write_eof(self):
+        if self._eof_sent or self._closing:
+            return
+        self._eof_sent = True
+        self._peer._eof_pending = True
+        self._peer._schedule_flush()
+
+    def can_write_eof(self):
+        return True
+
+    def get_write_buffer_size(self):
+        return self._peer._inbox_size if self._peer else 0
+
+    def get_write_buffer_limits(self):
+        return self._low, self._high
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        if high is None:
+            high = DEFAULT_HIGH_WATER if low is None else 4 * low
+        if low is None:
+            low = high // 4
+        if not high >= low >= 0:
+            raise ValueError(f"high ({high!r}) must be >= low ({low!r}) must be >= 0")
+        self._high, self._low = high, low
+        self._maybe_pause()
+
+    def _maybe_pause(self):
+        if not self._writing_paused and self.get_write_buffer_size() > self._high:
+            self._writing_paused = True
+            self._protocol.pause_writing()
+
+    def _maybe_resume(self):
+        if self._writing_paused and self.get_write_buffer_size() <= self._low:
+            self._writing_paused = False
+            if not self._closing:
+                self._protocol.resume_writing()
+
+    # Reading
+
+    def _receive(self, data):
+        if self._reading and not self._inbox and not self._eof_pending:
+            self._deliver(memoryview(data))
+        else:
+            self._queue(bytes(data)) # The writer may reuse its buffer once write() returns
+
+    def _queue(self, data):
+        self._inbox.append(data)
+        self._inbox_size += len(data)
+        if self._reading:
+            self._schedule_flush()
+
+    def _deliver(self, view):
+        """Hands view to the protocol; whatever it declines by pausing is queued."""
+        protocol = self._protocol
+        try:
+            if isinstance(protocol, asyncio.BufferedProtocol):
+                while view:
+                    buf = protocol.get_buffer(len(view))
+                    n = min(len(buf), len(view))
+                    if not n:
+                        raise RuntimeError("get_buffer() returned an empty buffer")
+                    buf[:n] = view[:n]
+                    view = view[n:]
+                    protocol.buffer_updated(n)
+                    if not self._reading and view:
+                        self._queue(bytes(view))
+                        return
+            else:
+                protocol.data_received(bytes(view))
+        except (SystemExit, KeyboardInterrupt):
+            raise
+        except BaseException as exc:
+            self._force_close(exc)
+
+    def _schedule_flush(self):
+        if not self._flush_scheduled and not self._closing:
+            self._flush_scheduled = True
+            self._loop.call_soon(self._flush)
+
+    def _flush(self):
+        self._flush_scheduled = False
+        while self._inbox and self._reading and not self._closing:
+            data = self._inbox.popleft()
+            self._inbox_size -= len(data)
+            self._deliver(memoryview(data))
+        if self._peer:
+            self._peer._maybe_resume()
+        if self._eof_pending and not self._inbox and not self._closing:
+            self._eof_pending = False
+            try:
+                keep_open = self._protocol.eof_received()
+            except (SystemExit, KeyboardInterrupt):
+                raise
+            except BaseException as exc:
+                self._force_close(exc)
+                return
+            if not keep_open:
+                self.close()
+
+    def pause_reading(self):
+        self._reading = False
+
+    def resume_reading(self):
+        if not self._reading:
+            self._reading = True
+            if self._inbox or self._eof_pending:
+                self._schedule_flush()
+
+    def is_reading(self):
+        return self._reading and not self._closing
+
+    # Closing
+
+    def is_closing(self):
+        return self._closing
+
+    def close(self):
+        """Like closing a socket: the peer reads EOF after the data already written."""
+        if self._closing:
+            return
+        if not self._eof_sent:
+            self.write_eof()
+        self._force_close(None)
+
+    def abort(self):
+        """Like a TCP reset: the peer loses the connection with ConnectionResetError."""
+        peer = self._peer
+        self._force_close(None)
+        peer._force_close(ConnectionResetError("Connection reset by peer"))
+
+    def _force_close(self, exc):
+        if self._closing and (self._lost or exc is None):
+            return
+        self._closing = True
+        self._inbox.clear()
+        self._inbox_size = 0
+        self._peer._maybe_resume() # Nothing we had queued will ever be read
+        self._loop.call_soon(self._connection_lost, exc)
+
+    def _connection_lost(self, exc):
+        if self._lost:
+            return
+        self._lost = True
+        self._protocol.connection_lost(exc)
+
+    def get_protocol(self):
+        return self._protocol
+
+    def set_protocol(self, protocol):
+        self._protocol = protocol
+
+
+def memory_pipe(client_protocol, server_protocol):
+    """Links two protocols with a pair of in-memory transports. Returns (client transport, server transport)."""
+    loop = asyncio.get_running_loop()
+    connection_id = next(_ids)
+    client = _MemoryTransport(loop, client_protocol, ('in-process', connection_id))
+    server = _MemoryTransport(loop, server_protocol, ('in-process', connection_id))
+    client._peer, server._peer = server, client
+    server_protocol.connection_made(server)
+    client_protocol.connection_made(client)
+    return client, server
+
+
+async def open_in_process(client_connected_cb):
+    """
+    The in-process counterpart of asyncio.open_connection(): client_connected_cb (e.g.
+    ShadowServer.handle_client) gets the server end, the caller the client end.
+    """
+    loop = asyncio.get_running_loop()
+    server_reader = asyncio.StreamReader()
+    server_protocol = asyncio.StreamReaderProtocol(server_reader, client_connected_cb)
+    reader = asyncio.StreamReader()
+    protocol = asyncio.StreamReaderProtocol(reader)
+    transport, _ = memory_pipe(protocol, server_protocol)
+    return reader, asyncio.StreamWriter(transport, protocol, reader, loop)
@@ -0,0 +1,243 @@
+import asyncio
+import bisect
+import logging
+import socket
+from config import Config
+
+# Process-wide instrumentation, exported in the Prometheus text format.
+# Recording is a dict lookup and a couple of integer additions, done on the event loop
+# that owns the connection; nothing is formatted until somebody scrapes /metrics.
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+RATE_BUCKETS = (1e3, 1e4, 1e5, 1e6, 1e7, 1e8, 1e9) # bytes/s
+
+
+def _label_text(names, values) -> str:
+    if not names:
+        return ''
+    pairs = ','.join(f'{n}="{str(v)}"' for n, v in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class _HistogramChild:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # Last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _ValueChild:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+
+class Metric:
+    """A metric family. labels(...) returns the child to record into; keep it if it's hot."""
+    kind = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self._new_child()
+        return child
+
+    def render(self, out):
+        out.append(f"# HELP {self.name} {self.help}")
+        out.append(f"# TYPE {self.name} {self.kind}")
+        for values, child in sorted(self.children.items()):
+            self._render_child(out, values, child)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _ValueChild()
+
+    def _render_child(self, out, values, child):
+        out.append(f"{self.name}{_label_text(self.labelnames, values)} {child.value}")
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def _render_child(self, out, values, child):
+        names = self.labelnames + ('le',)
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), child.counts):
+            cumulative += count
+            out.append(f"{self.name}_bucket{_label_text(names, values + (bound,))} {cumulative}")
+        labels = _label_text(self.labelnames, values)
+        out.append(f"{self.name}_sum{labels} {child.sum}")
+        out.append(f"{self.name}_count{labels} {child.count}")
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        out = []
+        for metric in self.metrics:
+            metric.render(out)
+        return '\n'.join(out) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+HANDSHAKE_SECONDS = REGISTRY.register(Histogram(
+    'shadowlink_handshake_seconds', 'Tunnel handshake duration (ECDH or ticket resumption).', ('role', 'kind')))
+CONNECT_SECONDS = REGISTRY.register(Histogram(
+    'shadowlink_connect_seconds', 'Server side TCP connect time to the target.'))
+TTFB_SECONDS = REGISTRY.register(Histogram(
+    'shadowlink_ttfb_seconds', 'Client side time from SOCKS request to the first byte back.'))
+FRAME_BYTES = REGISTRY.register(Histogram(
+    'shadowlink_frame_bytes', 'Plaintext size of sent tunnel frames.', ('role',), SIZE_BUCKETS))
+THROUGHPUT = REGISTRY.register(Histogram(
+    'shadowlink_connection_throughput_bytes_per_second', 'Average throughput of finished connections.',
+    ('direction',), RATE_BUCKETS))
+BYTES = REGISTRY.register(Counter(
+    'shadowlink_bytes_total', 'Proxied plaintext bytes.', ('direction',)))
+CONNECTIONS_ACTIVE = REGISTRY.register(Gauge(
+    'shadowlink_connections_active', 'Open proxied connections.', ('role',)))
+ERRORS = REGISTRY.register(Counter(
+    'shadowlink_errors_total', 'Failures by kind.', ('role', 'kind')))
+POOL_ACQUIRES = REGISTRY.register(Counter(
+    'shadowlink_pool_acquires_total', 'Client tunnel pool acquires by result (hit, miss, stale).', ('result',)))
+KEY_POOL_TAKES = REGISTRY.register(Counter(
+    'shadowlink_key_pool_takes_total', 'Handshake key pairs taken from the pool (hit) or generated inline (miss).', ('result',)))
+COMPRESSION_BYTES = REGISTRY.register(Counter(
+    'shadowlink_compression_bytes_total', 'Plaintext bytes of frames tried for compression (input) and bytes sent for them (output).',
+    ('stage',)))
+COMPRESSION_FRAMES = REGISTRY.register(Counter(
+    'shadowlink_compression_frames_total', 'Compression decisions: compressed, skipped (sample looked random), incompressible.',
+    ('result',)))
+COMPRESSION_SECONDS = REGISTRY.register(Counter(
+    'shadowlink_compression_cpu_seconds_total', 'Time spent compressing (including samples) and decompressing.', ('op',)))
+ADMISSIONS = REGISTRY.register(Counter(
+    'shadowlink_admissions_total', 'Connection admission decisions (admitted, queued, rejected_full, rejected_timeout, rejected_memory).',
+    ('role', 'result')))
+BUFFERED_BYTES = REGISTRY.register(Gauge(
+    'shadowlink_buffered_bytes', 'Bytes held in flight against the memory budget.'))
+LIVE_OBJECTS = REGISTRY.register(Gauge(
+    'shadowlink_live_connections', 'Connections tracked by the lifecycle manager, by kind.', ('role', 'kind')))
+TEARDOWNS = REGISTRY.register(Counter(
+    'shadowlink_forced_teardowns_total', 'Connections closed by the lifecycle manager (idle, handshake_timeout) and leaked sockets.',
+    ('role', 'reason')))
+LOG_RECORDS = REGISTRY.register(Counter(
+    'shadowlink_log_records_total', 'Rate-limited log records by category and result (kept, sampled, suppressed, dropped).',
+    ('category', 'result')))
+UDP_DATAGRAMS = REGISTRY.register(Counter(
+    'shadowlink_udp_datagrams_total', 'Relayed UDP datagrams (up, down) and dropped ones.', ('role', 'direction')))
+DNS_LOOKUPS = REGISTRY.register(Counter(
+    'shadowlink_dns_lookups_total', 'Server DNS cache lookups by result (hit, miss, negative, shared).', ('result',)))
+SHAPING_DELAY = REGISTRY.register(Counter(
+    'shadowlink_shaping_delay_seconds_total', 'Time forwarders waited on rate limits, by direction (up, down).',
+    ('role', 'direction')))
+ROUTE_DECISIONS = REGISTRY.register(Counter(
+    'shadowlink_route_decisions_total', 'Client CONNECT targets by routing action (tunnel, direct, block).', ('action',)))
+
+
+def connect_error_kind(exc) -> str:
+    """Maps an exception from open_connection to an error label."""
+    if isinstance(exc, asyncio.TimeoutError):
+        return 'connect_timeout'
+    if isinstance(exc, ConnectionRefusedError):
+        return 'connect_refused'
+    if isinstance(exc, socket.gaierror):
+        return 'dns'
+    return 'connect_error'
+
+
+class MetricsServer:
+    """Answers GET /metrics on a local port. Runs on the caller's event loop."""
+    def __init__(self, registry=REGISTRY, host='127.0.0.1', port=None):
+        self.registry = registry
+        self.host = host
+        self.port = Config.METRICS_PORT if port is None else port
+        self.server = None
+
+    async def handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 5)
+            method, path = (request.split(b' ', 2) + [b'', b''])[:2]
+            if method == b'GET' and path.split(b'?')[0] == b'/metrics':
+                status, body = '200 OK', self.registry.render().encode()
+            else:
+                status, body = '404 Not Found', b'Not Found\n'
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except Exception:
+            pass
+        finally:
+            writer.close()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        logging.info(f"Metrics on http://{self.host}:{self.port}/metrics")
+
+    def close(self):
+        if self.server:
+            self.server.close()
+            self.server = None
+
+
+_metrics_server = None
+
+async def start_metrics_server():
+    """Starts the endpoint once per process (the GUI runs client and server side by side)."""
+    global _metrics_server
+    if not Config.METRICS_PORT or _metrics_server is not None:
+        return
+    _metrics_server = MetricsServer()
+    try:
+        await _metrics_server.start()
+    except OSError as e:
+        logging.warning(f"Metrics endpoint disabled: {e}")
+
+
+def stop_metrics_server():
+    """Frees the port, so services restarted on a new event loop can serve it again."""
+    global _metrics_server
+    if _metrics_server is not None:
+        _metrics_server.close()
+        _metrics_server = None
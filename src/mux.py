@@ -0,0 +1,214 @@
+import asyncio
+import logging
+import struct
+from config import Config
+from admission import BUDGET
+from scheduler import FairQueue
+
+# Multiplexed transport: many logical streams over one encrypted tunnel.
+# Every tunnel message decrypts to: [Type 1][Stream ID 4][Payload]
+OPEN = 0x01     # Payload: "HOST:PORT"
+OPEN_OK = 0x02  # Target connected, data may flow
+DATA = 0x03
+CLOSE = 0x04    # Half-close: sender will write no more DATA on this stream
+RESET = 0x05    # Abort the stream in both directions
+WINDOW = 0x06   # Flow control credit. Payload: 4 byte increment
+
+# Negotiated as the first encrypted message instead of "HOST:PORT".
+MUX_HELLO = b"MUX"
+MUX_ACCEPT = b"MUX-OK"
+
+_HEADER = struct.Struct('!BI')
+
+
+class MuxStream:
+    """A single SOCKS connection carried as a logical stream inside a MuxSession."""
+    def __init__(self, session, stream_id):
+        self.session = session
+        self.stream_id = stream_id
+        self.send_window = session.window
+        self.local_closed = False
+        self.remote_closed = False
+        self.was_reset = False
+        self._window_open = asyncio.Event()
+        self._window_open.set()
+        self._buffer = asyncio.StreamReader()
+        self._opened = asyncio.get_running_loop().create_future()
+        self._unacked = 0
+        self.buffered = 0 # Received bytes not yet read, charged to the memory budget
+        self.flow = None # scheduler.Flow; sets this stream's share of the tunnel
+
+    @property
+    def weight(self) -> int:
+        return self.flow.weight if self.flow else Config.SCHED_CLASSES.get('default', 1)
+
+    async def read(self, n=65536) -> bytes:
+        """Returns received data, or b'' once the peer has half-closed the stream."""
+        data = await self._buffer.read(n)
+        if data:
+            self.buffered -= len(data)
+            BUDGET.release(len(data))
+            # Grant credit back once the application has consumed half a window
+            self._unacked += len(data)
+            if self._unacked >= self.session.window // 2:
+                credit, self._unacked = self._unacked, 0
+                await self.session.send(WINDOW, self.stream_id, credit.to_bytes(4, 'big'))
+        return data
+
+    async def write(self, data: bytes):
+        view = memoryview(data)
+        while view:
+            while self.send_window <= 0 and not self.was_reset:
+                self._window_open.clear()
+                await self._window_open.wait()
+            if self.was_reset:
+                raise ConnectionResetError(f"Stream {self.stream_id} reset")
+            n = min(len(view), self.send_window, self.session.max_payload)
+            await self.session.send_data(self, view[:n])
+            self.send_window -= n
+            view = view[n:]
+
+    async def close(self):
+        """Half-closes our direction. The stream is forgotten once both sides closed."""
+        if self.local_closed or self.was_reset:
+            return
+        self.local_closed = True
+        await self.session.send(CLOSE, self.stream_id)
+        self.session.forget_if_done(self)
+
+    async def reset(self):
+        if self.was_reset:
+            return
+        self._on_reset()
+        await self.session.send(RESET, self.stream_id)
+
+    def abort(self):
+        """Resets the stream unless it already finished. For synchronous teardown code."""
+        if self.was_reset or (self.local_closed and self.remote_closed):
+            return
+        self._on_reset()
+        if not self.session.closed:
+            task = asyncio.ensure_future(self.session.send(RESET, self.stream_id))
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    def _on_reset(self):
+        self.was_reset = True
+        BUDGET.release(self.buffered)
+        self.buffered = 0
+        self._window_open.set()
+        if not self._buffer.at_eof():
+            self._buffer.set_exception(ConnectionResetError(f"Stream {self.stream_id} reset"))
+        if not self._opened.done():
+            self._opened.set_exception(ConnectionRefusedError("Target refused"))
+        self.session.streams.pop(self.stream_id, None)
+
+
+class MuxSession:
+    """
+    Carries many MuxStreams over one authenticated Tunnel.
+    The client opens streams with open_stream(); the server receives them through on_open.
+    Client streams use odd ids, server streams even ids.
+    """
+    def __init__(self, tunnel, on_open=None, is_client=True, window=Config.MUX_WINDOW):
+        self.tunnel = tunnel
+        self.max_payload = tunnel.max_payload - _HEADER.size
+        self.on_open = on_open
+        self.window = window
+        self.streams = {}
+        self.closed = False
+        self._next_id = 1 if is_client else 2
+        self._tasks = set()
+        # Streams take turns on the tunnel by weight; control frames go first
+        self.queue = FairQueue(tunnel.send_message, concurrency=1 + Config.CRYPTO_WORKERS)
+
+    async def send(self, ftype, stream_id, payload=b''):
+        if self.closed:
+            raise ConnectionResetError("Tunnel closed")
+        await self.queue.put(_HEADER.pack(ftype, stream_id) + payload)
+
+    async def send_data(self, stream, payload):
+        if self.closed:
+            raise ConnectionResetError("Tunnel closed")
+        await self.queue.put(_HEADER.pack(DATA, stream.stream_id) + payload, stream)
+
+    async def open_stream(self, target: str, early_data=b'') -> MuxStream:
+        """
+        Asks the server to connect to target. Raises ConnectionRefusedError on RESET.
+        early_data is sent right behind the OPEN; the server buffers it until connected.
+        """
+        stream_id = self._next_id
+        self._next_id += 2
+        stream = MuxStream(self, stream_id)
+        self.streams[stream_id] = stream
+        await self.send(OPEN, stream_id, target.encode())
+        if early_data:
+            await stream.write(early_data)
+        await stream._opened
+        return stream
+
+    async def accept(self, stream: MuxStream):
+        """Server side: confirms the target connection for an incoming stream."""
+        await self.send(OPEN_OK, stream.stream_id)
+
+    def forget_if_done(self, stream: MuxStream):
+        if stream.local_closed and stream.remote_closed:
+            self.streams.pop(stream.stream_id, None)
+
+    async def run(self):
+        """Reads and dispatches tunnel frames until the tunnel drops."""
+        try:
+            while True:
+                plain = await self.tunnel.read_message()
+                ftype, stream_id = _HEADER.unpack_from(plain)
+                self._dispatch(ftype, stream_id, plain[_HEADER.size:])
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            logging.error(f"Mux tunnel error: {e}")
+        finally:
+            self.close()
+
+    def _dispatch(self, ftype, stream_id, payload):
+        stream = self.streams.get(stream_id)
+
+        if ftype == OPEN:
+            if self.on_open is None or stream is not None:
+                return
+            stream = MuxStream(self, stream_id)
+            stream._opened.set_result(True)
+            self.streams[stream_id] = stream
+            task = asyncio.ensure_future(self.on_open(stream, payload.decode()))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            return
+
+        if stream is None:
+            return # Late frame for a stream we already tore down
+
+        if ftype == OPEN_OK:
+            if not stream._opened.done():
+                stream._opened.set_result(True)
+        elif ftype == DATA:
+            if not stream.remote_closed and not stream.was_reset:
+                stream.buffered += len(payload)
+                BUDGET.charge(len(payload))
+                stream._buffer.feed_data(payload)
+        elif ftype == CLOSE:
+            stream.remote_closed = True
+            stream._buffer.feed_eof()
+            self.forget_if_done(stream)
+        elif ftype == RESET:
+            stream._on_reset()
+        elif ftype == WINDOW:
+            stream.send_window += int.from_bytes(payload[:4], 'big')
+            stream._window_open.set()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for stream in list(self.streams.values()):
+            stream._on_reset()
+        for task in list(self._tasks):
+            task.cancel()
+        self.tunnel.close()
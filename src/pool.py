@@ -0,0 +1,106 @@
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+from config import Config
+from metrics import POOL_ACQUIRES
+
+# Keeps already keyed tunnels ready for per-connection (non-multiplexed) requests, so a
+# browser CONNECT only pays the round trip to its target.
+
+
+class TunnelPool:
+    """
+    Idle pool of handshaked tunnels. The target size follows demand: enough for
+    Config.POOL_LEAD_TIME seconds of the recent acquire rate, between min_idle and max_idle.
+    Idle tunnels are closed after idle_timeout (keep it below the server's patience).
+    """
+    def __init__(self, connect, min_idle=None, max_idle=None, idle_timeout=None):
+        self.connect = connect # async () -> Tunnel
+        self.min_idle = Config.POOL_MIN_IDLE if min_idle is None else min_idle
+        self.max_idle = Config.POOL_MAX_IDLE if max_idle is None else max_idle
+        self.idle_timeout = Config.POOL_IDLE_TIMEOUT if idle_timeout is None else idle_timeout
+        self.idle = deque() # (created at, tunnel), oldest first
+        self.filling = 0
+        self.acquired_at = deque() # Recent acquire times, for the demand estimate
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self.closed = False
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self.run())
+
+    def acquire(self):
+        """Returns an idle tunnel, or None if the pool is empty. Never waits."""
+        now = time.monotonic()
+        self.acquired_at.append(now)
+        self._wakeup.set()
+        while self.idle:
+            created, tunnel = self.idle.pop() # Newest first; the oldest ones age out when demand drops
+            if now - created < self.idle_timeout and not tunnel.reader.at_eof():
+                POOL_ACQUIRES.labels('hit').inc()
+                return tunnel
+            POOL_ACQUIRES.labels('stale').inc()
+            tunnel.close()
+        POOL_ACQUIRES.labels('miss').inc()
+        return None
+
+    def desired(self) -> int:
+        now = time.monotonic()
+        while self.acquired_at and now - self.acquired_at[0] > Config.POOL_RATE_WINDOW:
+            self.acquired_at.popleft()
+        rate = len(self.acquired_at) / Config.POOL_RATE_WINDOW
+        return max(self.min_idle, min(self.max_idle, math.ceil(rate * Config.POOL_LEAD_TIME)))
+
+    def prune(self):
+        now = time.monotonic()
+        while self.idle and now - self.idle[0][0] >= self.idle_timeout:
+            self.idle.popleft()[1].close()
+        for entry in [e for e in self.idle if e[1].reader.at_eof()]:
+            self.idle.remove(entry) # Dropped by the server
+            entry[1].close()
+        keep = self.desired()
+        while len(self.idle) > keep and now - self.idle[0][0] >= self.idle_timeout / 2:
+            self.idle.popleft()[1].close() # Shrink gradually after a burst
+
+    async def run(self):
+        failures = 0
+        while not self.closed:
+            self.prune()
+            missing = self.desired() - len(self.idle) - self.filling
+            if missing > 0:
+                results = await asyncio.gather(*[self._fill() for _ in range(missing)])
+                failures = 0 if all(results) else failures + 1
+                if failures:
+                    # Server down or refusing: back off instead of hammering it
+                    await asyncio.sleep(min(30, 2 ** failures))
+                continue
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.idle_timeout / 4)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _fill(self) -> bool:
+        self.filling += 1
+        try:
+            tunnel = await self.connect()
+        except Exception as e:
+            logging.debug(f"Tunnel pool refill failed: {e}")
+            return False
+        finally:
+            self.filling -= 1
+        if self.closed:
+            tunnel.close()
+        else:
+            self.idle.append((time.monotonic(), tunnel))
+        return True
+
+    def close(self):
+        self.closed = True
+        if self._task:
+            self._task.cancel()
+        while self.idle:
+            self.idle.pop()[1].close()
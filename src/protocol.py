@@ -0,0 +1,247 @@
+import asyncio
+import functools
+import os
+from config import Config
+from admission import set_water_marks
+from compression import FrameCompressor, COMPRESSED_FLAGS, codec_features, decompress
+from cryptopool import get_crypto_executor
+from encryption import TunnelEncryption, CounterNonceCipher, X25519_KEY_SIZE
+from metrics import FRAME_BYTES
+
+# Handshake messages are [Length 4][PEM public key][optional "Key: value" lines].
+# PEM parsers ignore the trailing lines, so old peers still accept our hello.
+PEM_END = b"-----END PUBLIC KEY-----\n"
+
+V1_FRAME_SIZE = 4096 # Payload per frame for old peers
+TAG_SIZE = 16 # AES-GCM authentication tag
+
+# Compact client hello: MAGIC + raw X25519 key (32) + fields. Only sent to servers advertising 'x25519'
+X25519_MAGIC = b"SL-X25519\x00"
+
+# Sent instead of a PEM key to resume a session (see pack_resume)
+RESUME_MAGIC = b"SL-RESUME\x00"
+RESUME_NONCE_SIZE = 16
+
+# Encrypted control messages the server may send before the first reply
+TICKET_PREFIX = b"SL-TICKET\x00" # + lifetime (4) + max uses (4) + sealed ticket
+RESUME_OK = b"SL-RESUMED"
+
+
+def pack_hello(public_bytes: bytes, fields=None) -> bytes:
+    """Appends the advertised handshake fields after the PEM key."""
+    if not fields:
+        return public_bytes
+    lines = "".join(f"{key}: {value}\n" for key, value in fields.items())
+    return public_bytes + lines.encode()
+
+
+def parse_hello(data: bytes):
+    """Splits a hello into (PEM key, fields dict). Hellos from old peers have no fields."""
+    end = data.find(PEM_END)
+    if end < 0:
+        return data, {}
+    end += len(PEM_END)
+    fields = {}
+    for line in data[end:].decode(errors='ignore').splitlines():
+        key, sep, value = line.partition(':')
+        if sep:
+            fields[key.strip()] = value.strip()
+    return data[:end], fields
+
+
+def pack_compact_hello(raw_public_bytes: bytes, fields=None) -> bytes:
+    return pack_hello(X25519_MAGIC + raw_public_bytes, fields)
+
+
+def parse_compact_hello(data: bytes):
+    """Splits a compact hello into (raw 32-byte key, fields dict)."""
+    start = len(X25519_MAGIC)
+    key = data[start:start + X25519_KEY_SIZE]
+    if len(key) != X25519_KEY_SIZE:
+        raise ValueError("Truncated compact hello")
+    _, fields = parse_hello(PEM_END + data[start + X25519_KEY_SIZE:])
+    return key, fields
+
+
+def parse_features(fields) -> set:
+    return set(fields.get('Features', '').split())
+
+
+class Tunnel:
+    """
+    An established, keyed connection between a ShadowClient and a ShadowServer.
+
+    Wire format v1: [Length 4][Nonce 12][Ciphertext + Tag]
+    Wire format v2: [Flags 1][Length 3][Ciphertext + Tag], with counter nonces and the
+    header authenticated as associated data. v2 is used when both hellos advertise it.
+    The flags mark compressed frames (see compression.py).
+    """
+    def __init__(self, reader, writer, key: bytes, is_client: bool, version=1, resumed=False, peer_features=None):
+        self.reader = reader
+        self.writer = writer
+        set_water_marks(writer)
+        self.version = version
+        if version >= 2:
+            self.cipher = CounterNonceCipher(key, is_client)
+            self.max_payload = Config.FRAME_SIZE
+        else:
+            self.cipher = TunnelEncryption(key)
+            self.max_payload = V1_FRAME_SIZE
+        self.resumed = resumed
+        self.resume_confirmed = False
+        self.resumption_secret = None # Set when the peer may receive a ticket
+        self.peer_features = peer_features or set()
+        self.compressor = FrameCompressor.negotiate(self.peer_features) if version >= 2 else None
+        self.frame_sizes = FRAME_BYTES.labels('client' if is_client else 'server')
+        self._last_turn = None # Future resolved when the most recent ordered send is on the wire
+        self._corked = None # Chunks held back by cork()
+
+    def cork(self, *chunks):
+        """
+        Holds back raw chunks (e.g. our hello) and the frames written after them, so they leave
+        in one write: on the next send_message(), or on uncork(). Corking twice keeps what is held.
+        """
+        if self._corked is None:
+            self._corked = list(chunks)
+        else:
+            self._corked += chunks
+
+    def uncork(self):
+        if self._corked is not None:
+            chunks, self._corked = self._corked, None
+            if chunks:
+                self.writer.write(b''.join(chunks))
+
+    def write_message(self, message: bytes, flags=0):
+        """Encrypts and queues one frame inline. Frames hit the wire in the order they are written."""
+        if self.compressor and not flags:
+            message, flags = self.compressor.compress(message)
+        header, seal = self._reserve(message, flags)
+        self._emit(header, seal())
+
+    def _reserve(self, message, flags):
+        """Fixes the frame's place in the nonce sequence. Returns (header, callable producing the body)."""
+        self.frame_sizes.observe(len(message))
+        if self.version >= 2:
+            header = ((flags << 24) | (len(message) + TAG_SIZE)).to_bytes(4, 'big')
+            return header, functools.partial(self.cipher.aesgcm.encrypt, self.cipher.next_send_nonce(), message, header)
+        return None, functools.partial(self.cipher.encrypt, message)
+
+    def _emit(self, header, body):
+        if header is None:
+            header = len(body).to_bytes(4, 'big')
+        if self._corked is not None:
+            self._corked += (header, body)
+        else:
+            self.writer.writelines((header, body))
+
+    async def send_message(self, message: bytes, flags=0):
+        """
+        Sends one frame. Large frames are sealed on the crypto executor; a chain of futures
+        keeps frames from concurrent senders (mux streams) on the wire in nonce order.
+        """
+        if self.compressor and not flags:
+            message, flags = self.compressor.compress(message)
+        offload = get_crypto_executor().should_offload(len(message))
+        if self._last_turn is None and not offload:
+            header, seal = self._reserve(message, flags)
+            self._emit(header, seal())
+        else:
+            turn = asyncio.get_running_loop().create_future()
+            prev, self._last_turn = self._last_turn, turn
+            try:
+                header, seal = self._reserve(message, flags)
+                body = await get_crypto_executor().run(seal) if offload else seal()
+                if prev is not None and not prev.done():
+                    await prev
+                self._emit(header, body)
+            except BaseException:
+                self.close() # A reserved nonce never reached the wire: the tunnel is unusable
+                raise
+            finally:
+                turn.set_result(None)
+                if self._last_turn is turn:
+                    self._last_turn = None
+        self.uncork()
+        await self.writer.drain()
+
+    async def read_message(self) -> bytes:
+        """Reads exactly one frame. Raises IncompleteReadError if the peer hangs up mid-frame."""
+        header = await self.reader.readexactly(4)
+        if self.version >= 2:
+            length = int.from_bytes(header, 'big') & 0xFFFFFF
+            body = await self.reader.readexactly(length)
+            nonce = self.cipher.next_recv_nonce()
+            if get_crypto_executor().should_offload(length):
+                plain = await get_crypto_executor().run(self.cipher.aesgcm.decrypt, nonce, body, header)
+            else:
+                plain = self.cipher.aesgcm.decrypt(nonce, body, header)
+            if header[0] & COMPRESSED_FLAGS:
+                return decompress(plain, header[0])
+            return plain
+        encrypted = await self.reader.readexactly(int.from_bytes(header, 'big'))
+        if get_crypto_executor().should_offload(len(encrypted)):
+            return await get_crypto_executor().run(self.cipher.decrypt, encrypted)
+        return self.cipher.decrypt(encrypted)
+
+    def close(self):
+        try: self.writer.close()
+        except Exception: pass
+
+
+def negotiate_version(local_features, peer_features) -> int:
+    return 2 if 'v2' in local_features and 'v2' in peer_features else 1
+
+
+def local_features(is_client: bool) -> set:
+    """Features we advertise in our hello, according to Config."""
+    features = set() if is_client else {'mux'}
+    if Config.COMPACT_HANDSHAKE and not is_client:
+        features.add('x25519') # Clients know compact hellos as soon as they see this
+    if Config.SESSION_TICKETS:
+        features.add('resume')
+    if Config.WIRE_V2:
+        features.add('v2')
+        features |= codec_features()
+    return features
+
+
+def pack_resume(nonce: bytes, ticket: bytes, fields=None) -> bytes:
+    """Resumption hello: MAGIC + client nonce (16) + ticket length (2) + ticket + fields."""
+    message = RESUME_MAGIC + nonce + len(ticket).to_bytes(2, 'big') + ticket
+    if fields:
+        message += "".join(f"{key}: {value}\n" for key, value in fields.items()).encode()
+    return message
+
+
+def parse_resume(data: bytes):
+    """Returns (client nonce, ticket, fields) from a resumption hello."""
+    body = data[len(RESUME_MAGIC):]
+    nonce = body[:RESUME_NONCE_SIZE]
+    ticket_len = int.from_bytes(body[RESUME_NONCE_SIZE:RESUME_NONCE_SIZE + 2], 'big')
+    ticket_start = RESUME_NONCE_SIZE + 2
+    ticket = body[ticket_start:ticket_start + ticket_len]
+    _, fields = parse_hello(PEM_END + body[ticket_start + ticket_len:])
+    return nonce, ticket, fields
+
+
+def new_resume_nonce() -> bytes:
+    return os.urandom(RESUME_NONCE_SIZE)
+
+
+def format_target(host: str, port: int) -> str:
+    """"host:port", with IPv6 literals in brackets ("[2001:db8::1]:443")."""
+    if ':' in host:
+        return f"[{host}]:{port}"
+    return f"{host}:{port}"
+
+
+def parse_target(target: str):
+    """Inverse of format_target. Returns (host, port)."""
+    if target.startswith('['):
+        host, sep, port = target[1:].partition(']:')
+        if not sep:
+            raise ValueError(f"Bad target {target!r}")
+        return host, int(port)
+    host, _, port = target.rpartition(':')
+    return host, int(port)
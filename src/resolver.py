@@ -0,0 +1,156 @@
+import asyncio
+import ipaddress
+import socket
+import time
+from collections import OrderedDict
+from config import Config
+from metrics import DNS_LOOKUPS
+
+# Server-side name resolution and connection racing.
+# getaddrinfo runs on the default thread pool and carries no TTL, so answers are cached
+# for Config.DNS_TTL seconds (failures for DNS_NEGATIVE_TTL) in a bounded LRU, and
+# concurrent lookups of the same name share one query.
+
+
+class DNSCache:
+    def __init__(self, ttl=None, negative_ttl=None, max_entries=None):
+        self.ttl = Config.DNS_TTL if ttl is None else ttl
+        self.negative_ttl = Config.DNS_NEGATIVE_TTL if negative_ttl is None else negative_ttl
+        self.max_entries = Config.DNS_CACHE_SIZE if max_entries is None else max_entries
+        self._entries = OrderedDict() # (host, port) -> (expires, addresses or gaierror)
+        self._pending = {} # (host, port) -> Future of an in-flight lookup
+
+    async def resolve(self, host, port):
+        """Returns [(family, sockaddr), ...] for host, raising socket.gaierror on failure."""
+        try:
+            ip = ipaddress.ip_address(host)
+        except ValueError:
+            pass
+        else:
+            family = socket.AF_INET6 if ip.version == 6 else socket.AF_INET
+            return [(family, (host, port))]
+
+        key = (host.lower(), port)
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires, result = entry
+            if expires > time.monotonic():
+                self._entries.move_to_end(key)
+                if isinstance(result, Exception):
+                    DNS_LOOKUPS.labels('negative').inc()
+                    raise socket.gaierror(*result.args)
+                DNS_LOOKUPS.labels('hit').inc()
+                return result
+            del self._entries[key]
+
+        pending = self._pending.get(key)
+        if pending is not None:
+            DNS_LOOKUPS.labels('shared').inc()
+            return await asyncio.shield(pending)
+
+        DNS_LOOKUPS.labels('miss').inc()
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        try:
+            infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+            result = [(family, sockaddr) for family, _, _, _, sockaddr in infos]
+            self._store(key, result, self.ttl)
+            future.set_result(result)
+            return result
+        except socket.gaierror as e:
+            self._store(key, e, self.negative_ttl)
+            future.set_exception(e)
+            future.exception() # Marks it retrieved when nobody else was waiting
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()
+            raise
+        finally:
+            del self._pending[key]
+
+    def _store(self, key, result, ttl):
+        if ttl <= 0:
+            return
+        self._entries[key] = (time.monotonic() + ttl, result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+def interleave(addresses):
+    """RFC 8305 ordering: alternate address families, starting with the first one returned."""
+    if not addresses:
+        return []
+    first = addresses[0][0]
+    primary = [a for a in addresses if a[0] == first]
+    secondary = [a for a in addresses if a[0] != first]
+    ordered = []
+    for i in range(max(len(primary), len(secondary))):
+        ordered.extend(group[i] for group in (primary, secondary) if i < len(group))
+    return ordered
+
+
+async def _connect_one(family, sockaddr):
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.setblocking(False)
+        await asyncio.get_running_loop().sock_connect(sock, sockaddr)
+        return sock
+    except BaseException:
+        sock.close()
+        raise
+
+
+async def happy_eyeballs(addresses, delay=None):
+    """
+    Races connection attempts: the next address starts when the previous one fails or
+    after `delay` seconds, whichever is first. Returns the first connected socket and
+    closes the rest. Raises the last error if every attempt fails.
+    """
+    delay = Config.HAPPY_EYEBALLS_DELAY if delay is None else delay
+    addresses = interleave(addresses)
+    if not addresses:
+        raise OSError("No addresses to connect to")
+
+    attempts = set()
+    winner = None
+    error = None
+    pending = list(addresses)
+    try:
+        while pending or attempts:
+            if pending:
+                attempts.add(asyncio.ensure_future(_connect_one(*pending.pop(0))))
+            done, _ = await asyncio.wait(attempts, timeout=delay if pending else None,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                attempts.discard(task)
+                if task.exception() is None:
+                    if winner is None:
+                        winner = task.result()
+                    else:
+                        task.result().close()
+                else:
+                    error = task.exception()
+            if winner is not None:
+                return winner
+        raise error
+    finally:
+        for task in attempts:
+            task.cancel()
+        if attempts:
+            await asyncio.wait(attempts)
+            for task in attempts:
+                if not task.cancelled() and task.exception() is None and task.result() is not winner:
+                    task.result().close()
+
+
+async def open_connection(cache, host, port, timeout=None):
+    """asyncio.open_connection through the DNS cache and Happy Eyeballs, bounded by timeout."""
+    timeout = Config.CONNECT_TIMEOUT if timeout is None else timeout
+
+    async def connect():
+        sock = await happy_eyeballs(await cache.resolve(host, port))
+        return await asyncio.open_connection(sock=sock)
+
+    return await asyncio.wait_for(connect(), timeout)
@@ -0,0 +1,235 @@
+import asyncio
+import ipaddress
+import logging
+import os
+import socket
+from config import Config
+from metrics import ROUTE_DECISIONS
+
+# Client-side routing rules: which SOCKS CONNECT targets go through the tunnel, straight
+# to the destination, or nowhere. The rule file has one rule per line, '#' starts a comment:
+#
+#     direct  192.168.0.0/16     # CIDR ranges match IP targets (v4 or v6)
+#     direct  lan                # Domains match the name and every subdomain
+#     block   ads.example.com
+#     tunnel  cdn.ads.example.com
+#     direct  *                  # Catch-all (default: Config.ROUTE_DEFAULT)
+#
+# The most specific rule wins: the longest domain suffix or the longest network prefix.
+# Domains are compiled into a trie keyed by reversed labels and networks into one table per
+# prefix length, so a lookup costs one step per label (or per prefix length in use), however
+# many rules there are. Domain targets are matched by name only; they are never resolved
+# here to test CIDR rules, which would leak the lookup outside the tunnel.
+# The file is polled and recompiled off the event loop when it changes; connections that are
+# already open keep the route they were given, and hit counts survive the reload.
+
+ACTIONS = ('tunnel', 'direct', 'block')
+
+_RULE = '' # Trie key holding the rule of a node (labels are never empty)
+_V4_MAPPED = 0xFFFF << 32 # ::ffff:0:0/96
+
+
+class Rule:
+    __slots__ = ('action', 'pattern', 'line', 'hits', '_counter')
+
+    def __init__(self, action, pattern, line=0):
+        self.action = action
+        self.pattern = pattern
+        self.line = line # Line in the rule file (0 = built-in default)
+        self.hits = 0
+        self._counter = ROUTE_DECISIONS.labels(action)
+
+    def hit(self):
+        self.hits += 1
+        self._counter.inc()
+
+    def __repr__(self):
+        return f"{self.action} {self.pattern}"
+
+
+def _network(pattern):
+    """The ip_network a pattern names, or None for a domain."""
+    if '/' not in pattern and ':' not in pattern and not pattern[-1:].isdigit():
+        return None
+    try:
+        return ipaddress.ip_network(pattern, strict=False)
+    except ValueError:
+        return None
+
+
+class RuleTable:
+    """Compiled, read-only form of a rule list. Build a new one to change the rules."""
+    def __init__(self, rules, default):
+        self.rules = rules
+        self.default = default
+        self.domains = {}
+        self.networks = {4: {}, 6: {}} # version -> prefix length -> network bits -> Rule
+        for rule in rules:
+            if rule.pattern == '*':
+                if self.default is default: # First catch-all wins, like every other pattern
+                    self.default = rule
+                continue
+            network = _network(rule.pattern)
+            if network is None:
+                node = self.domains
+                for label in reversed(rule.pattern.split('.')):
+                    node = node.setdefault(label, {})
+                node.setdefault(_RULE, rule) # First rule for a pattern wins
+            else:
+                by_length = self.networks[network.version].setdefault(network.prefixlen, {})
+                by_length.setdefault(int(network.network_address) >> (network.max_prefixlen - network.prefixlen), rule)
+        # Longest prefix first
+        self.prefix_lengths = {version: sorted(tables, reverse=True) for version, tables in self.networks.items()}
+
+    def lookup(self, host) -> Rule:
+        if ':' in host:
+            try:
+                bits = int.from_bytes(socket.inet_pton(socket.AF_INET6, host.strip('[]')), 'big')
+            except OSError:
+                pass
+            else:
+                if bits >> 32 == _V4_MAPPED >> 32:
+                    return self.lookup_ip(4, bits & 0xFFFFFFFF)
+                return self.lookup_ip(6, bits)
+        elif host[-1:].isdigit(): # Top-level domains never end in a digit
+            try:
+                return self.lookup_ip(4, int.from_bytes(socket.inet_pton(socket.AF_INET, host), 'big'))
+            except OSError:
+                pass
+        return self.lookup_domain(host)
+
+    def lookup_domain(self, host) -> Rule:
+        node = self.domains
+        rule = self.default
+        for label in reversed(host.lower().rstrip('.').split('.')):
+            node = node.get(label)
+            if node is None:
+                break
+            rule = node.get(_RULE, rule)
+        return rule
+
+    def lookup_ip(self, version, bits) -> Rule:
+        """Longest-prefix match of an address given as an integer."""
+        width = 32 if version == 4 else 128
+        tables = self.networks[version]
+        for length in self.prefix_lengths[version]:
+            rule = tables[length].get(bits >> (width - length))
+            if rule is not None:
+                return rule
+        return self.default
+
+
+def parse_rules(text) -> list:
+    """Parses rule file text into Rules. Raises ValueError naming the first bad line."""
+    rules = []
+    for number, line in enumerate(text.splitlines(), 1):
+        fields = line.split('#', 1)[0].split()
+        if not fields:
+            continue
+        if len(fields) != 2 or fields[0].lower() not in ACTIONS:
+            raise ValueError(f"line {number}: expected '<{'|'.join(ACTIONS)}> <domain, CIDR or *>', got {line.strip()!r}")
+        action, pattern = fields[0].lower(), fields[1].lower()
+        if pattern != '*':
+            network = _network(pattern)
+            if network is not None:
+                pattern = str(network)
+            else:
+                pattern = pattern.lstrip('*').strip('.')
+                if not pattern or '' in pattern.split('.') or '/' in pattern:
+                    raise ValueError(f"line {number}: {fields[1]!r} is neither a domain nor a CIDR range")
+        rules.append(Rule(action, pattern, number))
+    return rules
+
+
+class Router:
+    """
+    Routing decisions for the client. route() is a dictionary walk on the current RuleTable;
+    a background task swaps in a new table when the rule file changes. A missing file means
+    no rules: everything takes Config.ROUTE_DEFAULT. A file that fails to parse is reported
+    and the previous rules stay in force.
+    """
+    def __init__(self, path=None, interval=None):
+        self.path = Config.ROUTE_RULES_FILE if path is None else path
+        self.interval = Config.ROUTE_RELOAD_INTERVAL if interval is None else interval
+        self.table = RuleTable([], Rule(Config.ROUTE_DEFAULT, '*'))
+        self.loads = 0
+        self.load_errors = 0
+        self._stamp = None # (mtime, size) of the file the table was built from
+        self._task = None
+        self.apply(self._read())
+
+    def route(self, host) -> Rule:
+        rule = self.table.lookup(host)
+        rule.hit()
+        return rule
+
+    def _read(self):
+        """Returns (stamp, compiled table or the parse error), or None if the file is unchanged."""
+        try:
+            st = os.stat(self.path)
+            stamp = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            stamp = None
+        if stamp == self._stamp:
+            return None
+        if stamp is None:
+            return None, RuleTable([], Rule(Config.ROUTE_DEFAULT, '*'))
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                return stamp, RuleTable(parse_rules(f.read()), Rule(Config.ROUTE_DEFAULT, '*'))
+        except (OSError, UnicodeDecodeError, ValueError) as e:
+            return stamp, e
+
+    def apply(self, result) -> bool:
+        """Installs a table built by _read(). True if the rules changed."""
+        if result is None:
+            return False
+        stamp, table = result
+        self._stamp = stamp
+        if isinstance(table, Exception):
+            self.load_errors += 1
+            logging.error(f"Routing rules {self.path} not loaded, keeping the previous ones: {table}")
+            return False
+        # Counts carry over to rules that are still there
+        previous = {(rule.action, rule.pattern): rule.hits for rule in self.table.rules + [self.table.default]}
+        for rule in table.rules + [table.default]:
+            rule.hits = previous.get((rule.action, rule.pattern), 0)
+        self.table = table
+        self.loads += 1
+        if stamp is not None:
+            logging.info(f"Loaded {len(table.rules)} routing rules from {self.path} (default: {table.default.action})")
+        return True
+
+    async def reload(self) -> bool:
+        """Re-reads the rule file if it changed, compiling it on the default executor."""
+        return self.apply(await asyncio.get_running_loop().run_in_executor(None, self._read))
+
+    def start(self):
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.ensure_future(self._poll())
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.reload()
+            except Exception as e:
+                logging.error(f"Routing rules reload failed: {e}")
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def rule_hits(self) -> list:
+        """[(line, rule text, hits), ...] in file order, the default rule last."""
+        return [(rule.line, repr(rule), rule.hits) for rule in self.table.rules + [self.table.default]]
+
+    def stats(self) -> dict:
+        hits = {action: 0 for action in ACTIONS}
+        for rule in self.table.rules + [self.table.default]:
+            hits[rule.action] += rule.hits
+        stats = {f'routed_{action}': n for action, n in hits.items()}
+        stats.update({'route_rules': len(self.table.rules), 'route_loads': self.loads,
+                      'route_load_errors': self.load_errors})
+        return stats
@@ -0,0 +1,229 @@
+import asyncio
+import time
+from collections import deque
+from config import Config
+from metrics import SHAPING_DELAY
+
+# Traffic shaping and fair scheduling, shared by client and server.
+# Every proxied connection gets a Flow from its role's TrafficShaper. Forwarders call
+# flow.pace() with each chunk they move: it draws from token buckets for the connection, its
+# destination host and the whole process (each per direction), sleeps off any debt, and
+# yields to the event loop after Config.SCHED_YIELD_BYTES so one busy forwarder cannot hold
+# the loop while others have data waiting. Delaying a read is what throttles the sender:
+# TCP (or the mux window) pushes back.
+# Mux streams share a tunnel; their DATA frames go through a FairQueue (deficit round robin)
+# whose weights come from the flow's priority class. A class is picked by destination port,
+# and flows that have moved Config.SCHED_BULK_AFTER bytes drop to 'bulk', so short
+# interactive exchanges get through between the frames of a large transfer.
+
+UP = 0 # Towards the target (browser -> target)
+DOWN = 1 # Towards the browser
+
+
+class TokenBucket:
+    """rate bytes/s with up to burst bytes banked. Takes tokens into debt and reports how long to wait it off."""
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def take(self, n, now) -> float:
+        """Takes n tokens; returns the seconds until the bucket is out of debt."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= n
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+def _bucket_pair(rate):
+    """(up, down) buckets for rate bytes/s, or None when unlimited."""
+    if rate <= 0:
+        return None
+    burst = rate * Config.SHAPE_BURST
+    return TokenBucket(rate, burst), TokenBucket(rate, burst)
+
+
+class Flow:
+    """Scheduling state of one proxied connection."""
+    __slots__ = ('shaper', 'host', 'cls', 'weight', 'moved', 'unyielded', 'buckets')
+
+    def __init__(self, shaper, host, cls):
+        self.shaper = shaper
+        self.host = host
+        self.cls = cls
+        self.weight = Config.SCHED_CLASSES.get(cls, 1)
+        self.moved = 0
+        self.unyielded = 0 # Bytes moved since the last pace() that waited
+        self.buckets = [pair for pair in (_bucket_pair(Config.SHAPE_STREAM_RATE), shaper.dest_buckets(host),
+                                          shaper.global_buckets) if pair is not None]
+
+    async def pace(self, n, direction):
+        """Accounts n bytes moved in direction; waits while a rate limit is exceeded."""
+        self.moved += n
+        if self.cls != 'bulk' and Config.SCHED_BULK_AFTER and self.moved >= Config.SCHED_BULK_AFTER:
+            self.cls = 'bulk'
+            self.weight = Config.SCHED_CLASSES.get('bulk', 1)
+            self.shaper.demotions += 1
+        delay = 0.0
+        if self.buckets:
+            now = time.monotonic()
+            for pair in self.buckets:
+                delay = max(delay, pair[direction].take(n, now))
+        if delay > 0:
+            self.shaper.delayed += delay
+            SHAPING_DELAY.labels(self.shaper.role, 'up' if direction == UP else 'down').inc(delay)
+            self.unyielded = 0
+            await asyncio.sleep(delay)
+            return
+        self.unyielded += n
+        if self.unyielded >= Config.SCHED_YIELD_BYTES:
+            self.unyielded = 0
+            await asyncio.sleep(0) # Let other connections' callbacks run
+
+    def close(self):
+        self.shaper.release(self.host)
+
+
+class TrafficShaper:
+    """Hands out Flows and owns the buckets they share: one pair per destination host and one for the process."""
+    def __init__(self, role):
+        self.role = role
+        self.global_buckets = _bucket_pair(Config.SHAPE_GLOBAL_RATE)
+        self._dests = {} # host -> [bucket pair, flows using it]
+        self.flows = 0
+        self.demotions = 0
+        self.delayed = 0.0 # Seconds forwarders spent waiting on rate limits
+
+    @property
+    def shaping(self) -> bool:
+        """True if any rate limit is configured."""
+        return bool(Config.SHAPE_GLOBAL_RATE > 0 or Config.SHAPE_DEST_RATE > 0 or Config.SHAPE_STREAM_RATE > 0)
+
+    def open(self, host, port) -> Flow:
+        self.flows += 1
+        return Flow(self, host, Config.SCHED_PORT_CLASSES.get(port, 'default'))
+
+    def dest_buckets(self, host):
+        if Config.SHAPE_DEST_RATE <= 0:
+            return None
+        entry = self._dests.get(host)
+        if entry is None:
+            entry = self._dests[host] = [_bucket_pair(Config.SHAPE_DEST_RATE), 0]
+        entry[1] += 1
+        return entry[0]
+
+    def release(self, host):
+        self.flows -= 1
+        entry = self._dests.get(host)
+        if entry is not None:
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del self._dests[host] # Nobody is connected to it any more
+
+    def stats(self) -> dict:
+        return {'shaped_flows': self.flows, 'bulk_demotions': self.demotions, 'shaping_delay_s': round(self.delayed, 3)}
+
+
+class FairQueue:
+    """
+    Orders frames of many flows onto one sender: control frames first, then DATA by deficit
+    round robin, each flow getting Config.SCHED_QUANTUM * its weight in bytes per round.
+    put() returns once its frame was sent, so a flow never has more than one frame waiting
+    and backpressure reaches each writer separately. Up to `concurrency` sends run at once
+    (frames sealed on crypto workers in parallel); while that leaves room, frames go straight
+    through without queuing.
+    """
+    def __init__(self, send, concurrency=1):
+        self.send = send # async (frame) -> None
+        self.concurrency = max(1, concurrency)
+        self._urgent = deque() # (frame, future)
+        self._queues = {} # flow -> deque of (frame, future)
+        self._round = deque() # Flows with frames queued, in visiting order
+        self._deficit = {}
+        self._inflight = 0
+        self._failed = None
+        self._tasks = set()
+
+    async def put(self, frame, flow=None):
+        """Sends frame. Without a flow it is a control frame and goes ahead of all DATA."""
+        if self._failed is not None:
+            raise self._failed
+        if self._inflight < self.concurrency and not self._urgent and not self._round:
+            self._inflight += 1
+            try:
+                await self.send(frame)
+            except Exception as e:
+                self._fail(e)
+                raise
+            finally:
+                self._inflight -= 1
+                self._dispatch()
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        if flow is None:
+            self._urgent.append((frame, waiter))
+        else:
+            queue = self._queues.get(flow)
+            if queue is None:
+                queue = self._queues[flow] = deque()
+                self._round.append(flow)
+                self._deficit[flow] = 0
+            queue.append((frame, waiter))
+        await waiter
+
+    def _next(self):
+        if self._urgent:
+            return self._urgent.popleft()
+        while True:
+            flow = self._round[0]
+            queue = self._queues[flow]
+            frame_size = len(queue[0][0])
+            if self._deficit[flow] >= frame_size:
+                self._deficit[flow] -= frame_size
+                entry = queue.popleft()
+                if not queue:
+                    self._round.popleft()
+                    del self._queues[flow], self._deficit[flow] # An idle flow banks no credit
+                return entry
+            self._deficit[flow] += Config.SCHED_QUANTUM * flow.weight
+            if self._deficit[flow] < frame_size:
+                self._round.rotate(-1) # Not enough yet: next flow's turn
+
+    def _dispatch(self):
+        while self._inflight < self.concurrency and (self._urgent or self._round):
+            frame, waiter = self._next()
+            if waiter.cancelled():
+                continue # Its writer is gone
+            self._inflight += 1
+            task = asyncio.ensure_future(self._send_queued(frame, waiter))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send_queued(self, frame, waiter):
+        try:
+            await self.send(frame)
+        except Exception as e:
+            if not waiter.done():
+                waiter.set_exception(e)
+            self._fail(e)
+        else:
+            if not waiter.done():
+                waiter.set_result(None)
+        finally:
+            self._inflight -= 1
+            self._dispatch()
+
+    def _fail(self, exc):
+        """The sender is broken (tunnel gone): fail every waiting frame."""
+        self._failed = exc
+        for queue in [self._urgent, *self._queues.values()]:
+            for _, waiter in queue:
+                if not waiter.done():
+                    waiter.set_exception(exc)
+        self._urgent.clear()
+        self._queues.clear()
+        self._round.clear()
+        self._deficit.clear()
@@ -1,157 +1,413 @@
 import asyncio
 import logging
-import urllib.request
+import time
 from config import Config
-from encryption import TunnelEncryption, ECDHKeyExchange
+from admission import AdmissionControl, BUDGET, set_water_marks
+from ipmonitor import PublicIPMonitor
+from lifecycle import Lifecycle
+from logpipe import CONN_LOG, ERROR_LOG, setup_logging
+from eventloop import BACKENDS, current_backend, listen_options, run, tune_listener, tune_socket
+from encryption import SessionTicketManager, derive_resumption_secret, derive_resumed_key
+from coalesce import FrameCoalescer
+from cryptopool import get_key_pool
+from dataplane import relay_buffered
+from metrics import (HANDSHAKE_SECONDS, CONNECT_SECONDS, CONNECTIONS_ACTIVE, ERRORS, connect_error_kind,
+                     start_metrics_server)
+from mux import MuxSession, MUX_HELLO, MUX_ACCEPT
+from protocol import (Tunnel, pack_hello, parse_hello, parse_compact_hello, parse_features, parse_resume,
+                      new_resume_nonce, local_features, negotiate_version, parse_target, RESUME_MAGIC, RESUME_OK,
+                      TICKET_PREFIX, X25519_MAGIC)
+from resolver import DNSCache, open_connection
+from scheduler import TrafficShaper, UP, DOWN
+from udprelay import UdpRelayServer, UDP_HELLO, UDP_ACCEPT
 
-logging.basicConfig(level=Config.get_log_level(), format='%(asctime)s - [SERVER] - %(message)s')
+setup_logging('SERVER')
 
 class ShadowServer:
-    def __init__(self, strict_mode=False, safe_isp_ip=None):
+    def __init__(self, strict_mode=False, safe_isp_ip=None, ip_sources=None):
         self.strict_mode = strict_mode
         self.safe_isp_ip = safe_isp_ip
+        self.tickets = SessionTicketManager(Config.TICKET_LIFETIME, Config.TICKET_MAX_USES)
+        self.ip_monitor = PublicIPMonitor(safe_isp_ip, sources=ip_sources) if strict_mode else None
+        self.dns = DNSCache()
+        self.udp = UdpRelayServer(self) if Config.UDP_RELAY else None
+        self.admission = AdmissionControl('server')
+        self.lifecycle = Lifecycle('server')
+        self.shaper = TrafficShaper('server') # Rate limits and fair shares of the mux tunnels
+        self.connections_total = 0
+        self.connections_active = 0
+        self.connections_rejected = 0
 
-    def get_public_ip(self):
-        try:
-            return urllib.request.urlopen('https://api.ipify.org', timeout=3).read().decode('utf8')
-        except Exception:
-            return None
+    def handshake_stats(self):
+        """Full vs. resumed handshake counters since the server started."""
+        return {
+            'full': self.tickets.full_handshakes,
+            'resumed': self.tickets.resumed_handshakes,
+            'rejected': self.tickets.rejected_tickets,
+            'resumption_ratio': self.tickets.resumption_ratio(),
+        }
+
+    def stats(self):
+        """Counters reported to the worker supervisor (and anything else that asks)."""
+        stats = {
+            'connections_total': self.connections_total,
+            'connections_active': self.connections_active,
+            'connections_rejected': self.connections_rejected,
+        }
+        stats.update(self.handshake_stats())
+        stats.update(self.admission.stats())
+        stats.update(self.lifecycle.stats())
+        stats.update(self.shaper.stats())
+        return stats
 
     def check_safety(self):
+        """Strict Mode admission gate. The verdict is kept fresh by the background IP monitor."""
         if not self.strict_mode:
             return True
-        
-        current_ip = self.get_public_ip()
-        if not current_ip:
-            logging.warning("Could not determine Public IP. Blocking traffic in Strict Mode.")
-            return False
-            
-        if current_ip == self.safe_isp_ip:
-            logging.critical(f"SECURITY ALERT: VPN DOWN! Current IP ({current_ip}) matches ISP IP. Blocking traffic.")
-            return False
-        
-        return True
+        return self.ip_monitor.is_safe()
 
     async def handle_client(self, reader, writer):
         addr = writer.get_extra_info('peername')
-        logging.info(f"New connection from {addr}")
+        CONN_LOG.info("New connection from %s", addr)
+        tune_socket(writer)
 
         # 1. Kill Switch / Strict Mode Check
         if not self.check_safety():
-            logging.error("Connection rejected due to Strict Mode violation.")
+            ERROR_LOG.error("Connection rejected due to Strict Mode violation.")
+            self.connections_rejected += 1
+            ERRORS.labels('server', 'strict_mode').inc()
             writer.close()
             await writer.wait_closed()
             return
 
+        # 2. Admission: bounded concurrency and memory
+        if not await self.admission.admit():
+            ERROR_LOG.warning("Connection from %s refused: connection limit or memory budget reached", addr)
+            self.connections_rejected += 1
+            writer.close()
+            return
+
+        self.connections_total += 1
+        self.connections_active += 1
+        CONNECTIONS_ACTIVE.labels('server').inc()
+        conn = self.lifecycle.open('tunnel', addr, deadline=Config.HANDSHAKE_TIMEOUT,
+                                   idle_timeout=Config.TUNNEL_IDLE_TIMEOUT)
+        conn.add_writer(writer)
+        tunnel = None
+        flow = None
         try:
-            # 2. Key Exchange (ECDH)
-            # Generate our ephemeral key pair
-            server_ecdh = ECDHKeyExchange()
-            server_pub = server_ecdh.get_public_bytes()
-            
-            # Send our public key
-            writer.write(len(server_pub).to_bytes(4, 'big'))
-            writer.write(server_pub)
-            await writer.drain()
-            
-            # Read client's public key
-            len_bytes = await reader.read(4)
-            if not len_bytes: return
-            client_pub_len = int.from_bytes(len_bytes, 'big')
-            client_pub_bytes = await reader.read(client_pub_len)
-            
-            # Derive shared session key (AES-256)
-            shared_key = server_ecdh.derive_shared_key(client_pub_bytes)
-            cipher = TunnelEncryption(shared_key)
-            logging.info(f"Secure Tunnel Established with {addr} (AES-256)")
+            # 3. Key Exchange (ECDH)
+            started = time.monotonic()
+            try:
+                tunnel = await self.perform_handshake(reader, writer)
+            except Exception:
+                ERRORS.labels('server', 'handshake').inc()
+                raise
+            HANDSHAKE_SECONDS.labels('server', 'resumed' if tunnel.resumed else 'full').observe(time.monotonic() - started)
+            conn.established() # Pooled tunnels now wait for their request, up to TUNNEL_IDLE_TIMEOUT
+            CONN_LOG.info("Secure Tunnel Established with %s (AES-256%s)", addr, ', resumed' if tunnel.resumed else '')
 
-            # 3. Handle Encrypted Traffic
+            # 4. Handle Encrypted Traffic
             # We expect the first message to be the Target Host info
             # Protocol: [Length 4][Encrypted Data]
-            # Encrypted Data Decrypts to: "HOST:PORT"
+            # Encrypted Data Decrypts to: "HOST:PORT" (or MUX_HELLO for a multiplexed tunnel)
             
             # Read encrypted target info
-            len_bytes = await reader.read(4)
-            if not len_bytes: return
-            enc_len = int.from_bytes(len_bytes, 'big')
-            encrypted_data = await reader.read(enc_len)
-            
-            target_info_bytes = cipher.decrypt(encrypted_data)
+            target_info_bytes = await tunnel.read_message()
+            if target_info_bytes == MUX_HELLO:
+                await self.handle_mux(tunnel, addr, conn)
+                return
+            if target_info_bytes == UDP_HELLO:
+                await self.handle_udp(tunnel, addr, conn)
+                return
             target_info = target_info_bytes.decode()
             
-            remote_host, remote_port_str = target_info.split(':')
-            remote_port = int(remote_port_str)
+            remote_host, remote_port = parse_target(target_info)
             
-            logging.info(f"Forwarding to {remote_host}:{remote_port}")
+            CONN_LOG.info("Forwarding to %s", target_info)
             
             try:
-                remote_reader, remote_writer = await asyncio.open_connection(remote_host, remote_port)
+                remote_reader, remote_writer = await self.connect_target(remote_host, remote_port)
             except Exception as e:
-                logging.error(f"Failed to connect to target: {e}")
+                ERROR_LOG.error("Failed to connect to target: %s", e)
                 # Send Encrypted Failure? Or just close.
-                writer.close()
                 return
+            conn.add_writer(remote_writer)
+            conn.label = target_info
+            conn.established(idle_timeout=Config.IDLE_TIMEOUT)
+            flow = self.shaper.open(remote_host, remote_port)
 
             # Confirm connection to client (Encrypted "OK")
-            encrypted_ok = cipher.encrypt(b"OK")
-            writer.write(len(encrypted_ok).to_bytes(4, 'big'))
-            writer.write(encrypted_ok)
-            await writer.drain()
+            await tunnel.send_message(b"OK")
 
             # Pipe data
+            if Config.DATA_PLANE == 'buffered' and tunnel.version >= 2 and not tunnel.compressor and not self.shaper.shaping:
+                await relay_buffered(remote_reader, remote_writer, tunnel, on_sent=conn.touch, on_received=conn.touch)
+                return
+
             await asyncio.gather(
-                self.forward_decrypt(reader, remote_writer, cipher),
-                self.forward_encrypt(remote_reader, writer, cipher)
+                self.forward_decrypt(tunnel, remote_writer, conn, flow),
+                self.forward_encrypt(remote_reader, tunnel, conn, flow)
             )
 
         except Exception as e:
-            logging.error(f"Error handling client {addr}: {e}")
+            ERROR_LOG.error("Error handling client %s: %s", addr, e)
         finally:
-            writer.close()
+            if tunnel and not writer.is_closing():
+                tunnel.uncork() # No reply after all: still let the client see its ticket / RESUME_OK
+            if flow:
+                flow.close()
+            self.connections_active -= 1
+            CONNECTIONS_ACTIVE.labels('server').dec()
+            conn.close()
+            self.admission.release()
+
+    async def perform_handshake(self, reader, writer):
+        """
+        Runs the server side of the handshake and returns the keyed Tunnel.
+        The client answers our hello with its key (PEM, or raw in a compact hello) for a full
+        ECDH handshake, or with a resumption ticket. Our RESUME_OK or ticket is held back until
+        the first reply, so the client gets both in one flight.
+        """
+        # Take an ephemeral key pair the pool generated in the background
+        server_ecdh = get_key_pool().take()
+        server_nonce = new_resume_nonce()
+        features = local_features(is_client=False)
+        fields = {'Features': ' '.join(sorted(features)), 'Nonce': server_nonce.hex()}
+        server_hello = pack_hello(server_ecdh.get_public_bytes(), fields)
+        
+        # Send our public key
+        writer.write(len(server_hello).to_bytes(4, 'big') + server_hello)
+        await writer.drain()
+        
+        # Read client's public key (or ticket)
+        len_bytes = await reader.readexactly(4)
+        client_hello_len = int.from_bytes(len_bytes, 'big')
+        client_hello = await reader.readexactly(client_hello_len)
+
+        if client_hello.startswith(RESUME_MAGIC):
+            client_nonce, ticket, client_fields = parse_resume(client_hello)
+            secret = self.tickets.redeem(ticket) if Config.SESSION_TICKETS else None
+            if secret is None:
+                ERRORS.labels('server', 'ticket_rejected').inc()
+                raise ValueError("Invalid or expired resumption ticket")
+            peer_features = parse_features(client_fields)
+            tunnel = Tunnel(reader, writer, derive_resumed_key(secret, client_nonce, server_nonce), is_client=False,
+                            version=negotiate_version(features, peer_features), resumed=True,
+                            peer_features=peer_features)
+            tunnel.cork() # Goes out with our first reply
+            tunnel.write_message(RESUME_OK)
+            return tunnel
+        
+        # Derive shared session key (AES-256)
+        if client_hello.startswith(X25519_MAGIC):
+            client_pub_bytes, client_fields = parse_compact_hello(client_hello)
+        else:
+            client_pub_bytes, client_fields = parse_hello(client_hello)
+        shared_key = server_ecdh.derive_shared_key(client_pub_bytes)
+        peer_features = parse_features(client_fields)
+        tunnel = Tunnel(reader, writer, shared_key, is_client=False, version=negotiate_version(features, peer_features),
+                        peer_features=peer_features)
+
+        self.tickets.full_handshakes += 1
+        if Config.SESSION_TICKETS and 'resume' in peer_features:
+            sealed = self.tickets.issue(derive_resumption_secret(shared_key))
+            tunnel.cork() # Goes out with our first reply
+            tunnel.write_message(TICKET_PREFIX + self.tickets.lifetime.to_bytes(4, 'big')
+                                 + self.tickets.max_uses.to_bytes(4, 'big') + sealed)
+        return tunnel
+
+    async def handle_mux(self, tunnel, addr, conn):
+        """Serves a long-lived multiplexed tunnel until the client drops it or leaves it unused."""
+        await tunnel.send_message(MUX_ACCEPT)
+
+        CONN_LOG.info("Multiplexed tunnel with %s", addr)
+        session = MuxSession(tunnel, on_open=self.handle_stream, is_client=False)
+        conn.busy = lambda: bool(session.streams) # Streams have their own idle timeouts
+        conn.add_closer(session.close)
+        await session.run()
+        CONN_LOG.info("Multiplexed tunnel with %s closed", addr)
 
-    async def forward_decrypt(self, source, dest, cipher):
+    async def handle_udp(self, tunnel, addr, conn):
+        """UDP ASSOCIATE: hands out an association and keeps it until the client drops the tunnel."""
+        if self.udp is None or self.udp.transport is None:
+            return # Client reports "command not supported"
+        association_id, key = self.udp.open_association()
+        conn.established(idle_timeout=0) # Quiet between datagrams is normal; upstream sockets expire on their own
+        CONN_LOG.info("UDP association with %s", addr)
         try:
+            await tunnel.send_message(UDP_ACCEPT + association_id + key + self.udp.port.to_bytes(2, 'big'))
             while True:
-                len_bytes = await source.read(4)
-                if not len_bytes: break
-                length = int.from_bytes(len_bytes, 'big')
-                encrypted = await source.read(length)
-                if not encrypted: break
-                
-                decrypted = cipher.decrypt(encrypted)
-                dest.write(decrypted)
-                await dest.drain()
-        except: pass
+                await tunnel.read_message()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.udp.close_association(association_id)
+            CONN_LOG.info("UDP association with %s closed", addr)
+
+    async def handle_stream(self, stream, target_info):
+        # The kill switch applies to every logical stream, not just the tunnel
+        if not self.check_safety():
+            ERROR_LOG.error("Stream rejected due to Strict Mode violation.")
+            ERRORS.labels('server', 'strict_mode').inc()
+            await stream.reset()
+            return
+        if not await self.admission.admit():
+            ERROR_LOG.warning("Stream %s refused: connection limit or memory budget reached", stream.stream_id)
+            self.connections_rejected += 1
+            await stream.reset()
+            return
+
+        conn = self.lifecycle.open('stream', target_info)
+        conn.add_closer(stream.abort)
+        flow = None
+        try:
+            remote_host, remote_port = parse_target(target_info)
+            CONN_LOG.info("Forwarding stream %s to %s", stream.stream_id, target_info)
+
+            try:
+                remote_reader, remote_writer = await self.connect_target(remote_host, remote_port)
+            except Exception as e:
+                ERROR_LOG.error("Failed to connect to target: %s", e)
+                await stream.reset()
+                return
+            conn.add_writer(remote_writer)
+            flow = stream.flow = self.shaper.open(remote_host, remote_port)
+
+            await stream.session.accept(stream)
+            await asyncio.gather(
+                self.forward_from_stream(stream, remote_writer, conn, flow),
+                self.forward_to_stream(remote_reader, stream, conn, flow)
+            )
+        except Exception as e:
+            ERROR_LOG.error("Error handling stream %s: %s", stream.stream_id, e)
         finally:
-            try: dest.close() 
-            except: pass
+            if flow:
+                flow.close()
+            conn.close()
+            self.admission.release()
+
+    async def connect_target(self, host, port):
+        """Opens the upstream connection, recording connect time or the kind of failure."""
+        started = time.monotonic()
+        try:
+            streams = await open_connection(self.dns, host, port)
+        except Exception as e:
+            ERRORS.labels('server', connect_error_kind(e)).inc()
+            raise
+        CONNECT_SECONDS.labels().observe(time.monotonic() - started)
+        set_water_marks(streams[1])
+        tune_socket(streams[1])
+        return streams
+
+    # Forwarders: a clean EOF is passed on as a half-close and the other direction keeps
+    # running; any error tears down the whole connection (both sockets and the stream).
 
-    async def forward_encrypt(self, source, dest, cipher):
+    async def forward_from_stream(self, stream, dest, conn, flow):
         try:
             while True:
-                data = await source.read(4096)
+                data = await stream.read()
                 if not data: break
-                
-                encrypted = cipher.encrypt(data)
-                dest.write(len(encrypted).to_bytes(4, 'big'))
-                dest.write(encrypted)
-                await dest.drain()
-        except: pass
-
-    async def start(self):
+                conn.touch()
+                await flow.pace(len(data), UP)
+                dest.write(data)
+                await BUDGET.hold(len(data), dest.drain())
+            conn.half_close(dest)
+        except Exception:
+            conn.close()
+
+    async def forward_to_stream(self, source, stream, conn, flow):
+        try:
+            coalescer = FrameCoalescer(source, stream.session.max_payload)
+            while True:
+                data = await coalescer.read()
+                if not data: break
+                conn.touch()
+                await flow.pace(len(data), DOWN)
+                await BUDGET.hold(len(data), stream.write(data))
+            await stream.close()
+        except Exception:
+            conn.close()
+
+    async def forward_decrypt(self, tunnel, dest, conn, flow):
+        try:
+            while True:
+                decrypted = await tunnel.read_message()
+                conn.touch()
+                await flow.pace(len(decrypted), UP)
+                dest.write(decrypted)
+                await BUDGET.hold(len(decrypted), dest.drain())
+        except asyncio.IncompleteReadError as e:
+            # A tunnel closed between frames is the client's half-close: the browser is done sending
+            if e.partial: conn.close()
+            else: conn.half_close(dest)
+        except Exception:
+            conn.close()
+
+    async def forward_encrypt(self, source, tunnel, conn, flow):
+        try:
+            coalescer = FrameCoalescer(source, tunnel.max_payload)
+            while True:
+                data = await coalescer.read()
+                if not data: break
+                conn.touch()
+                await flow.pace(len(data), DOWN)
+                await BUDGET.hold(len(data), tunnel.send_message(data))
+            conn.half_close(tunnel.writer) # Target is done sending
+        except Exception:
+            conn.close()
+
+    async def start(self, reuse_port=False):
+        """Serves until cancelled. reuse_port lets several worker processes share SERVER_PORT."""
         server = await asyncio.start_server(
-            self.handle_client, '0.0.0.0', Config.SERVER_PORT)
+            self.handle_client, '0.0.0.0', Config.SERVER_PORT, reuse_port=reuse_port, **listen_options())
+        tune_listener(server)
         
-        logging.info(f"ShadowLink Server running on 0.0.0.0:{Config.SERVER_PORT}")
+        logging.info(f"ShadowLink Server running on 0.0.0.0:{Config.SERVER_PORT} ({current_backend()} event loop)")
         logging.info(f"Strict Mode: {self.strict_mode}")
+        if self.ip_monitor:
+            await self.ip_monitor.start()
+        self.lifecycle.start()
+        get_key_pool().start()
+        if not reuse_port:
+            await start_metrics_server()
+        if self.udp and not reuse_port: # Datagrams can't be steered to the worker owning the association
+            try:
+                await self.udp.start()
+            except OSError as e:
+                logging.warning(f"UDP relay disabled: {e}")
         
-        async with server:
-            await server.serve_forever()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.close()
+
+    def close(self):
+        """Stops the UDP relay and IP monitor and closes live connections once serving stops."""
+        if self.udp:
+            self.udp.close()
+        if self.ip_monitor:
+            self.ip_monitor.stop()
+        self.lifecycle.close_all()
 
 if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="ShadowLink Server")
+    parser.add_argument('--workers', type=int, default=Config.SERVER_WORKERS,
+                        help="Worker processes sharing the port via SO_REUSEPORT (Linux)")
+    parser.add_argument('--loop', choices=BACKENDS, default=Config.EVENT_LOOP,
+                        help="Event loop backend (auto = uvloop when installed)")
+    args = parser.parse_args()
+    Config.EVENT_LOOP = args.loop # Inherited by forked workers
+
     # For testing, strictly relying on args would be better, but default is OFF
-    server = ShadowServer()
-    try:
-        asyncio.run(server.start())
-    except KeyboardInterrupt:
-        pass
+    if args.workers > 1:
+        from workers import ServerSupervisor
+        ServerSupervisor(args.workers).run_forever()
+    else:
+        server = ShadowServer()
+        try:
+            run(server.start(), args.loop)
+        except KeyboardInterrupt:
+            pass
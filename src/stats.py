@@ -0,0 +1,135 @@
+import asyncio
+import time
+from collections import deque
+from config import Config
+from metrics import BYTES, CONNECTIONS_ACTIVE, THROUGHPUT, TTFB_SECONDS
+
+# Traffic accounting for the GUI and the headless stats log.
+# Counters are plain ints only ever written from the event loop thread, so the hot path is
+# a few additions and no lock. A publisher task turns them into an immutable snapshot dict a
+# few times per second; readers in other threads (the GUI) just grab the latest reference.
+
+_BYTES_UP = BYTES.labels('up')
+_BYTES_DOWN = BYTES.labels('down')
+_ACTIVE = CONNECTIONS_ACTIVE.labels('client')
+
+
+class ConnectionCounters:
+    """Bytes through one proxied connection. Updating it also updates the global totals."""
+    __slots__ = ('traffic', 'label', 'opened_at', 'sent', 'received')
+
+    def __init__(self, traffic, label):
+        self.traffic = traffic
+        self.label = label
+        self.opened_at = time.monotonic()
+        self.sent = 0
+        self.received = 0
+
+    def add_sent(self, n):
+        self.sent += n
+        self.traffic.sent += n
+        _BYTES_UP.value += n
+
+    def add_received(self, n):
+        if not self.received:
+            TTFB_SECONDS.labels().observe(time.monotonic() - self.opened_at)
+        self.received += n
+        self.traffic.received += n
+        _BYTES_DOWN.value += n
+
+    def close(self):
+        self.traffic.close_connection(self)
+        duration = time.monotonic() - self.opened_at
+        if duration > 0:
+            if self.sent:
+                THROUGHPUT.labels('up').observe(self.sent / duration)
+            if self.received:
+                THROUGHPUT.labels('down').observe(self.received / duration)
+
+
+class TrafficStats:
+    """
+    Global and per-connection byte counters plus sliding-window rates.
+
+    Only the event loop writes; publish() (run on the loop) builds a new snapshot dict and
+    swaps it into self.snapshot, which other threads may read at any time.
+    """
+    def __init__(self, window=None, interval=None):
+        self.window = Config.STATS_WINDOW if window is None else window
+        self.interval = Config.STATS_INTERVAL if interval is None else interval
+        self.sent = 0
+        self.received = 0
+        self.connections = set()
+        self.connections_total = 0
+        self._samples = deque() # (time, sent, received), oldest first
+        self._conn_samples = {} # ConnectionCounters -> (time, sent, received) of the previous publish
+        self.admission = None # AdmissionControl whose pressure is published alongside the traffic
+        self.lifecycle = None # Lifecycle whose live/leaked counts are published too
+        self.router = None # Router whose per-action counts are published too
+        self.shaper = None # TrafficShaper whose rate limit waits are published too
+        self.snapshot = self._empty_snapshot()
+
+    def _empty_snapshot(self) -> dict:
+        return {'sent': 0, 'recv': 0, 'rate_sent': 0.0, 'rate_recv': 0.0,
+                'active': 0, 'total': 0, 'connections': [], 'pressure': {}, 'lifecycle': {}, 'routes': {}, 'shaping': {}, 'time': time.time()}
+
+    def open_connection(self, label) -> ConnectionCounters:
+        counters = ConnectionCounters(self, label)
+        self.connections.add(counters)
+        self.connections_total += 1
+        _ACTIVE.inc()
+        return counters
+
+    def close_connection(self, counters):
+        if counters in self.connections:
+            self.connections.discard(counters)
+            self._conn_samples.pop(counters, None)
+            _ACTIVE.dec()
+
+    def publish(self) -> dict:
+        """Samples the counters and publishes a fresh snapshot. Rates are bytes/s over the window."""
+        now = time.monotonic()
+        self._samples.append((now, self.sent, self.received))
+        while len(self._samples) > 2 and now - self._samples[1][0] >= self.window:
+            self._samples.popleft()
+
+        oldest = self._samples[0]
+        elapsed = now - oldest[0]
+        rate_sent = (self.sent - oldest[1]) / elapsed if elapsed > 0 else 0.0
+        rate_recv = (self.received - oldest[2]) / elapsed if elapsed > 0 else 0.0
+
+        connections = []
+        for conn in self.connections:
+            # Per connection we only keep the previous publish, an interval-long window
+            then, sent, received = self._conn_samples.get(conn, (conn.opened_at, 0, 0))
+            dt = now - then
+            connections.append({
+                'label': conn.label,
+                'sent': conn.sent,
+                'recv': conn.received,
+                'rate_sent': (conn.sent - sent) / dt if dt > 0 else 0.0,
+                'rate_recv': (conn.received - received) / dt if dt > 0 else 0.0,
+            })
+            self._conn_samples[conn] = (now, conn.sent, conn.received)
+        connections.sort(key=lambda c: c['rate_sent'] + c['rate_recv'], reverse=True)
+
+        self.snapshot = {
+            'sent': self.sent,
+            'recv': self.received,
+            'rate_sent': rate_sent,
+            'rate_recv': rate_recv,
+            'active': len(self.connections),
+            'total': self.connections_total,
+            'connections': connections,
+            'pressure': self.admission.stats() if self.admission else {},
+            'lifecycle': self.lifecycle.stats() if self.lifecycle else {},
+            'routes': self.router.stats() if self.router else {},
+            'shaping': self.shaper.stats() if self.shaper else {},
+            'time': time.time(),
+        }
+        return self.snapshot
+
+    async def run_publisher(self):
+        while True:
+            self.publish()
+            await asyncio.sleep(self.interval)
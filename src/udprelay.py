@@ -0,0 +1,285 @@
+import asyncio
+import ipaddress
+import logging
+import os
+import socket
+import time
+from config import Config
+from encryption import DatagramCipher
+from metrics import UDP_DATAGRAMS
+
+# SOCKS5 UDP ASSOCIATE.
+# The association is set up over a tunnel: the client sends UDP_HELLO, the server answers
+# UDP_ACCEPT + association id (8) + key (32) + UDP port (2) and keeps the tunnel open as the
+# association's lifetime. Datagrams then travel over real UDP, sealed with DatagramCipher.
+# The sealed payload is the SOCKS UDP request minus RSV/FRAG: [ATYP][DST.ADDR][DST.PORT][DATA]
+# (replies carry the source address in the same format).
+
+UDP_HELLO = b"UDP"
+UDP_ACCEPT = b"UDP-OK"
+
+ASSOCIATION_ID_SIZE = 8
+
+
+def parse_socks_address(data, offset=0):
+    """Parses [ATYP][ADDR][PORT] at offset. Returns (host, port, end offset)."""
+    atyp = data[offset]
+    if atyp == 0x01:
+        end = offset + 5
+        host = socket.inet_ntoa(data[offset + 1:end])
+    elif atyp == 0x04:
+        end = offset + 17
+        host = socket.inet_ntop(socket.AF_INET6, data[offset + 1:end])
+    elif atyp == 0x03:
+        end = offset + 2 + data[offset + 1]
+        host = data[offset + 2:end].decode()
+    else:
+        raise ValueError(f"Bad address type {atyp}")
+    if end + 2 > len(data):
+        raise ValueError("Truncated address")
+    return host, int.from_bytes(data[end:end + 2], 'big'), end + 2
+
+
+def pack_socks_address(host, port) -> bytes:
+    try:
+        ip = ipaddress.ip_address(host)
+    except ValueError:
+        encoded = host.encode()
+        return b'\x03' + bytes([len(encoded)]) + encoded + port.to_bytes(2, 'big')
+    atyp = b'\x04' if ip.version == 6 else b'\x01'
+    return atyp + ip.packed + port.to_bytes(2, 'big')
+
+
+class _Endpoint(asyncio.DatagramProtocol):
+    """Hands every datagram to a callback."""
+    def __init__(self, on_datagram):
+        self.on_datagram = on_datagram
+
+    def connection_made(self, transport):
+        # Bursts (QUIC flights) overflow default buffers long before the loop gets to read them
+        sock = transport.get_extra_info('socket')
+        for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, option, Config.UDP_SOCKET_BUFFER)
+            except OSError:
+                pass
+
+    def datagram_received(self, data, addr):
+        self.on_datagram(data, addr)
+
+    def error_received(self, exc):
+        logging.debug(f"UDP error: {exc}")
+
+
+class _ServerAssociation:
+    """Server side of one association: its cipher, the client's UDP address and upstream sockets."""
+    role = 'server'
+
+    def __init__(self, relay, association_id, key):
+        self.relay = relay
+        self.association_id = association_id
+        self.cipher = DatagramCipher(key, association_id)
+        self.client_addr = None
+        self.upstream = {} # address family -> [transport, last used]
+        self._opening = {} # address family -> Future of the transport being created
+        self.closed = False
+
+    def from_client(self, packet, addr):
+        try:
+            payload = self.cipher.open(packet)
+            host, port, offset = parse_socks_address(payload)
+        except Exception:
+            UDP_DATAGRAMS.labels(self.role, 'dropped').inc()
+            return
+        self.client_addr = addr # Follows the client if its source port changes (NAT rebinding)
+        if not self.relay.server.check_safety():
+            UDP_DATAGRAMS.labels(self.role, 'dropped').inc()
+            return
+        UDP_DATAGRAMS.labels(self.role, 'up').inc()
+        data = payload[offset:]
+        try:
+            ip = ipaddress.ip_address(host)
+        except ValueError:
+            asyncio.ensure_future(self._send_resolved(host, port, data))
+            return
+        family = socket.AF_INET6 if ip.version == 6 else socket.AF_INET
+        entry = self.upstream.get(family)
+        if entry:
+            entry[1] = time.monotonic()
+            entry[0].sendto(data, (host, port))
+        else:
+            asyncio.ensure_future(self._send_slow(family, (host, port), data))
+
+    async def _send_resolved(self, host, port, data):
+        try:
+            family, sockaddr = (await self.relay.server.dns.resolve(host, port))[0]
+        except Exception:
+            UDP_DATAGRAMS.labels(self.role, 'dropped').inc()
+            return
+        await self._send_slow(family, sockaddr, data)
+
+    async def _send_slow(self, family, sockaddr, data):
+        try:
+            transport = await self._transport(family)
+        except Exception as e:
+            logging.debug(f"UDP upstream socket failed: {e}")
+            UDP_DATAGRAMS.labels(self.role, 'dropped').inc()
+            return
+        if self.closed:
+            transport.close()
+            return
+        self.upstream[family][1] = time.monotonic()
+        transport.sendto(data, sockaddr)
+
+    async def _transport(self, family):
+        entry = self.upstream.get(family)
+        if entry:
+            return entry[0]
+        opening = self._opening.get(family)
+        if opening is None:
+            opening = self._opening[family] = asyncio.ensure_future(self._open_upstream(family))
+            opening.add_done_callback(lambda _: self._opening.pop(family, None))
+        return await asyncio.shield(opening)
+
+    async def _open_upstream(self, family):
+        if self.relay.upstream_sockets() >= Config.UDP_MAX_SOCKETS:
+            raise OSError("UDP socket pool exhausted")
+        bind = '::' if family == socket.AF_INET6 else '0.0.0.0'
+        transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: _Endpoint(self.from_upstream), local_addr=(bind, 0), family=family)
+        self.upstream[family] = [transport, time.monotonic()]
+        return transport
+
+    def from_upstream(self, data, addr):
+        if self.client_addr is None:
+            return
+        UDP_DATAGRAMS.labels(self.role, 'down').inc()
+        self.relay.transport.sendto(self.cipher.seal(pack_socks_address(addr[0], addr[1]) + data), self.client_addr)
+
+    def expire(self, now):
+        for family, (transport, last_used) in list(self.upstream.items()):
+            if now - last_used > Config.UDP_IDLE_TIMEOUT:
+                transport.close()
+                del self.upstream[family]
+
+    def close(self):
+        self.closed = True
+        for transport, _ in self.upstream.values():
+            transport.close()
+        self.upstream.clear()
+
+
+class UdpRelayServer:
+    """
+    The server's UDP port. Routes client datagrams to their association by id and keeps a
+    bounded pool of upstream sockets (one per association and address family) that are
+    closed after Config.UDP_IDLE_TIMEOUT without traffic.
+    """
+    role = 'server'
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.port = None
+        self.associations = {} # association id -> _ServerAssociation
+        self._sweeper = None
+
+    async def start(self, host='0.0.0.0', port=None):
+        port = Config.SERVER_PORT if port is None else port
+        self.transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: _Endpoint(self.datagram_received), local_addr=(host, port))
+        self.port = self.transport.get_extra_info('sockname')[1]
+        self._sweeper = asyncio.ensure_future(self._sweep())
+        logging.info(f"UDP relay on {host}:{self.port}")
+
+    def open_association(self):
+        """Returns (association id, key) for a new association."""
+        association_id = os.urandom(ASSOCIATION_ID_SIZE)
+        key = os.urandom(32)
+        self.associations[association_id] = _ServerAssociation(self, association_id, key)
+        return association_id, key
+
+    def close_association(self, association_id):
+        association = self.associations.pop(association_id, None)
+        if association:
+            association.close()
+
+    def upstream_sockets(self) -> int:
+        return sum(len(a.upstream) for a in self.associations.values())
+
+    def datagram_received(self, packet, addr):
+        association = self.associations.get(packet[:ASSOCIATION_ID_SIZE])
+        if association is None:
+            UDP_DATAGRAMS.labels(self.role, 'dropped').inc()
+            return
+        association.from_client(packet, addr)
+
+    async def _sweep(self):
+        while True:
+            await asyncio.sleep(Config.UDP_IDLE_TIMEOUT / 2)
+            now = time.monotonic()
+            for association in list(self.associations.values()):
+                association.expire(now)
+
+    def close(self):
+        if self._sweeper:
+            self._sweeper.cancel()
+        for association_id in list(self.associations):
+            self.close_association(association_id)
+        if self.transport:
+            self.transport.close()
+
+
+class UdpAssociation:
+    """
+    Client side of one SOCKS UDP ASSOCIATE: a local socket for the application and a socket
+    to the server's UDP port. Lives as long as the SOCKS control connection.
+    """
+    role = 'client'
+
+    def __init__(self, association_id, key, counters=None):
+        self.cipher = DatagramCipher(key, association_id)
+        self.counters = counters
+        self.local = None
+        self.remote = None
+        self.app_addr = None
+        self.allowed_host = None
+
+    async def start(self, bind_host, server_host, server_port, allowed_host):
+        """Opens both sockets. Returns the (host, port) the application must send to."""
+        loop = asyncio.get_running_loop()
+        self.allowed_host = allowed_host
+        self.local, _ = await loop.create_datagram_endpoint(
+            lambda: _Endpoint(self.from_app), local_addr=(bind_host, 0))
+        self.remote, _ = await loop.create_datagram_endpoint(
+            lambda: _Endpoint(self.from_server), remote_addr=(server_host, server_port))
+        return self.local.get_extra_info('sockname')[:2]
+
+    def from_app(self, data, addr):
+        # RFC 1928: only the host that made the association may use it
+        if addr[0] != self.allowed_host or len(data) < 4 or data[2] != 0x00:
+            UDP_DATAGRAMS.labels(self.role, 'dropped').inc() # Wrong sender, or a fragment (unsupported)
+            return
+        self.app_addr = addr
+        self.remote.sendto(self.cipher.seal(data[3:]))
+        UDP_DATAGRAMS.labels(self.role, 'up').inc()
+        if self.counters:
+            self.counters.add_sent(len(data) - 3)
+
+    def from_server(self, packet, addr):
+        try:
+            payload = self.cipher.open(packet)
+        except Exception:
+            UDP_DATAGRAMS.labels(self.role, 'dropped').inc()
+            return
+        if self.app_addr is None:
+            return
+        self.local.sendto(b'\x00\x00\x00' + payload, self.app_addr)
+        UDP_DATAGRAMS.labels(self.role, 'down').inc()
+        if self.counters:
+            self.counters.add_received(len(payload))
+
+    def close(self):
+        for transport in (self.local, self.remote):
+            if transport:
+                transport.close()
@@ -0,0 +1,129 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import socket
+import sys
+import time
+from config import Config
+from eventloop import run
+
+def reuse_port_supported() -> bool:
+    return sys.platform.startswith('linux') and hasattr(socket, 'SO_REUSEPORT')
+
+def _worker_main(worker_id, strict_mode, safe_isp_ip, stats_queue):
+    """Entry point of a worker process: one ShadowServer bound with SO_REUSEPORT."""
+    from server import ShadowServer
+
+    server = ShadowServer(strict_mode=strict_mode, safe_isp_ip=safe_isp_ip)
+
+    async def report():
+        while True:
+            await asyncio.sleep(Config.WORKER_STATS_INTERVAL)
+            try:
+                stats_queue.put_nowait((worker_id, os.getpid(), server.stats()))
+            except queue.Full:
+                pass
+
+    async def main():
+        asyncio.ensure_future(report())
+        await server.start(reuse_port=True)
+
+    try:
+        run(main())
+    except KeyboardInterrupt:
+        pass
+
+class ServerSupervisor:
+    """
+    Forks N ShadowServer workers that share Config.SERVER_PORT through SO_REUSEPORT, so the
+    kernel spreads connections (and their handshakes and crypto) across interpreters.
+    Crashed workers are restarted; their periodic stats are aggregated here.
+    """
+    def __init__(self, workers, strict_mode=False, safe_isp_ip=None):
+        self.workers = workers
+        self.strict_mode = strict_mode
+        self.safe_isp_ip = safe_isp_ip
+        self.ctx = multiprocessing.get_context('fork')
+        self.stats_queue = self.ctx.Queue(maxsize=1024)
+        self.processes = {} # worker id -> Process
+        self.started_at = {} # worker id -> last (re)start time
+        self.worker_stats = {} # worker id -> latest stats dict
+        self.restarts = 0
+        self.stopping = False
+
+    def _spawn(self, worker_id):
+        process = self.ctx.Process(target=_worker_main, name=f"shadowlink-worker-{worker_id}",
+                                   args=(worker_id, self.strict_mode, self.safe_isp_ip, self.stats_queue),
+                                   daemon=True)
+        process.start()
+        self.processes[worker_id] = process
+        self.started_at[worker_id] = time.monotonic()
+        logging.info(f"Worker {worker_id} started (pid {process.pid})")
+
+    def start(self):
+        if not reuse_port_supported():
+            raise RuntimeError("SO_REUSEPORT workers need Linux; run a single-process server instead")
+        for worker_id in range(self.workers):
+            self._spawn(worker_id)
+
+    def poll(self):
+        """Collects pending stats and restarts workers that died. Call periodically."""
+        while True:
+            try:
+                worker_id, pid, stats = self.stats_queue.get_nowait()
+            except queue.Empty:
+                break
+            process = self.processes.get(worker_id)
+            if process and process.pid == pid: # Ignore reports from a worker we already replaced
+                self.worker_stats[worker_id] = stats
+
+        if self.stopping:
+            return
+        for worker_id, process in list(self.processes.items()):
+            if process.is_alive():
+                continue
+            if time.monotonic() - self.started_at[worker_id] < Config.WORKER_RESTART_BACKOFF:
+                continue # Crash looping: give it a moment
+            logging.error(f"Worker {worker_id} (pid {process.pid}) exited with code {process.exitcode}, restarting")
+            self.worker_stats.pop(worker_id, None)
+            self.restarts += 1
+            self._spawn(worker_id)
+
+    def aggregate_stats(self) -> dict:
+        """Sums the latest counters of all live workers."""
+        total = {}
+        for stats in self.worker_stats.values():
+            for key, value in stats.items():
+                if isinstance(value, (int, float)) and key != 'resumption_ratio':
+                    total[key] = total.get(key, 0) + value
+        handshakes = total.get('full', 0) + total.get('resumed', 0)
+        total['resumption_ratio'] = total.get('resumed', 0) / handshakes if handshakes else 0.0
+        total['workers_alive'] = sum(1 for p in self.processes.values() if p.is_alive())
+        total['worker_restarts'] = self.restarts
+        return total
+
+    def stop(self):
+        self.stopping = True
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes.values():
+            process.join(timeout=5)
+
+    def run_forever(self, report_every=30):
+        self.start()
+        logging.info(f"Supervising {self.workers} workers on port {Config.SERVER_PORT}")
+        last_report = time.monotonic()
+        try:
+            while True:
+                time.sleep(1)
+                self.poll()
+                if time.monotonic() - last_report >= report_every:
+                    last_report = time.monotonic()
+                    logging.info(f"Workers: {self.aggregate_stats()}")
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()